@@ -130,7 +130,7 @@ class Main(object):
 
         ## set action
         action = options.get('a')
-        actions = ('render', 'convert', 'cache', 'retrieve', 'statements', 'syntax', 'dump', 'preprocess')
+        actions = ('render', 'convert', 'cache', 'retrieve', 'statements', 'syntax', 'dump', 'preprocess', 'static', 'bundle', 'deps')
         if action:
             if action not in actions:
                 raise self.error("-a %s: unknown action." % action)
@@ -232,9 +232,31 @@ class Main(object):
             if properties.get('templateclass') == tenjin.Preprocessor:
                 properties['templateclass'] = tenjin.SafePreprocessor
 
+        ## '--bundle' option
+        bundle_path = properties.pop('bundle', None)
+        if action == 'bundle':
+            if not bundle_path or bundle_path is True:
+                raise self.error("-a bundle: '--bundle=file' option required.")
+            if not filenames:
+                raise self.error("-a bundle: template filenames required.")
+
+        if action == 'deps' and not filenames:
+            raise self.error("-a deps: template filenames required.")
+
         ## create engine
         engine = tenjin.Engine(**properties)
 
+        ## build bundle file
+        if action == 'bundle':
+            n = tenjin.BundleCacheStorage(bundle_path).build(engine, filenames)
+            return not options.get('q') and "%s - %d templates.\n" % (bundle_path, n) or ''
+
+        ## dump dependency graph of templates ('target: dependencies' format)
+        if action == 'deps':
+            graph = engine.dependency_graph(filenames, context)
+            return ''.join([ "%s:%s\n" % (filepath, ''.join([ ' ' + (dep[2] or dep[1]) for dep in deps ]))
+                             for filepath, deps in graph.items() ])
+
         ## execute
         output_buf = []
         template_names = filenames
@@ -258,15 +280,27 @@ class Main(object):
                 try:
                     template = engine.get_template(template_name)
                     output = self.check_syntax(template.script, template.filename)
+                    if output is None and template.macro_script:
+                        output = self.check_syntax(template.macro_script, template.filename)
                 except TemplateSyntaxError as ex:
                     output = ex.build_error_message()
                 if output is None:
                     output = not options.get('q') and "%s - ok.\n" % template.filename or ''
+            elif action == 'static':
+                template = engine.get_template(template_name)
+                status = template.static is not None and 'static' or 'dynamic'
+                output = "%s - %s.\n" % (template.filename, status)
             elif action == 'dump':
                 cache_filename = template_name
                 with open(cache_filename, 'rb') as f:
                     dct = marshal.load(f)
-                output = dct['script']
+                output = dct.get('script')
+                #: regenerate python script if not stored (by LeanMarshalCacheStorage).
+                if output is None:
+                    filename = re.sub(r'\.cache$', '', cache_filename)
+                    if not os.path.isfile(filename):
+                        filename = os.path.splitext(filename)[0]
+                    output = engine.get_script(filename)
                 if dct['args'] is not None:
                     output += '#@ARGS ' + ', '.join(dct['args']) + "\n"
             elif action == 'render' or action == 'preprocess':
@@ -357,6 +391,9 @@ Usage: %(command)s [..options..] [file1 [file2...]]
      -a syntax        :  syntax check of template
      -a dump          :  show scripts in cache file
      -a preprocess    :  show preprocessed template
+     -a static        :  report whether template is static (no statements nor expressions)
+     -a bundle        :  precompile templates into a bundle file (with '--bundle=file')
+     -a deps          :  show templates which templates include, use as layout or import
   -s                  :  alias of '-a convert'
   -S                  :  alias of '-a retrieve'
   -X                  :  alias of '-a statements'
@@ -388,6 +425,7 @@ Usage: %(command)s [..options..] [file1 [file2...]]
   --pp=name1,name2,.. :  preprocessor class (Trim,JavaScript,PrefixedLine)
   --templateclass=name:  template class (default: tenjin.Template)
   --safe              :  use SafeTemplate class instead of Template
+  --bundle=file       :  bundle file name (for '-a bundle')
 Examples:
  ex1. render template
    $ %(command)s file.pyhtml
@@ -404,6 +442,10 @@ Examples:
    $ %(command)s -c 'title="tenjin example"; items=[1,2,3]' file.pyhtml   # python
  ex6. syntax check
    $ %(command)s -a syntax *.pyhtml   # or '-z'
+ ex7. precompile templates into a bundle file
+   $ %(command)s -a bundle --bundle=views.bundle views/*.pyhtml
+ ex8. show dependency graph of templates
+   $ %(command)s -a deps --path=views page.pyhtml
 """ % { 'command': command }
         return re.compile(r'^#.*?\n', re.M).sub('', s[1:])
 
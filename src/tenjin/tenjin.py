@@ -19,10 +19,12 @@ __all__      = ('Template', 'Engine', )
 
 
 import sys, os, re, time, marshal
+from collections import OrderedDict
 from time import time as _time
 from os.path import getmtime as _getmtime
 from os.path import isfile as _isfile
-random = pickle = unquote = None   # lazy import
+random = pickle = quote = unquote = json = ast = threading = sqlite3 = mmap = py_compile = hashlib = atexit = glob = concurrent = signal = None   # lazy import
+weakref = ctypes = select = struct = importlib = None   # lazy import
 python3 = sys.version_info[0] == 3
 python2 = sys.version_info[0] == 2
 
@@ -490,6 +492,45 @@ class TemplateSyntaxError(SyntaxError):
         ])
 
 
+class MemoizeStore(object):
+    """Bounded in-memory store for rendered output, which removes least
+       recently used items when number of items exceeds 'size', and
+       expires items after 'ttl' seconds (0 or None means no expiration).
+    """
+
+    def __init__(self, size=256, ttl=None):
+        self.size  = size
+        self.ttl   = ttl
+        self.items = OrderedDict()   # key: tuple of argument values, value: (output, expires_at)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        output, expires_at = item
+        try:
+            if expires_at and expires_at < _time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+        except KeyError:   # removed by other thread
+            pass
+        return output
+
+    def set(self, key, output):
+        items = self.items
+        items[key] = (output, self.ttl and _time() + self.ttl or None)
+        try:
+            items.move_to_end(key)
+            while len(items) > self.size:
+                items.popitem(last=False)
+        except KeyError:   # removed by other thread
+            pass
+
+    def clear(self):
+        self.items.clear()
+
+
 class Template(object):
     """Convert and evaluate embedded python string.
        See User's Guide and examples for details.
@@ -507,10 +548,36 @@ class Template(object):
     smarttrim  = None
     args       = None
     timestamp  = None
+    depends    = None    # dict of filepath and timestamp of parent and imported templates
+    checksums  = None    # dict of filepath and content hash of template and parents (see Engine.checksum)
+    fragments  = None    # dict of fragment name and compiled code (see get_fragment())
+    macro_script = None  # python script of macros defined by '#@MACRO' (see get_macros())
+    imports    = None    # list of [template name, alias, names] declared by '#@IMPORT' or '#@FROM'
+    references = None    # list of ['include' or 'layout', template name] found in python script
+    line_map   = None    # list of [line number, filename, line number in it] of expanded input (see expand_blocks())
+    _macros    = None    # dict of macro name and function (see get_macros())
+    _imported  = None    # dict of name and macro or namespace imported (set by Engine)
+    _prefetched = False  # True if referenced templates are prefetched (set by Engine)
+    memoize    = False   # if True then memoize output by values of '#@ARGS' (see render())
+    memoize_size = 256   # max number of memoized outputs
+    memoize_ttl  = 60    # seconds (0 or None means no expiration)
+    _memo      = None    # MemoizeStore object
+    static     = None    # output string if template has no statements nor expressions
+    tier       = 1       # 2 means bytecode is optimized by TemplateOptimizer (see Engine.tier_threshold)
+    tier_passes = None   # list of optimizer pass names applied
+    _render_count = 0    # number of rendering counted by Engine
+    _promoting = False   # True when promotion to tier 2 is started
+    _blocks    = None    # list of checkpoints between top-level blocks (see convert())
+    compile_error = None # SyntaxError raised by compile() (raised again without compiling)
+    compile_error_hits = 0  # number of times compile_error is raised again
     trace      = False   # if True then '<!-- begin: file -->' and '<!-- end: file -->' are printed
+    #: attributes which affect converted python code (see cache_signature())
+    cache_options = ('encoding', 'escapefunc', 'tostrfunc', 'indent', 'preamble', 'postamble', 'smarttrim', 'trace')
+    pp_signature = None  # identifies preprocessors of engine which affect converted python code (see Engine._new_template())
 
     def __init__(self, filename=None, encoding=None, input=None, escapefunc=None, tostrfunc=None,
-                       indent=None, preamble=None, postamble=None, smarttrim=None, trace=None):
+                       indent=None, preamble=None, postamble=None, smarttrim=None, trace=None,
+                       memoize=None):
         """Initailizer of Template class.
 
            filename:str (=None)
@@ -538,6 +605,9 @@ class Template(object):
            smarttrim:bool (=None)
              If True then "<div>\\n#{_context}\\n</div>" is parsed as
              "<div>\\n#{_context}</div>".
+           memoize:bool (=None)
+             If True then output is memoized by values of template arguments
+             declared by '#@ARGS' ('#@MEMOIZE' in template does the same).
         """
         if encoding   is not None:  self.encoding   = encoding
         if escapefunc is not None:  self.escapefunc = escapefunc
@@ -547,6 +617,7 @@ class Template(object):
         if postamble  is not None:  self.postamble  = postamble
         if smarttrim  is not None:  self.smarttrim  = smarttrim
         if trace      is not None:  self.trace      = trace
+        if memoize    is not None:  self.memoize    = memoize
         #
         if preamble  is True:  self.preamble  = "_buf = []"
         if postamble is True:  self.postamble = "print(''.join(_buf))"
@@ -558,6 +629,23 @@ class Template(object):
         else:
             self._reset()
 
+    def cache_signature(self):
+        """Return string which identifies python bytecode version, tenjin
+           version and options to convert template (including preprocessors
+           of engine). Cache storage ignores cached template attributes if
+           their signature is different from this.
+        """
+        global hashlib, importlib
+        if hashlib is None: import hashlib
+        if importlib is None: import importlib.machinery, importlib.util
+        klass = self.__class__
+        options = [ (k, getattr(self, k, None)) for k in self.cache_options ]
+        key = repr(('%s.%s' % (klass.__module__, klass.__name__), options))
+        if self.pp_signature:
+            key += self.pp_signature
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return '%s-%s-%s' % (importlib.util.MAGIC_NUMBER.hex(), __version__, digest)
+
     def _reset(self, input=None, filename=None):
         self.script   = None
         self.bytecode = None
@@ -572,6 +660,18 @@ class Template(object):
             else:
                 self.newline = "\n"
         self._localvars_assignments_added = False
+        self._macro = None
+        self.macro_script = None
+        self.imports = None
+        self._macros = self._imported = None
+        self._memo = None
+        self.static = None
+        self.tier = 1
+        self.tier_passes = None
+        self.fragments = None
+        self._blocks = None
+        self.compile_error = None
+        self.compile_error_hits = 0
 
     def _localvars_assignments(self):
         return "_extend=_buf.extend;_to_str=%s;_escape=%s; " % (self.tostrfunc, self.escapefunc)
@@ -594,24 +694,163 @@ class Template(object):
         input = _read_template_file(filename)
         return self.convert(input, filename)
 
-    def convert(self, input, filename=None):
+    def convert(self, input, filename=None, base=None):
         """Convert string in which python code is embedded into python script and return it.
 
            input:str
              Input string to convert into python code.
            filename:str (=None)
              Filename of input. this is optional but recommended to report errors.
+           base:Template (=None)
+             Template object converted from previous version of input.
+             If specified, only top-level blocks changed from it are converted
+             again and python code of other blocks is reused.
         """
         pass
         self._reset(input, filename)
+        if base is not None:
+            args = self.args
+            script = self._convert_changes(input, base)
+            if script is not None:
+                self.script = script
+                self.references = self._find_references()
+                return script
+            self.args = args
+            self._reset(input, filename)
         buf = []
         self.before_convert(buf)
         self.parse_stmts(buf, input)
         self.after_convert(buf)
         script = ''.join(buf)
         self.script = script
+        self.static = self._static_output(input)
+        self.references = self._find_references()
+        return script
+
+    REFERENCE_PATTERN = re.compile(r'''\binclude\(\s*(['"])([^'"\\]+)\1|'''
+                                   r'''\b_context\[(['"])_layout\3\]\s*=\s*(['"])([^'"\\]+)\4''')
+
+    TEXT_PATTERN = re.compile(r"'''(?:[^'\\]|\\.)*'''", re.S)   # text literal (see add_text())
+
+    def _find_references(self):
+        #: return templates included or used as layout by string literal (or None).
+        refs = []
+        for script in (self.script, self.macro_script):
+            #: ignore text of template (such as 'include("_footer.pyhtml")' in plain text).
+            code = self.TEXT_PATTERN.sub("''", script or '')
+            for m in self.REFERENCE_PATTERN.finditer(code):
+                ref = m.group(2) and ['include', m.group(2)] or ['layout', m.group(5)]
+                if ref not in refs:
+                    refs.append(ref)
+        return refs or None
+
+    ##
+    ## incremental conversion
+    ##
+    ## parse_stmts() records checkpoints after top-level statements (where no
+    ## blocks are open) as tuples of (offset of input, offset of script,
+    ## whether local vars assignments are added, whether '#@ARGS' is declared).
+    ## When template is edited, input between checkpoints around changed range
+    ## is converted and python code of other blocks is reused.
+    ##
+    _OPTIONS = ('escapefunc', 'tostrfunc', 'indent', 'smarttrim', 'encoding')
+
+    def _convert_changes(self, input, base):
+        #: return None if incremental conversion is not available.
+        old, blocks = base.input, base._blocks
+        if not blocks or old is None or base.script is None or base.macro_script \
+           or self.preamble or self.postamble or base.__class__ is not self.__class__ \
+           or self.newline != base.newline \
+           or [ getattr(self, k) for k in self._OPTIONS ] != [ getattr(base, k) for k in self._OPTIONS ]:
+            return None
+        #: find checkpoints before and after changed range.
+        prefix = _common_prefix_length(old, input)
+        suffix = _common_suffix_length(old, input, min(len(old), len(input)) - prefix)
+        ## (local vars assignments are inserted into existing code when added,
+        ##  therefore checkpoint before adding them is not available as start.)
+        start, end = (0, 0, False, False), None
+        for cp in blocks:
+            if cp[0] <= prefix:
+                if cp[2]:
+                    start = cp
+            elif cp[0] >= len(old) - suffix:
+                end = cp
+                break
+        if start[0] == 0 and end is None:
+            return None
+        delta = len(input) - len(old)
+        stop = end[0] if end else len(old)
+        segment = input[start[0]:stop + delta]
+        #: directives (such as '#@ARGS' or '#@MACRO') change state of template.
+        if '#@' in segment or '#@' in old[start[0]:stop]:
+            return None
+        #: convert changed blocks.
+        self._localvars_assignments_added = start[2]
+        self.args = base.args if start[3] else None
+        buf = []
+        try:
+            self.parse_stmts(buf, segment)
+        except SyntaxError:
+            return None
+        converted = self._blocks or []
+        if end is not None:
+            last = converted and converted[-1]
+            if not last or last[0] != len(segment) or last[2:] != end[2:]:
+                return None
+        #: join python code of changed blocks with others.
+        head = base.script[:start[1]]
+        tail = base.script[end[1]:] if end else ''
+        script = head + ''.join(buf) + tail
+        blocks = [ cp for cp in blocks if cp[0] <= start[0] ] \
+               + [ (o + start[0], i + start[1], f1, f2) for o, i, f1, f2 in converted ]
+        if end is not None:
+            delta2 = len(script) - len(base.script)
+            blocks += [ (o + delta, i + delta2, f1, f2) for o, i, f1, f2 in base._blocks if o > end[0] ]
+        self._blocks = blocks
+        self._localvars_assignments_added = base._localvars_assignments_added
+        self.args = base.args
+        self.imports = base.imports and list(base.imports)
+        for k in ('memoize', 'memoize_size', 'memoize_ttl'):
+            if k in base.__dict__:
+                setattr(self, k, base.__dict__[k])
+        if logger: logger.info("[tenjin.%s] converted %d of %d chars (filename=%r)" % \
+                                   (self.__class__.__name__, len(segment), len(input), self.filename))
         return script
 
+    def _find_checkpoints(self, block, buf, marks):
+        #: return checkpoints where no blocks are open.
+        ## (each item of buf is converted into an item of block.)
+        closed = set()
+        n = 0
+        for i, item in enumerate(block):
+            if isinstance(item, list):
+                n += self._count_lines(item)
+            else:
+                n += 1
+                if i + 1 == len(block) or not isinstance(block[i+1], list):
+                    closed.add(n)
+        checkpoints = []
+        offset, k = 0, 0
+        for pos, index, assignments_added, args_declared in marks:
+            if index in closed:
+                offset += sum([ len(x) for x in buf[k:index] ])
+                k = index
+                checkpoints.append((pos, offset, assignments_added, args_declared))
+        return checkpoints
+
+    def _count_lines(self, block):
+        return sum([ self._count_lines(x) if isinstance(x, list) else 1 for x in block ])
+
+    def _static_output(self, input):
+        #: return input as output if template has no statements nor expressions.
+        if self.preamble or self.postamble:
+            return None
+        if not input:
+            return ''
+        if self.stmt_pattern().search(input) or self.expr_pattern().search(input):
+            return None
+        return input
+
     STMT_PATTERN = (r'<\?py( |\t|\r?\n)(.*?) ?\?>([ \t]*\r?\n)?', re.S)
 
     def stmt_pattern(self):
@@ -625,7 +864,10 @@ class Template(object):
         rexp = self.stmt_pattern()
         is_bol = True
         index = 0
+        macro_buf = []
+        marks = []
         for m in rexp.finditer(input):
+            pos = m.start()
             mspace, code, rspace = m.groups()
             #mspace, close, rspace = m.groups()
             #code = input[m.start()+4+len(mspace):m.end()-len(close)-(rspace and len(rspace) or 0)]
@@ -660,14 +902,28 @@ class Template(object):
             if code:
                 code = self.statement_hook(code)
                 m = self._match_to_args_declaration(code)
+                m2 = not m and '#@' in code and self.DIRECTIVE_PATTERN.match(code.strip())
                 if m:
                     self._add_args_declaration(buf, m)
+                elif m2 and m2.group(1) == 'MEMOIZE':
+                    self._add_memoize_directive(buf, m2, code, _linenum(input, pos))
+                elif m2:
+                    self._add_macro_directive(buf, m2, code, _linenum(input, pos), macro_buf)
                 else:
                     self.add_stmt(buf, code)
+            if is_bol and not self._macro:
+                marks.append((index, len(buf), self._localvars_assignments_added, self.args is not None))
+        if self._macro:
+            msg = "'#@MACRO %s' is not closed." % (self._macro[0], )
+            raise TemplateSyntaxError(msg, (self.filename, _linenum(input, len(input)), None, None))
         rest = input[index:]
         if rest:
             self.parse_exprs(buf, rest)
-        self._arrange_indent(buf)
+        block = self._arrange_indent(buf)
+        if macro_buf:
+            self.macro_script = ''.join(macro_buf)
+        elif marks and block is not None:
+            self._blocks = self._find_checkpoints(block, buf, marks)
 
     def statement_hook(self, stmt):
         """expand macros and parse '#@ARGS' in a statement."""
@@ -694,6 +950,470 @@ class Template(object):
         #if nl: declares.append(nl)
         buf.append(''.join(declares) + "\n")
 
+    ##
+    ## macros which are compiled into python functions only once
+    ##
+    ## ex. (_components.pyhtml)
+    ##   <?py #@MACRO card(title, body='') ?>
+    ##   <div class="card"><h2>${title}</h2>#{body}</div>
+    ##   <?py #@ENDMACRO ?>
+    ## ex. (page.pyhtml)
+    ##   <?py #@FROM _components.pyhtml IMPORT card ?>
+    ##   #{card('Hello')}
+    ##   <?py card('World', _buf=_buf) ?>
+    ##
+    DIRECTIVE_PATTERN = re.compile(r'^#@(MACRO|ENDMACRO|IMPORT|FROM|MEMOIZE)\b[ \t]*(.*?)[ \t]*$')
+
+    def _add_macro_directive(self, buf, m, code, linenum, macro_buf):
+        directive, arg = m.groups()
+        filename = self.filename
+        if directive == 'MACRO':
+            if self._macro:
+                msg = "'#@MACRO %s' is not closed." % (self._macro[0], )
+                raise TemplateSyntaxError(msg, (filename, linenum, None, None))
+            m = re.match(r'^([a-zA-Z_]\w*)[ \t]*\((.*)\)$', arg)
+            if not m:
+                raise TemplateSyntaxError("%r: invalid macro definition." % (arg, ),
+                                          (filename, linenum, None, None))
+            name, params = m.groups()
+            params = self._macro_params(params, linenum, code)
+            #: save state of main script and convert macro body into the end of buf.
+            self._macro = (name, len(buf), self._localvars_assignments_added, linenum)
+            self._localvars_assignments_added = True
+            buf.append("def %s(%s):\n" % (name, params))
+            buf.append("_bufarg = _buf; _buf = [] if _buf is None else _buf; " + self._localvars_assignments().rstrip() + "\n")
+        elif directive == 'ENDMACRO':
+            if not self._macro:
+                msg = "'#@ENDMACRO' found but corresponding '#@MACRO' is missing."
+                raise TemplateSyntaxError(msg, (filename, linenum, None, None))
+            name, index, assignments_added, start_linenum = self._macro
+            if arg and arg != name:
+                msg = "'#@ENDMACRO %s' expected but got '#@ENDMACRO %s'." % (name, arg)
+                raise TemplateSyntaxError(msg, (filename, linenum, None, None))
+            buf.append("return ''.join(_buf) if _bufarg is None else None\n")
+            buf.append("#enddef\n")
+            #: move macro definition from main script into macro script.
+            #: (blank lines are inserted in order to keep line numbers.)
+            lines = buf[index:]
+            del buf[index:]
+            self._arrange_indent(lines)
+            n = start_linenum - 1 - ''.join(macro_buf).count("\n")
+            if n > 0:
+                macro_buf.append("\n" * n)
+            macro_buf.extend(lines)
+            buf.append("\n" * (linenum - start_linenum + 1))
+            self._localvars_assignments_added = assignments_added
+            self._macro = None
+        else:   # 'IMPORT' or 'FROM'
+            if directive == 'IMPORT':
+                m = re.match(r'^(\S+)[ \t]+as[ \t]+([a-zA-Z_]\w*)$', arg)
+                entry = m and [m.group(1).strip('\'"'), m.group(2), None]
+            else:
+                m = re.match(r'^(\S+)[ \t]+(?:IMPORT|import)[ \t]+(.*)$', arg)
+                names = m and [ s.strip() for s in m.group(2).split(',') ]
+                ok = names and all([ re.match(r'^[a-zA-Z_]\w*$', x) for x in names ])
+                entry = ok and [m.group(1).strip('\'"'), None, names]
+            if not entry:
+                raise TemplateSyntaxError("'#@%s %s': invalid import." % (directive, arg),
+                                          (filename, linenum, None, None))
+            if self.imports is None:
+                self.imports = []
+            self.imports.append(entry)
+            self.add_stmt(buf, code)
+
+    def _macro_params(self, params, linenum, code):
+        #: add keyword-only argument '_buf' to macro parameters.
+        global ast
+        if ast is None: import ast
+        try:
+            args = ast.parse("def _(%s): pass" % params).body[0].args
+        except SyntaxError:
+            raise TemplateSyntaxError("%r: invalid macro parameters." % (params, ),
+                                      (self.filename, linenum, None, None))
+        extra = (args.vararg or args.kwonlyargs) and "_buf=None" or "*, _buf=None"
+        if args.kwarg:
+            i = params.rindex('**', 0, args.kwarg.col_offset - len("def _("))
+            return params[:i] + extra + ", " + params[i:]
+        params = params.strip().rstrip(',')
+        return params and params + ", " + extra or extra
+
+    def get_macros(self, globals=None):
+        """Return dict of macro functions defined by '#@MACRO' and imported by
+           '#@IMPORT' or '#@FROM'. Macros are evaluated only once with copy of
+           globals, therefore they can't access to local variables of template.
+        """
+        macros = self._macros
+        if macros is None:
+            macros = {}
+            if self._imported:
+                macros.update(self._imported)
+            if self.macro_script:
+                if globals is None:
+                    globals = sys._getframe(1).f_globals
+                namespace = globals.copy()
+                namespace.update(macros)
+                exec(compile(self.macro_script, self.filename or '(tenjin)', 'exec'), namespace)
+                for name in re.findall(r'^def ([a-zA-Z_]\w*)', self.macro_script, re.M):
+                    macros[name] = namespace[name]
+            self._macros = macros
+        return macros
+
+    ##
+    ## memoize output by values of template arguments
+    ##
+    ## ex.
+    ##   <?py #@ARGS product, currency ?>
+    ##   <?py #@MEMOIZE size=100, ttl=30 ?>
+    ##
+    def _add_memoize_directive(self, buf, m, code, linenum):
+        self.memoize = True
+        for pair in m.group(2).split(','):
+            if not pair.strip():
+                continue
+            m2 = re.match(r'^[ \t]*(size|ttl)[ \t]*=[ \t]*(\d+(?:\.\d+)?)[ \t]*$', pair)
+            if not m2:
+                raise TemplateSyntaxError("'#@MEMOIZE %s': invalid option." % (m.group(2), ),
+                                          (self.filename, linenum, None, None))
+            key, val = m2.groups()
+            if key == 'size': self.memoize_size = int(val)
+            else:             self.memoize_ttl  = float(val)
+        self.add_stmt(buf, code)
+
+    def _memoize_key(self, context):
+        #: return tuple of argument types and values, or None if some of them are not hashable.
+        #: (types are necessary to distinguish such as True from 1 or escaped string from str.)
+        if context is None:
+            context = {}
+        key = tuple([ (type(v), v) for v in [ context.get(name) for name in self.args ] ])
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _memoize_store(self):
+        memo = self._memo
+        if memo is None:
+            memo = self._memo = MemoizeStore(self.memoize_size, self.memoize_ttl)
+        return memo
+
+    ##
+    ## named blocks for layout inheritance
+    ##
+    ## ex. (parent)
+    ##   <html><title><?py #@BLOCK title ?>Default Title<?py #@ENDBLOCK ?></title>
+    ## ex. (child)
+    ##   <?py #@EXTENDS _layout.pyhtml ?>
+    ##   <?py #@BLOCK title ?>My Page<?py #@ENDBLOCK ?>
+    ##
+    BLOCK_PATTERN = re.compile(r'^[ \t]*#@(EXTENDS|BLOCK|ENDBLOCK|ARGS)\b[ \t]*(.*?)[ \t]*$')
+
+    def _scan_block_tags(self, input):
+        """yield tag match and directive match of '#@EXTENDS', '#@BLOCK', '#@ENDBLOCK' and '#@ARGS'."""
+        rexp = self.BLOCK_PATTERN
+        for m in self.stmt_pattern().finditer(input):
+            code = m.group(2)
+            if code and '#@' in code:
+                m2 = rexp.match(code.strip())
+                if m2:
+                    yield m, m2
+
+    def parse_blocks(self, input, filename=None):
+        """Parse '#@EXTENDS', '#@BLOCK' and '#@ENDBLOCK' directives.
+           Returns tuple of parent template name (or None), list of nodes,
+           and '#@ARGS' declarations found. Node is a text string or
+           a list of block name, child nodes, start tag, end tag and
+           position (list of filename and line numbers of start and end tag).
+        """
+        parent = None
+        nodes = []
+        stack = [(None, nodes)]
+        args_tags = []
+        pos = 0
+        for m, m2 in self._scan_block_tags(input):
+            directive, arg = m2.groups()
+            if directive == 'ARGS':
+                args_tags.append((m, arg))
+                continue
+            start = m.start()
+            bol = input.rfind("\n", 0, start) + 1
+            if input[bol:start].isspace():   # spaces at beginning of line
+                start = bol
+            text = input[pos:start]
+            tag = input[start:m.end()]
+            pos = m.end()
+            children = stack[-1][1]
+            if text:
+                children.append(text)
+            linenum = _linenum(input, m.start())
+            if directive == 'EXTENDS':
+                if parent is not None or len(stack) > 1:
+                    msg = "'#@EXTENDS' should be appeared only once and out of blocks."
+                    raise TemplateSyntaxError(msg, (filename, linenum, None, None))
+                parent = arg.strip('\'"')
+                if not parent:
+                    raise TemplateSyntaxError("'#@EXTENDS': template name required.",
+                                              (filename, linenum, None, None))
+            elif directive == 'BLOCK':
+                if not re.match(r'^[a-zA-Z_]\w*$', arg):
+                    raise TemplateSyntaxError("%r: invalid block name." % (arg, ),
+                                              (filename, linenum, None, None))
+                block = [arg, [], tag, None, [filename, linenum, None]]
+                children.append(block)
+                stack.append(block)
+            else:   # 'ENDBLOCK'
+                if len(stack) == 1:
+                    msg = "'#@ENDBLOCK' found but corresponding '#@BLOCK' is missing."
+                    raise TemplateSyntaxError(msg, (filename, linenum, None, None))
+                block = stack.pop()
+                block[3] = tag
+                block[4][2] = linenum
+                name = block[0]
+                if arg and arg != name:
+                    msg = "'#@ENDBLOCK %s' expected but got '#@ENDBLOCK %s'." % (name, arg)
+                    raise TemplateSyntaxError(msg, (filename, linenum, None, None))
+        if len(stack) > 1:
+            msg = "'#@BLOCK %s' is not closed." % (stack[-1][0], )
+            raise TemplateSyntaxError(msg, (filename, _linenum(input, len(input)), None, None))
+        rest = input[pos:]
+        if rest:
+            nodes.append(rest)
+        return parent, nodes, args_tags
+
+    def expand_blocks(self, input, load_parent, filename=None):
+        """Resolve '#@EXTENDS' and '#@BLOCK' statically and return expanded input string.
+
+           input:str
+             Template string which may contain '#@EXTENDS' and '#@BLOCK'.
+           load_parent:callable
+             Function which takes parent template name and returns
+             tuple of content string and filename of parent template.
+           filename:str (=None)
+             Filename of input (used to report errors).
+
+           Blocks in parent template are replaced by blocks of the same name
+           in child template. Content of child template out of blocks is ignored,
+           and '#@ARGS' declarations of all templates are merged.
+           Filename and line number of each line of expanded string are
+           recorded into self.line_map (see source_location()).
+        """
+        self.line_map = None
+        if '#@EXTENDS' not in input and '#@BLOCK' not in input:
+            return input
+        overrides = {}
+        args, args_tag = [], None
+        filenames = [filename]
+        while True:
+            parent, nodes, args_tags = self.parse_blocks(input, filename)
+            for m, arg in args_tags:
+                if args_tag is None:
+                    args_tag = (input[m.start():m.start(2)], input[m.end(2):m.end()])
+                for s in arg.split(','):
+                    s = s.strip()
+                    if s and s not in args:
+                        args.append(s)
+            if parent is None:
+                if len(filenames) == 1:   # no need to expand
+                    return input
+                break
+            defined = {}
+            self._collect_blocks(nodes, defined, filename)
+            for name in defined:
+                overrides.setdefault(name, defined[name])
+            input, filename = load_parent(parent)
+            if filename in filenames:
+                msg = "%r: circular '#@EXTENDS' found." % (parent, )
+                raise TemplateSyntaxError(msg, (filenames[-1], None, None, None))
+            filenames.append(filename)
+        buf = []
+        line_map = []
+        counter = [1]
+        def add(text, filename, linenum):
+            #: record filename and line number only when they are not continued from previous text.
+            lineno = counter[0]
+            if not line_map or line_map[-1][1] != filename or \
+               line_map[-1][2] - line_map[-1][0] != linenum - lineno:
+                if line_map and line_map[-1][0] == lineno:
+                    line_map.pop()
+                line_map.append([lineno, filename, linenum])
+            buf.append(text)
+            counter[0] = lineno + text.count("\n")
+        if len(filenames) > 1 and args_tag:
+            add(''.join((args_tag[0], '#@ARGS ', ', '.join(args), args_tag[1])), filename, 1)
+        self._join_blocks(nodes, overrides, add, (), (filename, 1))
+        self.line_map = line_map
+        return ''.join(buf)
+
+    def source_location(self, lineno):
+        """Return filename and line number in it which correspond to line
+           number of python code. They are different from self.filename and
+           lineno when '#@EXTENDS' is expanded (see expand_blocks()).
+        """
+        line_map = self.line_map
+        if not line_map or not lineno:
+            return self.filename, lineno
+        for start, filename, linenum in reversed(line_map):
+            if start <= lineno:
+                return filename, linenum + (lineno - start)
+        return self.filename, lineno
+
+    def _collect_blocks(self, nodes, defined, filename):
+        for node in nodes:
+            if isinstance(node, list):
+                name, children = node[0], node[1]
+                if name in defined:
+                    msg = "'#@BLOCK %s' is defined twice." % (name, )
+                    raise TemplateSyntaxError(msg, (filename, None, None, None))
+                defined[name] = node
+                self._collect_blocks(children, defined, filename)
+
+    def _join_blocks(self, nodes, overrides, add, active, origin):
+        #: origin is filename and line number of the first node.
+        filename, linenum = origin
+        for node in nodes:
+            if isinstance(node, list):
+                name, _, start_tag, end_tag, (_, start, end) = node
+                block = node
+                if name not in active:
+                    block = overrides.get(name, node)
+                #: block tags are kept in order to find fragments (see find_fragment()).
+                add(start_tag, filename, start)
+                pos = block[4]
+                self._join_blocks(block[1], overrides, add, active + (name, ),
+                                  (pos[0], pos[1] + block[2].count("\n")))
+                add(end_tag, filename, end)
+                linenum = end + end_tag.count("\n")
+            else:
+                add(node, filename, linenum)
+                linenum += node.count("\n")
+
+    ##
+    ## fragments (named block or capture_as() region) which are rendered independently
+    ##
+    CAPTURE_PATTERN = re.compile(r'^(?:with|for[ \t]+\w+[ \t]+in)[ \t]+capture_as\([ \t]*([\'"])(\w+)\1[ \t]*(?:,[^)]*)?\)(?:[ \t]+as[ \t]+\w+)?[ \t]*:$')
+    FRAGMENT_MARKER = '__tenjin_fragment__ = None'
+
+    def find_fragment(self, input, name):
+        """Find named block or capture_as() region with fixed name.
+           Returns tuple of start tag match, start and end position of region,
+           and start and end position of body in region, or None if not found.
+        """
+        rexp = self.BLOCK_PATTERN
+        target = start_m = None
+        depth = 0
+        for m in self.stmt_pattern().finditer(input):
+            code = (m.group(2) or '').strip()
+            if target is None:
+                m2 = rexp.match(code)
+                if m2 and m2.group(1) == 'BLOCK' and m2.group(2) == name:
+                    target, start_m, depth = 'BLOCK', m, 1
+                else:
+                    m2 = self.CAPTURE_PATTERN.match(code)
+                    if m2 and m2.group(2) == name:
+                        target, start_m, depth = 'CAPTURE', m, 1
+                continue
+            if target == 'BLOCK':
+                m2 = rexp.match(code)
+                if m2 and m2.group(1) == 'BLOCK':     depth += 1
+                if m2 and m2.group(1) == 'ENDBLOCK':  depth -= 1
+            else:
+                depth += self._depth_delta(code)
+            if depth == 0:
+                start, body_start, body_end, end = start_m.start(), start_m.end(), m.start(), m.end()
+                bol = input.rfind("\n", body_start, body_end) + 1
+                if bol and input[bol:body_end].isspace():   # spaces before end tag
+                    body_end = bol
+                return start_m, start, end, body_start, body_end
+        return None
+
+    def _depth_delta(self, code):
+        delta = 0
+        for line in code.splitlines():
+            m = self._WORD_REXP.search(line)
+            if not m:
+                continue
+            word = m.group(0)
+            if word in self._END_WORDS:
+                delta -= 1
+            elif word in self._START_WORDS and line.rstrip().endswith(':'):
+                delta += 1
+        return delta
+
+    def convert_fragment(self, name):
+        """Convert fragment (named block or capture_as() region with fixed name)
+           into independent python script and return it. The script contains
+           the fragment and top-level statements which the fragment depends on.
+        """
+        input = self.input
+        ret = input and self.find_fragment(input, name)
+        if not ret:
+            raise ValueError("%s: fragment %r not found." % (self.filename or '(tenjin)', name))
+        m, start, end, body_start, body_end = ret
+        #: replace fragment with marker statement to find statements before fragment.
+        marker = ''.join((input[m.start():m.start(2)], self.FRAGMENT_MARKER, input[m.end(2):m.end()]))
+        outer = self._fragment_converter(None).convert(input[:start] + marker + input[end:], self.filename)
+        body  = self._fragment_converter([]).convert(input[body_start:body_end], self.filename)
+        return self._fragment_script(outer, body)
+
+    def _fragment_converter(self, args):
+        template = object.__new__(self.__class__)
+        template.__dict__.update(self.__dict__)
+        template.args = args
+        template.preamble = template.postamble = None
+        return template
+
+    _FRAGMENT_PROVIDED = ('_buf', '_context', '_extend', '_to_str', '_escape')
+    _OUTPUT_FUNCS = ('_extend', 'echo', 'include', 'start_capture', 'stop_capture', 'not_cached', 'echo_cached')
+
+    def _fragment_script(self, outer, body):
+        global ast
+        if ast is None: import ast
+        def names_of(node, ctx):
+            return set([ x.id for x in ast.walk(node) if isinstance(x, ast.Name) and isinstance(x.ctx, ctx) ])
+        def is_output(node):
+            for x in ast.walk(node):
+                if isinstance(x, ast.Call):
+                    f = x.func
+                    if isinstance(f, ast.Name) and f.id in self._OUTPUT_FUNCS:
+                        return True
+                    if isinstance(f, ast.Attribute) and isinstance(f.value, ast.Name) and f.value.id == '_buf':
+                        return True
+            return False
+        stmts = ast.parse(outer).body
+        for index, node in enumerate(stmts):
+            if self.FRAGMENT_MARKER.split()[0] in names_of(node, ast.Store):
+                break
+        needed = names_of(ast.parse(body), ast.Load) - set(self._FRAGMENT_PROVIDED)
+        #: select statements which define names used in fragment (and in selected statements).
+        selected = []
+        for node in reversed(stmts[:index]):
+            if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                stored = set([node.name])
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                stored = set([ (a.asname or a.name).split('.')[0] for a in node.names ])
+            elif is_output(node):
+                continue
+            else:
+                stored = names_of(node, ast.Store)
+            if stored & needed:
+                selected.append(node)
+                needed |= names_of(node, ast.Load)
+        selected.reverse()
+        buf = [ ast.get_source_segment(outer, node) + "\n" for node in selected ]
+        buf.append(body)
+        return ''.join(buf)
+
+    def get_fragment(self, name):
+        """Return compiled code object of fragment."""
+        fragments = self.fragments
+        if fragments is None:
+            self.fragments = fragments = {}
+        code = fragments.get(name)
+        if code is None:
+            script = self.convert_fragment(name)
+            code = fragments[name] = compile(script, self.filename or '(tenjin)', 'exec')
+        return code
+
     s = r'(?:\{.*?\}.*?)*'
     EXPR_PATTERN = (r'#\{(.*?'+s+r')\}|\$\{(.*?'+s+r')\}|\{=(?:=(.*?)=|(.*?))=\}', re.S)
     del s
@@ -925,6 +1645,7 @@ class Template(object):
         block = self.parse_lines(buf)
         buf[:] = []
         self._join_block(block, buf, 0)
+        return block
 
 
     def render(self, context=None, globals=None, _buf=None):
@@ -938,7 +1659,31 @@ class Template(object):
              Global object. If None then globals() is used.
            _buf:list (=None)
              If None then new list is created.
+
+           If 'memoize' is True and '#@ARGS' is declared, output is memoized by
+           values of arguments and template is not evaluated while memoized
+           (therefore changes of context data such as '_layout' or captured
+           strings are not reproduced). Memoization is skipped if some of
+           argument values are not hashable (such as list or dict).
+           If template is static (= no statements nor expressions), output
+           string is returned (or appended into _buf) without evaluation.
         """
+        static = self.static
+        if static is not None and not self.trace:
+            if _buf is None:
+                return static
+            _buf.append(static)
+            return _buf
+        memokey = None
+        if self.memoize and self.args is not None:
+            memokey = self._memoize_key(context)
+            if memokey is not None:
+                output = self._memoize_store().get(memokey)
+                if output is not None:
+                    if _buf is None:
+                        return output
+                    _buf.append(output)
+                    return _buf
         if context is None:
             locals = context = {}
         elif self.args is None:
@@ -954,14 +1699,24 @@ class Template(object):
         if _buf is None:
             _buf = []
         locals['_buf'] = _buf
+        if self.macro_script or self._imported:
+            locals.update(self.get_macros(globals))
         if not self.bytecode:
             self.compile()
-        if self.trace:
-            _buf.append("<!-- ***** begin: %s ***** -->\n" % self.filename)
-            exec(self.bytecode, globals, locals)
-            _buf.append("<!-- ***** end: %s ***** -->\n" % self.filename)
-        else:
-            exec(self.bytecode, globals, locals)
+        start = len(_buf)
+        try:
+            if self.trace:
+                _buf.append("<!-- ***** begin: %s ***** -->\n" % self.filename)
+                exec(self.bytecode, globals, locals)
+                _buf.append("<!-- ***** end: %s ***** -->\n" % self.filename)
+            else:
+                exec(self.bytecode, globals, locals)
+        except Exception:
+            if self.line_map:
+                self._add_error_location(sys.exc_info())
+            raise
+        if memokey is not None:
+            self._memo.set(memokey, ''.join(_buf[start:]))
         if bufarg is not None:
             return bufarg
         elif not logger:
@@ -974,9 +1729,72 @@ class Template(object):
                 logger.error("[tenjin.Template] (_buf=%r)" % (_buf, ))
                 raise
 
+    def _relocate_syntax_error(self, ex):
+        #: replace filename and line number of syntax error in expanded template
+        #: with those of template file which contains the line.
+        if self.line_map and ex.lineno:
+            filename, linenum = self.source_location(ex.lineno)
+            if getattr(ex, 'end_lineno', None):
+                ex.end_lineno += linenum - ex.lineno
+            ex.filename, ex.lineno = filename, linenum
+
+    def _add_error_location(self, exc_info):
+        #: add filename and line number of template file to error raised in
+        #: expanded template, because python code of it is compiled with filename
+        #: of child template (python 3.11 or later).
+        _, ex, tb = exc_info
+        lineno = None
+        while tb is not None:
+            if tb.tb_frame.f_code.co_filename == self.bytecode.co_filename:
+                lineno = tb.tb_lineno
+            tb = tb.tb_next
+        if lineno and hasattr(ex, 'add_note'):
+            filename, linenum = self.source_location(lineno)
+            ex.add_note('  (File "%s", line %s in template)' % (filename, linenum))
+
+    def render_fragment(self, name, context=None, globals=None, _buf=None):
+        """Evaluate only fragment (named block or capture_as() region with fixed name)
+           of template, without executing the rest of template.
+           Statements which fragment depends on are executed only if they are
+           top-level statements (statements in for-loop or if-statement are not
+           executed, so pass variables such as loop variable by context data).
+           Context data is available as local variables even if '#@ARGS' is declared.
+           See render() for other arguments.
+        """
+        if context is None:
+            locals = context = {}
+        else:
+            locals = context.copy()
+        locals['_context'] = context
+        if globals is None:
+            globals = sys._getframe(1).f_globals
+        bufarg = _buf
+        if _buf is None:
+            _buf = []
+        locals['_buf'] = _buf
+        if self.macro_script or self._imported:
+            locals.update(self.get_macros(globals))
+        exec(self.get_fragment(name), globals, locals)
+        if bufarg is not None:
+            return bufarg
+        return ''.join(_buf)
+
     def compile(self):
-        """compile self.script into self.bytecode"""
-        self.bytecode = compile(self.script, self.filename or '(tenjin)', 'exec')
+        """compile self.script into self.bytecode.
+           If failed, SyntaxError is kept and raised again without compiling
+           until template is converted again.
+        """
+        error = self.compile_error
+        if error is not None:
+            self.compile_error_hits += 1
+            raise error.with_traceback(None)
+        try:
+            self.bytecode = compile(self.script, self.filename or '(tenjin)', 'exec')
+        except SyntaxError:
+            self.compile_error = sys.exc_info()[1]
+            self._relocate_syntax_error(self.compile_error)
+            if logger: logger.error("[tenjin.%s] compile error (filename=%r): %s" % (self.__class__.__name__, self.filename, self.compile_error))
+            raise
 
 
 ##
@@ -1214,6 +2032,46 @@ class JavaScriptPreprocessor(object):
 def _linenum(input, pos):
     return input[0:pos].count("\n") + 1
 
+_code_type = type(_linenum.__code__)
+
+def _code_size(code):
+    #: return approximate size of code object including nested code objects and constants.
+    size = sys.getsizeof(code) + sys.getsizeof(code.co_code)
+    for c in code.co_consts:
+        if type(c) is _code_type:
+            size += _code_size(c)
+        elif c is not None:
+            size += sys.getsizeof(c)
+    return size
+
+def _checksum(input):
+    #: return content hash of template.
+    global hashlib
+    if hashlib is None: import hashlib
+    return hashlib.sha1(input.encode('utf-8')).hexdigest()
+
+def _common_prefix_length(s1, s2):
+    #: binary search to compare strings in C, not per character.
+    lo, hi = 0, min(len(s1), len(s2))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if s1[lo:mid] == s2[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _common_suffix_length(s1, s2, maxlen):
+    lo, hi = 0, maxlen
+    n1, n2 = len(s1), len(s2)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if s1[n1-mid:n1-lo] == s2[n2-mid:n2-lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
 
 JS_FUNC = r"""
 function _S(x){return x==null?'':x;}
@@ -1229,44 +2087,235 @@ JS_FUNC = escaped.EscapedStr(JS_FUNC)
 ## cache storages
 ##
 
+def _template_cache_data(template):
+    #: return dict of template attributes to store into cache.
+    dct = { 'args'  : template.args,   'bytecode' : template.bytecode,
+            'script': template.script, 'timestamp': template.timestamp,
+            'signature': template.cache_signature() }
+    if template.depends:
+        dct['depends'] = template.depends
+    if template.macro_script:
+        dct['macro_script'] = template.macro_script
+    if template.imports:
+        dct['imports'] = template.imports
+    if template.references:
+        dct['references'] = template.references
+    if template.line_map:
+        dct['line_map'] = template.line_map
+    if template.static is not None:
+        dct['static'] = template.static
+    if template.checksums:
+        dct['checksums'] = template.checksums
+    if template.memoize:
+        dct.update(memoize=True, memoize_size=template.memoize_size, memoize_ttl=template.memoize_ttl)
+    return dct
+
+
 class CacheStorage(object):
-    """[abstract] Template object cache class (in memory and/or file)"""
+    """[abstract] Template object cache class (in memory and/or file)
+
+       If 'max_items' or 'max_bytes' is specified, least recently used template
+       objects are removed from memory (not from cache file) when number of
+       them or approximate size of their script, bytecode and input exceeds it.
+       Removed template objects are loaded from cache file again when required.
+
+       If 'write_behind' is True, template attributes are saved into cache file
+       by background thread instead of thread which calls set(). Template
+       attributes set at the same time are saved in a batch, and only the last
+       one is saved if the same template is set again before saved. Pending
+       template attributes are saved by flush(), which is called at exit.
+    """
 
-    def __init__(self):
-        self.items = {}    # key: full path, value: template object
+    max_items = None   # max number of template objects in memory (None means unlimited)
+    max_bytes = None   # max size of script, bytecode and input in memory (None means unlimited)
+    write_behind = False       # if True then template attributes are saved by background thread
+    write_behind_delay = 0.05  # seconds to wait for other template attributes to save in a batch
+
+    def __init__(self, max_items=None, max_bytes=None, write_behind=None):
+        if max_items is not None: self.max_items = max_items
+        if max_bytes is not None: self.max_bytes = max_bytes
+        if write_behind is not None: self.write_behind = write_behind
+        self.items = OrderedDict()   # key: full path, value: template object
+        self._sizes = {}   # key: full path, value: size of template object
+        self.bytes = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._pending = {}     # key: full path, value: template attributes to save
+        self._writing = False  # True while template attributes are being saved
+        self._writer = None    # background thread to save template attributes
+        self._cond = None
+        if self.write_behind:
+            global threading
+            if threading is None: import threading
+            self._cond = threading.Condition()
 
     def get(self, cachepath, create_template):
         """get template object. if not found, load attributes from cache file and restore  template object."""
         template = self.items.get(cachepath)
         if not template:
-            dct = self._load(cachepath)
+            #: template attributes which are not saved yet are used if exist.
+            dct = self._pending.get(cachepath)
+            dct = dct and dict(dct) or self._load(cachepath)
             if dct:
-                template = create_template()
-                for k in dct:
-                    setattr(template, k, dct[k])
-                self.items[cachepath] = template
+                template = self._restore_template(cachepath, dct, create_template)
+                if template:
+                    self._add(cachepath, template)
+        elif self.max_items or self.max_bytes:
+            try:
+                self.items.move_to_end(cachepath)
+            except KeyError:   # removed by other thread
+                pass
+        return template
+
+    def _restore_template(self, cachepath, dct, create_template):
+        #: create template object from attributes loaded from cache file.
+        template = create_template()
+        #: return None if attributes are created by other version of python or
+        #: tenjin, or with other options (they will be converted again).
+        if dct.pop('signature', None) != template.cache_signature():
+            if logger: logger.info("[tenjin.%s] ignore cache of other version or options (cachepath=%r)" % (self.__class__.__name__, cachepath))
+            return None
+        for k in dct:
+            setattr(template, k, dct[k])
         return template
 
     def set(self, cachepath, template):
         """set template object and save template attributes into cache file."""
-        self.items[cachepath] = template
+        self._add(cachepath, template)
         dct = self._save_data_of(template)
+        if self.write_behind:
+            return self._enqueue(cachepath, dct)
         return self._store(cachepath, dct)
 
+    def _enqueue(self, cachepath, dct):
+        global atexit
+        with self._cond:
+            #: older attributes of the same template are not saved.
+            self._pending[cachepath] = dct
+            #: start background thread (again if process is forked).
+            if self._writer is None or not self._writer.is_alive():
+                if self._writer is None:
+                    if atexit is None: import atexit
+                    atexit.register(self.flush)
+                self._writer = threading.Thread(target=self._write_behind_loop)
+                self._writer.daemon = True
+                self._writer.start()
+            self._cond.notify_all()
+
+    def _write_behind_loop(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._pending:
+                    cond.wait()
+            #: wait for other template attributes in order to save them in a batch.
+            time.sleep(self.write_behind_delay)
+            self._write_pending()
+
+    def _write_pending(self):
+        #: save pending template attributes (only a thread saves them at a time).
+        cond = self._cond
+        with cond:
+            while self._writing:
+                cond.wait()
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            self._writing = True
+        try:
+            try:
+                self._store_all(list(pending.items()))
+            except Exception:
+                ex = sys.exc_info()[1]
+                if logger: logger.error("[tenjin.%s] failed to store cache: %s" % (self.__class__.__name__, ex))
+        finally:
+            with cond:
+                self._writing = False
+                cond.notify_all()
+        return len(pending)
+
+    def _store_all(self, pairs):
+        #: save list of cachepath and template attributes.
+        for cachepath, dct in pairs:
+            self._store(cachepath, dct)
+
+    def flush(self):
+        """Save pending template attributes into cache file (see 'write_behind')
+           and return number of them.
+        """
+        if self._cond is None:
+            return 0
+        return self._write_pending()
+
+    def _add(self, cachepath, template):
+        items = self.items
+        items[cachepath] = template
+        if not (self.max_items or self.max_bytes):
+            return
+        size = self._size_of(template)
+        self.bytes += size - self._sizes.get(cachepath, 0)
+        self._sizes[cachepath] = size
+        try:
+            items.move_to_end(cachepath)
+            #: remove least recently used template objects from memory.
+            while len(items) > 1 and (self.max_items and len(items) > self.max_items or
+                                      self.max_bytes and self.bytes > self.max_bytes):
+                key, _ = items.popitem(last=False)
+                size = self._sizes.pop(key, 0)
+                self.bytes -= size
+                self.evictions += 1
+                self.evicted_bytes += size
+                if logger: logger.info("[tenjin.%s] evict template object (cachepath=%r)" % (self.__class__.__name__, key))
+        except KeyError:   # removed by other thread
+            pass
+
+    def _size_of(self, template):
+        #: return approximate size of script, bytecode and input of template object.
+        size = len(template.script or '') + len(template.input or '')
+        if template.bytecode:
+            size += len(marshal.dumps(template.bytecode))
+        return size
+
+    def stats(self):
+        """Return dict of number and size of template objects in memory, and eviction counters."""
+        return {'items': len(self.items), 'bytes': self.bytes,
+                'max_items': self.max_items, 'max_bytes': self.max_bytes,
+                'evictions': self.evictions, 'evicted_bytes': self.evicted_bytes}
+
     def _save_data_of(self, template):
-        return { 'args'  : template.args,   'bytecode' : template.bytecode,
-                 'script': template.script, 'timestamp': template.timestamp }
+        return _template_cache_data(template)
 
     def unset(self, cachepath):
         """remove template object from dict and cache file."""
         self.items.pop(cachepath, None)
-        return self._delete(cachepath)
+        self.bytes -= self._sizes.pop(cachepath, 0)
+        cond = self._cond
+        if cond is None:
+            return self._delete(cachepath)
+        with cond:
+            #: wait for background thread saving attributes, otherwise cache
+            #: file would be saved again after deleted.
+            while self._writing:
+                cond.wait()
+            self._pending.pop(cachepath, None)
+            return self._delete(cachepath)
 
     def clear(self):
         """remove all template objects and attributes from dict and cache file."""
-        d, self.items = self.items, {}
-        for k in d.keys():
-            self._delete(k)
+        d, self.items = self.items, OrderedDict()
+        self._sizes = {}
+        self.bytes = 0
+        cond = self._cond
+        if cond is None:
+            for k in d.keys():
+                self._delete(k)
+        else:
+            with cond:
+                while self._writing:
+                    cond.wait()
+                self._pending.clear()
+                for k in d.keys():
+                    self._delete(k)
         d.clear()
 
     def _load(self, cachepath):
@@ -1295,17 +2344,53 @@ class MemoryCacheStorage(CacheStorage):
 
 
 class FileCacheStorage(CacheStorage):
+    """[abstract] Store template attributes into cache file.
+
+       Cache file is created next to template file by default. If 'cache_dir'
+       is specified, cache files are created under it instead, named by hash
+       of full path of template file (and lang) and sharded into
+       subdirectories.
+
+       ex.
+         storage = tenjin.MarshalCacheStorage(cache_dir='/dev/shm/myapp')
+         ## '/app/views/page.pyhtml' is cached as
+         ## '/dev/shm/myapp/3f/3f7a...c2-page.pyhtml.cache'
+    """
+
+    cache_dir = None
+
+    def __init__(self, cache_dir=None, max_items=None, max_bytes=None, write_behind=None):
+        CacheStorage.__init__(self, max_items, max_bytes, write_behind)
+        if cache_dir is not None: self.cache_dir = cache_dir
+
+    def cachefile(self, cachepath):
+        """Return filename of cache file."""
+        cache_dir = self.cache_dir
+        if not cache_dir:
+            return cachepath
+        global hashlib
+        if hashlib is None: import hashlib
+        #: shard cache files by first 2 chars of hash to avoid huge flat directory.
+        digest = hashlib.sha1(cachepath.encode('utf-8')).hexdigest()
+        basename = os.path.basename(cachepath)
+        return os.path.join(cache_dir, digest[:2], '%s-%s' % (digest, basename))
 
     def _load(self, cachepath):
-        if not _isfile(cachepath): return None
-        if logger: logger.info("[tenjin.%s] load cache (file=%r)" % (self.__class__.__name__, cachepath))
-        data = _read_binary_file(cachepath)
+        cachefile = self.cachefile(cachepath)
+        if not _isfile(cachefile): return None
+        if logger: logger.info("[tenjin.%s] load cache (file=%r)" % (self.__class__.__name__, cachefile))
+        data = _read_binary_file(cachefile)
         return self._restore(data)
 
     def _store(self, cachepath, dct):
-        if logger: logger.info("[tenjin.%s] store cache (file=%r)" % (self.__class__.__name__, cachepath))
+        cachefile = self.cachefile(cachepath)
+        if logger: logger.info("[tenjin.%s] store cache (file=%r)" % (self.__class__.__name__, cachefile))
         data = self._dump(dct)
-        _write_binary_file(cachepath, data)
+        if self.cache_dir:
+            dirname = os.path.dirname(cachefile)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, exist_ok=True)
+        _write_binary_file(cachefile, data)
 
     def _restore(self, data):
         raise NotImplementedError("%s._restore(): not implemented yet." % self.__class__.__name__)
@@ -1314,18 +2399,38 @@ class FileCacheStorage(CacheStorage):
         raise NotImplementedError("%s._dump(): not implemented yet." % self.__class__.__name__)
 
     def _delete(self, cachepath):
-        _ignore_not_found_error(lambda: os.unlink(cachepath))
+        cachefile = self.cachefile(cachepath)
+        _ignore_not_found_error(lambda: os.unlink(cachefile))
 
 
 class MarshalCacheStorage(FileCacheStorage):
 
     def _restore(self, data):
-        return marshal.loads(data)
+        #: return None if data is dumped by other version of python.
+        try:
+            return marshal.loads(data)
+        except (ValueError, EOFError, TypeError):
+            return None
 
     def _dump(self, dct):
         return marshal.dumps(dct)
 
 
+class LeanMarshalCacheStorage(MarshalCacheStorage):
+    """Same as MarshalCacheStorage, but python script is not stored into
+       cache file when template is compiled successfully. Cache file is
+       smaller and loaded faster, but 'script' of template object loaded
+       from it is None (use Engine.get_script() to get python script).
+    """
+
+    def _save_data_of(self, template):
+        dct = MarshalCacheStorage._save_data_of(self, template)
+        #: keep python script if template has syntax error.
+        if dct['bytecode'] is not None:
+            dct.pop('script')
+        return dct
+
+
 class PickleCacheStorage(FileCacheStorage):
 
     def __init__(self, *args, **kwargs):
@@ -1348,22 +2453,35 @@ class TextCacheStorage(FileCacheStorage):
         header, script = data.split("\n\n".encode('ascii'), 1)
         header = header.decode('ascii')
         timestamp = encoding = args = None
+        extra = {}
         for line in header.split("\n"):
             key, val = line.split(": ", 1)
             if   key == 'timestamp':  timestamp = float(val)
+            elif key == 'signature':  extra[key] = val
             elif key == 'encoding':   encoding  = val
             elif key == 'args':       args      = val.split(', ')
+            else:                     extra[key] = self._json().loads(val)
         script = script.decode(encoding or 'utf-8')     ## binary to unicode(=str)
-        return {'args': args, 'script': script, 'timestamp': timestamp}
+        dct = {'args': args, 'script': script, 'timestamp': timestamp}
+        dct.update(extra)
+        return dct
+
+    _header_keys = ('timestamp', 'signature', 'encoding', 'args', 'script', 'bytecode')
 
     def _dump(self, dct):
         s = dct['script']
         sb = []
         sb.append("timestamp: %s\n" % dct['timestamp'])
+        if dct.get('signature'):
+            sb.append("signature: %s\n" % dct['signature'])
         if dct.get('encoding'):
             sb.append("encoding: %s\n" % dct['encoding'])
         if dct.get('args') is not None:
             sb.append("args: %s\n" % ', '.join(dct['args']))
+        #: other attributes are stored as JSON string (in ascii).
+        for key in dct:
+            if key not in self._header_keys and dct[key] is not None:
+                sb.append("%s: %s\n" % (key, self._json().dumps(dct[key])))
         sb.append("\n")
         sb.append(s)
         s = ''.join(sb)
@@ -1377,6 +2495,457 @@ class TextCacheStorage(FileCacheStorage):
         dct['encoding'] = template.encoding
         return dct
 
+    def _json(self):
+        global json
+        if json is None:
+            import json
+        return json
+
+
+class SqliteCacheStorage(CacheStorage):
+    """Store template attributes (marshaled) into a SQLite database file
+       instead of '*.cache' files. WAL mode is enabled so that worker processes
+       can read and write the database concurrently.
+
+       ex.
+         storage = tenjin.SqliteCacheStorage('/var/cache/myapp/templates.sqlite3')
+         engine = tenjin.Engine(cache=storage)
+         storage.preload(engine)    # load all template objects into memory
+    """
+
+    table = 'tenjin_cache'
+    timeout = 5.0   # seconds to wait for lock of database
+
+    def __init__(self, dbpath, readonly=False, max_items=None, max_bytes=None, write_behind=None):
+        """Initializer of SqliteCacheStorage class.
+
+           dbpath:str
+             Filename of SQLite database. It is created if not exist.
+           readonly:bool (=False)
+             If True, database is opened in read-only mode and template
+             attributes are not stored into it.
+           max_items, max_bytes:int (=None), write_behind:bool (=None)
+             See CacheStorage.
+        """
+        global sqlite3, threading
+        if sqlite3 is None: import sqlite3
+        if threading is None: import threading
+        CacheStorage.__init__(self, max_items, max_bytes, write_behind)
+        self.dbpath = dbpath
+        self.readonly = readonly
+        self._local = threading.local()
+
+    def _connect(self):
+        #: create connection for each thread and each process.
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None and local.pid == os.getpid():
+            return conn
+        if self.readonly:
+            global quote
+            if quote is None: from urllib.parse import quote
+            conn = sqlite3.connect('file:%s?mode=ro' % quote(self.dbpath), timeout=self.timeout, uri=True)
+        else:
+            conn = sqlite3.connect(self.dbpath, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS %s (cachepath TEXT PRIMARY KEY,"
+                         " timestamp REAL, data BLOB)" % self.table)
+            conn.commit()
+        local.conn, local.pid = conn, os.getpid()
+        return conn
+
+    def _execute(self, sql, params=()):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params)
+        finally:
+            if not self.readonly:
+                conn.commit()
+
+    def _load(self, cachepath):
+        try:
+            row = self._execute("SELECT data FROM %s WHERE cachepath = ?" % self.table,
+                                (cachepath, )).fetchone()
+        except sqlite3.Error:
+            ex = sys.exc_info()[1]
+            if logger: logger.error("[tenjin.%s] failed to load cache (cachepath=%r): %s" % (self.__class__.__name__, cachepath, ex))
+            return None
+        return row and self._restore(row[0], cachepath) or None
+
+    def _restore(self, data, cachepath):
+        #: return None if data is broken or dumped by other version of python.
+        try:
+            return marshal.loads(data)
+        except (ValueError, EOFError, TypeError):
+            if logger: logger.info("[tenjin.%s] ignore broken cache (cachepath=%r)" % (self.__class__.__name__, cachepath))
+            return None
+
+    def _store(self, cachepath, dct):
+        if self.readonly:
+            return
+        if logger: logger.info("[tenjin.%s] store cache (cachepath=%r)" % (self.__class__.__name__, cachepath))
+        try:
+            self._execute("INSERT OR REPLACE INTO %s (cachepath, timestamp, data) VALUES (?, ?, ?)" % self.table,
+                          (cachepath, dct.get('timestamp') or None, marshal.dumps(dct)))
+        except sqlite3.Error:
+            ex = sys.exc_info()[1]
+            #: template object is kept in memory even if failed to store it.
+            if logger: logger.error("[tenjin.%s] failed to store cache (cachepath=%r): %s" % (self.__class__.__name__, cachepath, ex))
+
+    def _store_all(self, pairs):
+        #: store template attributes saved by background thread in a transaction.
+        if self.readonly:
+            return
+        if logger: logger.info("[tenjin.%s] store %d caches" % (self.__class__.__name__, len(pairs)))
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO %s (cachepath, timestamp, data) VALUES (?, ?, ?)" % self.table,
+                                 [ (cachepath, dct.get('timestamp') or None, marshal.dumps(dct)) for cachepath, dct in pairs ])
+        except sqlite3.Error:
+            ex = sys.exc_info()[1]
+            if logger: logger.error("[tenjin.%s] failed to store caches: %s" % (self.__class__.__name__, ex))
+
+    def _delete(self, cachepath):
+        if self.readonly:
+            return
+        try:
+            self._execute("DELETE FROM %s WHERE cachepath = ?" % self.table, (cachepath, ))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        """remove all template objects from memory and database."""
+        CacheStorage.clear(self)
+        if not self.readonly:
+            self._execute("DELETE FROM %s" % self.table)
+
+    def preload(self, engine):
+        """Load all template objects stored in database into memory at once,
+           and return number of them. This is intended to be called at startup
+           of process in order to avoid a query per template.
+
+           engine:Engine
+             Engine object which creates template objects (with its templateclass
+             and options).
+        """
+        create_template = engine._new_template
+        rows = self._execute("SELECT cachepath, data FROM %s" % self.table).fetchall()
+        n = 0
+        for cachepath, data in rows:
+            dct = self._restore(data, cachepath)
+            template = dct and self._restore_template(cachepath, dct, create_template)
+            if not template:
+                continue
+            self._add(cachepath, template)
+            n += 1
+        if logger: logger.info("[tenjin.%s] preloaded %d templates (dbpath=%r)" % (self.__class__.__name__, n, self.dbpath))
+        return n
+
+    def close(self):
+        """close database connection of current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+
+class BundleCacheStorage(CacheStorage):
+    """Load template attributes from a bundle file which contains precompiled
+       templates (marshaled) and an index of them. Bundle file is opened only
+       once and memory-mapped, and each template is unmarshaled when it is
+       required at first time.
+
+       Bundle file is read-only. Template objects which are converted again
+       because template file is changed are kept only in memory.
+
+       Templates are indexed by filename relative to path entry of engine
+       (ex. 'user/list.pyhtml.cache'), and looked up by cache path without
+       directory in 'path', so bundle file can be built on other directory.
+       If 'path' is not specified, path of engine which uses bundle file is
+       used.
+
+       ex.
+         ## build step (or 'pytenjin -a bundle --bundle=views.bundle views/*.pyhtml')
+         engine = tenjin.Engine(path=['views'])
+         tenjin.BundleCacheStorage('views.bundle').build(engine, names)
+         ## application
+         engine = tenjin.Engine(path=['views'], cache=tenjin.BundleCacheStorage('views.bundle'))
+    """
+
+    magic = b'TENJIN-BUNDLE-1\n'
+
+    def __init__(self, bundlepath, path=None, max_items=None, max_bytes=None):
+        """Initializer of BundleCacheStorage class.
+
+           bundlepath:str
+             Filename of bundle file. It is opened when a template is
+             requested at first time.
+           path:list of str (=None)
+             Directories which contain template files (same as 'path' of
+             engine). If None, it is set by engine (see Engine.__init__()).
+           max_items, max_bytes:int (=None)
+             See CacheStorage.
+        """
+        global mmap, threading
+        if mmap is None: import mmap
+        if threading is None: import threading
+        CacheStorage.__init__(self, max_items, max_bytes)
+        self.bundlepath = bundlepath
+        self.path = path
+        self._map = None
+        self._index = None   # key: relative cache path, value: (offset, length)
+        self._lock = threading.Lock()
+
+    def _open(self):
+        #: if bundle file is not found then no templates are loaded from it.
+        try:
+            f = open(self.bundlepath, 'rb')
+        except IOError:
+            if logger: logger.info("[tenjin.%s] bundle file not found (file=%r)" % (self.__class__.__name__, self.bundlepath))
+            self._index = {}
+            return self._index
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        #: file layout: magic, size of index (16 hex digits), index, and data.
+        pos = len(self.magic)
+        if m[:pos] != self.magic:
+            m.close()
+            raise ValueError("%s: not a bundle file." % self.bundlepath)
+        size = int(m[pos:pos+16], 16)
+        pos += 16
+        index = marshal.loads(m[pos:pos+size])
+        self._map, self._start = m, pos + size
+        self._index = index
+        if logger: logger.info("[tenjin.%s] open bundle (file=%r, templates=%d)" % (self.__class__.__name__, self.bundlepath, len(index)))
+        return index
+
+    def _load(self, cachepath):
+        index = self._index
+        if index is None:
+            #: open bundle file only once even if requested by threads at the same time.
+            with self._lock:
+                index = self._index
+                if index is None:
+                    index = self._open()
+        pair = self._lookup(index, cachepath)
+        if not pair:
+            return None
+        offset, length = pair
+        start = self._start + offset
+        return marshal.loads(self._map[start:start+length])
+
+    def _lookup(self, index, cachepath):
+        #: strip directory in path from cache path and find entry by relative path.
+        #: (don't match only by basename, because other directory may have the same filename.)
+        for dirname in self.path or ['.']:
+            prefix = os.path.join(os.path.abspath(dirname), '')
+            if cachepath.startswith(prefix):
+                pair = index.get(cachepath[len(prefix):].replace(os.sep, '/'))
+                if pair:
+                    return pair
+        return None
+
+    def _store(self, cachepath, dct):
+        pass
+
+    def _delete(self, cachepath):
+        pass
+
+    def build(self, engine, template_names):
+        """Convert and compile templates with engine, write them into bundle
+           file, and return number of templates in it. Bundle file is replaced
+           atomically.
+
+           engine:Engine
+             Template engine which has the same path, prefix, postfix and lang
+             as engine which uses bundle file.
+           template_names:list
+             Template names (or filenames) to precompile.
+        """
+        #: convert templates by copy of engine which keeps them only in memory,
+        #: in order not to write '*.cache' files.
+        builder = engine.__class__.__new__(engine.__class__)
+        builder.__dict__.update(engine.__dict__)
+        builder._filepaths, builder._flights, builder._frozen = {}, {}, None
+        builder.cache = MemoryCacheStorage()
+        entries = []
+        for template_name in template_names:
+            template = builder.get_template(template_name)
+            #: raise SyntaxError if template has syntax error.
+            if not template.bytecode:
+                template.compile()
+            #: index template by filename relative to path entry, not by absolute path.
+            filename = os.path.normpath(builder.to_filename(template_name))
+            key = builder.cachename(filename).replace(os.sep, '/')
+            entries.append((key, marshal.dumps(self._save_data_of(template))))
+        index = {}
+        offset = 0
+        for cachepath, data in entries:
+            index[cachepath] = (offset, len(data))
+            offset += len(data)
+        header = marshal.dumps(index)
+        chunks = [self.magic, ('%016x' % len(header)).encode('ascii'), header]
+        chunks.extend(data for _, data in entries)
+        with self._lock:
+            self._close()
+        _write_binary_file(self.bundlepath, b''.join(chunks))
+        if logger: logger.info("[tenjin.%s] build bundle (file=%r, templates=%d)" % (self.__class__.__name__, self.bundlepath, len(index)))
+        return len(index)
+
+    def close(self):
+        """unmap bundle file. it is opened again when required."""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        m, self._map, self._index = self._map, None, None
+        if m is not None:
+            m.close()
+
+
+def _template_module_code(dct, filename):
+    #: return code object of module which has template attributes as
+    #: '__tenjin__' (dict) and compiled python code as '__bytecode__'.
+    attrs = dict( (k, v) for k, v in dct.items() if k != 'bytecode' )
+    code = compile("__tenjin__ = %r\n__bytecode__ = '__bytecode__'\n" % (attrs, ), filename, 'exec')
+    bytecode = dct.get('bytecode')
+    consts = tuple( bytecode if c == '__bytecode__' else c for c in code.co_consts )
+    return code.replace(co_consts=consts)
+
+def _template_module_attrs(namespace):
+    #: return template attributes from namespace of module.
+    dct = dict(namespace['__tenjin__'])
+    dct['bytecode'] = namespace['__bytecode__']
+    return dct
+
+def _uint32(n):
+    return (n & 0xFFFFFFFF).to_bytes(4, 'little')
+
+
+class _PycCacheLoader(object):
+    #: validate '*.pyc' file of cachepath against template file
+    #: in the same way as python module.
+    #: (methods of SourceFileLoader are replaced so that importlib is imported lazily.)
+
+    def __init__(self, cachepath, filepath):
+        self.path = cachepath
+        self.filepath = filepath
+        self._loader = loader = importlib.machinery.SourceFileLoader(cachepath, cachepath)
+        loader.path_stats, loader.get_data = self.path_stats, self.get_data
+        loader.source_to_code = self.source_to_code
+
+    def get_code(self, fullname):
+        return self._loader.get_code(fullname)
+
+    def path_stats(self, path):
+        if path == self.path:
+            path = self.filepath
+        return importlib.machinery.SourceFileLoader.path_stats(self._loader, path)
+
+    def get_data(self, path):
+        if path == self.path:
+            path = self.filepath
+        return importlib.machinery.SourceFileLoader.get_data(self._loader, path)
+
+    def source_to_code(self, data, path, _optimize=-1):
+        #: '*.pyc' file is not found or expired.
+        raise _PycCacheMiss(path)
+
+
+class _PycCacheMiss(Exception):
+    pass
+
+
+class PycCacheStorage(CacheStorage):
+    """Store template attributes into '__pycache__/*.pyc' files instead of
+       '*.cache' files. Cache files are named, stamped and validated by
+       importlib in the same way as python modules (interpreter tag, magic
+       number, and timestamp- or hash-based invalidation mode).
+
+       ex.
+         engine = tenjin.Engine(cache=tenjin.PycCacheStorage())
+         ## 'views/page.pyhtml' is cached as 'views/__pycache__/page.pyhtml.cpython-312.pyc'
+    """
+
+    def __init__(self, invalidation_mode=None, max_items=None, max_bytes=None, write_behind=None):
+        """Initializer of PycCacheStorage class.
+
+           invalidation_mode:py_compile.PycInvalidationMode (=None)
+             TIMESTAMP, CHECKED_HASH or UNCHECKED_HASH. Default is TIMESTAMP,
+             or CHECKED_HASH if $SOURCE_DATE_EPOCH is set (same as py_compile).
+           max_items, max_bytes:int (=None), write_behind:bool (=None)
+             See CacheStorage.
+        """
+        global py_compile, importlib
+        if py_compile is None: import py_compile
+        if importlib is None: import importlib.machinery, importlib.util
+        CacheStorage.__init__(self, max_items, max_bytes, write_behind)
+        if invalidation_mode is None:
+            if os.environ.get('SOURCE_DATE_EPOCH'):
+                invalidation_mode = py_compile.PycInvalidationMode.CHECKED_HASH
+            else:
+                invalidation_mode = py_compile.PycInvalidationMode.TIMESTAMP
+        self.invalidation_mode = invalidation_mode
+
+    def pycpath(self, cachepath):
+        """return filename of '*.pyc' file ('/views/__pycache__/page.pyhtml.cpython-312.pyc')."""
+        return importlib.util.cache_from_source(cachepath)
+
+    def _filepath(self, cachepath):
+        #: return template filename ('page.pyhtml' of 'page.pyhtml.cache' or 'page.pyhtml.en.cache').
+        filepath = cachepath[:-len('.cache')]
+        if not _isfile(filepath):
+            filepath = os.path.splitext(filepath)[0]
+        return filepath
+
+    def _load(self, cachepath):
+        loader = _PycCacheLoader(cachepath, self._filepath(cachepath))
+        try:
+            code = loader.get_code(cachepath)
+        except (_PycCacheMiss, OSError, ImportError):
+            return None
+        if logger: logger.info("[tenjin.%s] load cache (file=%r)" % (self.__class__.__name__, self.pycpath(cachepath)))
+        namespace = {}
+        exec(code, namespace)
+        return _template_module_attrs(namespace)
+
+    def _store(self, cachepath, dct):
+        #: don't write '*.pyc' file if 'python -B' or $PYTHONDONTWRITEBYTECODE.
+        if sys.dont_write_bytecode:
+            return
+        filepath = self._filepath(cachepath)
+        pycpath = self.pycpath(cachepath)
+        if logger: logger.info("[tenjin.%s] store cache (file=%r)" % (self.__class__.__name__, pycpath))
+        code = _template_module_code(dct, filepath)
+        try:
+            #: header of '*.pyc' file is described in PEP 552.
+            mode = self.invalidation_mode
+            if mode == py_compile.PycInvalidationMode.TIMESTAMP:
+                st = os.stat(filepath)
+                mtime = int(dct.get('timestamp') or st.st_mtime)
+                header = (importlib.util.MAGIC_NUMBER + _uint32(0) +
+                          _uint32(mtime) + _uint32(st.st_size))
+            else:
+                flags = 0b01 | (mode == py_compile.PycInvalidationMode.CHECKED_HASH and 0b10 or 0)
+                header = (importlib.util.MAGIC_NUMBER + _uint32(flags) +
+                          importlib.util.source_hash(_read_binary_file(filepath)))
+            dirname = os.path.dirname(pycpath)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, exist_ok=True)
+            _write_binary_file(pycpath, header + marshal.dumps(code))
+        except OSError:
+            ex = sys.exc_info()[1]
+            #: template object is kept in memory even if failed to store it (ex. read-only directory).
+            if logger: logger.error("[tenjin.%s] failed to store cache (file=%r): %s" % (self.__class__.__name__, pycpath, ex))
+
+    def _delete(self, cachepath):
+        pycpath = self.pycpath(cachepath)
+        _ignore_not_found_error(lambda: os.unlink(pycpath))
+
 
 
 ##
@@ -1654,6 +3223,321 @@ class FileSystemLoader(Loader):
         return _ignore_not_found_error(f)
 
 
+
+##
+## import hook to import template file as module
+##
+class TemplateFileLoader(object):
+    """Loader to import template file as module. Template file is converted
+       and compiled, and the result is cached into '__pycache__/*.pyc' by
+       importlib in the same way as python module.
+       Imported module has 'template' (template object) and 'render()'.
+    """
+
+    def __init__(self, fullname, path, create_template=None):
+        global importlib
+        if importlib is None: import importlib.machinery, importlib.util
+        self.name = fullname
+        self.path = path
+        self.create_template = create_template or Template
+        #: SourceFileLoader reads and writes '*.pyc' file, and calls source_to_code() of self.
+        self._loader = importlib.machinery.SourceFileLoader(fullname, path)
+        self._loader.source_to_code = self.source_to_code
+
+    def __getattr__(self, name):
+        #: delegate get_code(), get_source(), get_filename() and so on to SourceFileLoader.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._loader, name)
+
+    def source_to_code(self, data, path, _optimize=-1):
+        template = self.create_template()
+        template.convert(data.decode(template.encoding or 'utf-8'), path)
+        #: raise SyntaxError in the same way as python module.
+        template.compile()
+        template.timestamp = self._loader.path_stats(path)['mtime']
+        return _template_module_code(_template_cache_data(template), path)
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        self._loader.exec_module(module)
+        template = self.create_template()
+        for k, v in _template_module_attrs(module.__dict__).items():
+            setattr(template, k, v)
+        template.filename = self.path
+        module.template = template
+        module.render = template.render
+
+
+class TemplateFinder(object):
+    """Meta path finder to import template files in path as modules.
+
+       ex.
+         finder = tenjin.TemplateFinder(['views'], escapefunc='escape').install()
+         import page                    # views/page.pyhtml
+         print(page.render({'title': 'Hello'}))
+    """
+
+    postfix = '.pyhtml'
+
+    def __init__(self, path, postfix=None, templateclass=None, **kwargs):
+        """Initializer of TemplateFinder class.
+
+           path:list
+             Directories to find template files.
+           postfix:str (='.pyhtml')
+             Suffix of template files.
+           templateclass:class (=Template)
+             Template class. kwargs are passed to it.
+        """
+        global importlib
+        if importlib is None: import importlib.machinery, importlib.util
+        self.path = path
+        if postfix is not None: self.postfix = postfix
+        self.templateclass = templateclass or Template
+        self.kwargs = kwargs
+
+    def create_template(self):
+        return self.templateclass(None, **self.kwargs)
+
+    def find_spec(self, fullname, path=None, target=None):
+        relpath = fullname.replace('.', os.sep) + self.postfix
+        for dirname in self.path:
+            filepath = os.path.join(dirname, relpath)
+            if _isfile(filepath):
+                loader = TemplateFileLoader(fullname, filepath, self.create_template)
+                return importlib.util.spec_from_file_location(fullname, filepath, loader=loader)
+        return None
+
+    def install(self):
+        """append finder to sys.meta_path and return self."""
+        if self not in sys.meta_path:
+            sys.meta_path.append(self)
+        return self
+
+    def uninstall(self):
+        """remove finder from sys.meta_path."""
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+
+##
+## watcher to detect changes of template files
+##
+
+class TemplateWatcher(object):
+    """Watch directories of template files in background thread and call
+       callback with full path of changed (created, or removed) file.
+       inotify is used on Linux, and directories are polled by os.scandir()
+       on other platforms (or if backend is 'poll'). Callback is called with
+       None if changes may be lost (event queue overflow or fork, for example).
+
+       ex.
+         watcher = tenjin.TemplateWatcher(['views'], lambda path: print(path))
+         watcher.start()
+         ...
+         watcher.stop()
+    """
+
+    interval = 1.0   # seconds to poll directories ('poll' backend only)
+    ignore = re.compile(r'(\.cache|~|\.sw[px])$|[\\/]__pycache__([\\/]|$)')   # files not notified
+
+    ## inotify(7)
+    IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x4, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_Q_OVERFLOW, IN_IGNORED = 0x100, 0x200, 0x4000, 0x8000
+    IN_ISDIR, IN_CLOEXEC = 0x40000000, 0x80000
+    IN_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, dirs, callback, backend=None, interval=None):
+        """Initializer of TemplateWatcher class.
+
+           dirs:list of str
+             Directories to watch (including subdirectories).
+           callback:callable
+             Function which is called with full path of changed file.
+           backend:str (=None)
+             'inotify' or 'poll'. If None, 'inotify' is used on Linux.
+           interval:float (=None)
+             Seconds to poll directories. See TemplateWatcher.interval.
+        """
+        global weakref
+        if weakref is None: import weakref
+        self.dirs = [ os.path.abspath(d) for d in dirs ]
+        self.callback = callback
+        if backend is None:
+            backend = sys.platform.startswith('linux') and 'inotify' or 'poll'
+        self.backend = backend
+        if interval is not None: self.interval = interval
+        self._thread = None
+        self._forked = False
+        #: restart watcher in child process because thread is not inherited.
+        ref = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: ref() and ref()._after_fork())
+
+    def start(self):
+        """Start to watch directories in background thread and return self."""
+        global threading
+        if threading is None: import threading
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        target = None
+        if self.backend == 'inotify':
+            try:
+                self._setup_inotify()
+                target = self._run_inotify
+            except (OSError, AttributeError):
+                ex = sys.exc_info()[1]
+                if logger: logger.info("[tenjin.%s] inotify is not available (%s), poll directories instead." % (self.__class__.__name__, ex))
+                self.backend = 'poll'
+        if target is None:
+            self._snapshot = self._scan()
+            target = self._run_poll
+        self._thread = threading.Thread(target=target)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching directories."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._stopped.set()
+        if self.backend == 'inotify':
+            os.write(self._wakeup[1], b'x')
+        #: (stop() may be called by callback in watcher thread)
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def is_alive(self):
+        """Return True if watcher is running in current process.
+           Watcher is restarted if process is forked after started.
+        """
+        if self._forked:
+            self._restart()
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def _after_fork(self):
+        #: thread can't be started here, so restart watcher when is_alive() is called.
+        if self._thread is not None:
+            self._forked = True
+
+    def _restart(self):
+        with self._lock:
+            if not self._forked:
+                return
+            self._thread = None
+            if self.backend == 'inotify':
+                self._close_inotify()
+            self.start()
+            self._forked = False
+        #: changes may be lost while restarting.
+        self._notify(None)
+
+    def _notify(self, path):
+        if path is not None and self.ignore.search(path):
+            return
+        try:
+            self.callback(path)
+        except Exception:
+            ex = sys.exc_info()[1]
+            if logger: logger.error("[tenjin.%s] callback failed (path=%r): %s" % (self.__class__.__name__, path, ex))
+
+    def _setup_inotify(self):
+        global ctypes
+        if ctypes is None: import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._libc, self._fd, self._wds = libc, fd, {}
+        self._wakeup = os.pipe()
+        for dirname in self.dirs:
+            self._add_watches(dirname)
+
+    def _add_watches(self, dirname):
+        #: watch directory and subdirectories of it.
+        for path, dirnames, _ in os.walk(dirname):
+            dirnames[:] = [ d for d in dirnames if d != '__pycache__' ]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.IN_MASK)
+            if wd >= 0:
+                self._wds[wd] = path
+
+    def _close_inotify(self):
+        for fd in (self._fd, ) + self._wakeup:
+            os.close(fd)
+
+    def _run_inotify(self):
+        global select, struct
+        if select is None: import select
+        if struct is None: import struct
+        fd, wakeup = self._fd, self._wakeup[0]
+        try:
+            while not self._stopped.is_set():
+                if wakeup in select.select([fd, wakeup], [], [])[0]:
+                    break
+                data = os.read(fd, 65536)
+                pos = 0
+                while pos < len(data):
+                    wd, mask, _, length = struct.unpack_from('iIII', data, pos)
+                    name = data[pos+16:pos+16+length].rstrip(b'\0')
+                    pos += 16 + length
+                    if mask & self.IN_Q_OVERFLOW:
+                        self._notify(None)
+                        continue
+                    if mask & self.IN_IGNORED:
+                        self._wds.pop(wd, None)
+                        continue
+                    dirname = self._wds.get(wd)
+                    if dirname is None or not name:
+                        continue
+                    path = os.path.join(dirname, os.fsdecode(name))
+                    #: watch directory created (or moved) in watched directory.
+                    if mask & self.IN_ISDIR:
+                        if mask & (self.IN_CREATE | self.IN_MOVED_TO) and not self.ignore.search(path):
+                            self._add_watches(path)
+                        continue
+                    self._notify(path)
+        finally:
+            self._close_inotify()
+
+    def _scan(self):
+        #: return dict of full path and mtime (and size) of files in directories.
+        snapshot = {}
+        dirs = list(self.dirs)
+        while dirs:
+            try:
+                entries = list(os.scandir(dirs.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if self.ignore.search(entry.path):
+                    continue
+                try:
+                    if entry.is_dir():
+                        dirs.append(entry.path)
+                    else:
+                        st = entry.stat()
+                        snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    pass
+        return snapshot
+
+    def _run_poll(self):
+        while not self._stopped.wait(self.interval):
+            snapshot = self._scan()
+            old = self._snapshot
+            for path in set(old) | set(snapshot):
+                if old.get(path) != snapshot.get(path):
+                    self._notify(path)
+            self._snapshot = snapshot
+
+
 ##
 ##
 ##
@@ -1662,6 +3546,312 @@ class TemplateNotFoundError(Exception):
 
 
 
+##
+## optimizer for tiered compilation
+##
+
+class TemplateOptimizer(object):
+    """Optimize python code of template. Engine uses this to recompile
+       templates which are rendered frequently (see Engine.tier_threshold).
+
+       Passes:
+         'inline'   : inline include() of static template as string.
+         'escape'   : elide escaping of numbers and evaluate constant expressions.
+         'merge'    : merge adjacent _extend() calls and adjacent strings.
+         'localize' : evaluate template in function to use fast local variables
+                      (only for templates which declare '#@ARGS').
+
+       'merge' is not applied to statements in try or with statement,
+       because output before exception should be kept in such statements.
+    """
+
+    passes = ('inline', 'escape', 'merge', 'localize')
+
+    ## functions which access to local variables of caller
+    FRAME_FUNCS  = ('echo', 'start_capture', 'stop_capture', 'capture_as', 'captured_as',
+                    'not_cached', 'echo_cached', 'CaptureContext', 'locals', 'vars', 'exec', 'eval', 'dir')
+    ## functions which add string into _buf
+    OUTPUT_FUNCS = ('_extend', 'echo', 'include', 'captured_as', 'start_capture', 'stop_capture',
+                    'not_cached', 'echo_cached', 'cache_as')
+
+    def __init__(self, passes=None):
+        if passes is not None:
+            self.passes = passes
+
+    def optimize(self, template, globals, include_static=None):
+        """Optimize python code of template and return tuple of code object and
+           list of applied pass names, or None if no pass is applied.
+
+           template:Template
+             Template object to optimize.
+           globals:dict
+             Global variables to render template.
+           include_static:callable (=None)
+             Function which takes template name and returns output string
+             if the template is static, else returns None.
+        """
+        global ast
+        if ast is None: import ast
+        if not template.script:
+            return None
+        tree = ast.parse(template.script)
+        applied = []
+        for name in self.passes:
+            if getattr(self, '_pass_' + name)(tree, template, globals, include_static):
+                applied.append(name)
+        if not applied:
+            return None
+        ast.fix_missing_locations(tree)
+        return compile(tree, template.filename or '(tenjin)', 'exec'), applied
+
+    def _walk_stmts(self, stmts, protected=False):
+        #: yield statement lists and whether they are in try or with statement.
+        yield stmts, protected
+        for node in stmts:
+            flag = protected or isinstance(node, (ast.Try, ast.With))
+            for field in ('body', 'orelse', 'finalbody'):
+                child = getattr(node, field, None)
+                if child and isinstance(child, list) and isinstance(child[0], ast.stmt):
+                    for x in self._walk_stmts(child, flag):
+                        yield x
+            for handler in getattr(node, 'handlers', None) or ():
+                for x in self._walk_stmts(handler.body, flag):
+                    yield x
+
+    def _extend_elts(self, node):
+        #: return elements of tuple if node is '_extend((...))', else None.
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            call = node.value
+            if isinstance(call.func, ast.Name) and call.func.id == '_extend' \
+               and len(call.args) == 1 and not call.keywords and isinstance(call.args[0], ast.Tuple):
+                return call.args[0].elts
+        return None
+
+    def _new_extend(self, arg, node):
+        call = ast.Call(func=ast.Name(id='_extend', ctx=ast.Load()), args=[arg], keywords=[])
+        return ast.copy_location(ast.Expr(value=call), node)
+
+    def _is_pure(self, nodes):
+        #: return False if nodes may add string into _buf.
+        for node in nodes:
+            for x in ast.walk(node):
+                if isinstance(x, ast.Name) and (x.id == '_buf' or x.id in self.OUTPUT_FUNCS):
+                    return False
+                if isinstance(x, ast.keyword) and x.arg == '_buf':
+                    return False
+        return True
+
+    def _is_call(self, node, names):
+        return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+               and node.func.id in names and not node.keywords
+
+    def _constant(self, value, node):
+        return ast.copy_location(ast.Constant(value=value, kind=None), node)
+
+    ##
+    ## ex. include('_footer.pyhtml')  =>  _extend(('<footer>...</footer>\n', ))
+    ##
+    def _pass_inline(self, tree, template, globals, include_static):
+        if not include_static:
+            return False
+        changed = False
+        for stmts, _ in self._walk_stmts(tree.body):
+            for i, node in enumerate(stmts):
+                if isinstance(node, ast.Expr) and self._is_call(node.value, ('include', )):
+                    args = node.value.args
+                    if len(args) == 1 and isinstance(args[0], ast.Constant) and isinstance(args[0].value, str):
+                        output = include_static(args[0].value)
+                        if output is not None:
+                            arg = ast.Tuple(elts=[self._constant(output, node)], ctx=ast.Load())
+                            stmts[i] = self._new_extend(arg, node)
+                            changed = True
+        return changed
+
+    ##
+    ## ex. _escape(_to_str(len(items)))  =>  _to_str(len(items))
+    ## ex. _escape(_to_str('<b>'))       =>  '&lt;b&gt;'
+    ##
+    _INT_OPS = ('Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow')
+
+    def _pass_escape(self, tree, template, globals, include_static):
+        escapefunc, tostrfunc = template.escapefunc, template.tostrfunc
+        if not escapefunc or not tostrfunc:
+            return False
+        try:
+            escape, to_str = eval(escapefunc, globals), eval(tostrfunc, globals)
+            #: escaping should not change numbers.
+            for v in (0, -12, 3.5, 1e100, True):
+                s = to_str(v)
+                if type(s) is not str or escape(s) != s:
+                    return False
+        except Exception:
+            return False
+        int_names, builtins = self._int_names(tree, template, globals)
+        optimizer = self
+        changed = []
+        def fold(func, value, node):
+            try:
+                value = func(value)
+            except Exception:
+                return None
+            return type(value) is str and optimizer._constant(value, node) or None
+        class Transformer(ast.NodeTransformer):
+            def visit_Call(self, node):
+                self.generic_visit(node)
+                new = None
+                if optimizer._is_call(node, ('_escape', '_to_str')) and len(node.args) == 1:
+                    arg = node.args[0]
+                    if isinstance(arg, ast.Constant) and isinstance(arg.value, (str, int, float)):
+                        new = fold(node.func.id == '_escape' and escape or to_str, arg.value, node)
+                    elif node.func.id == '_escape' and optimizer._is_call(arg, ('_to_str', )) \
+                         and len(arg.args) == 1 and optimizer._is_int(arg.args[0], int_names, builtins):
+                        new = arg
+                if new is not None:
+                    changed.append(node)
+                    return new
+                return node
+        Transformer().visit(tree)
+        return bool(changed)
+
+    def _int_names(self, tree, template, globals):
+        #: return names which are assigned only int (or float) values, and available builtins.
+        stored = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+                stored.add(node.id)
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                stored.add(node.name)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                stored.update([ (a.asname or a.name).split('.')[0] for a in node.names ])
+            elif isinstance(node, ast.arg):
+                stored.add(node.arg)
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                stored.add(node.name)
+        #: local variables may be set by context data if '#@ARGS' is not declared.
+        if template.args is None:
+            return set(), set()
+        builtins = set(['len', 'range', 'enumerate']) - stored - set(globals)
+        values = {}   # name => list of assigned expressions ('int' or None means int or unknown)
+        handled = set()
+        def add(target, value):
+            if isinstance(target, ast.Name):
+                values.setdefault(target.id, []).append(value)
+                handled.add(id(target))
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Assign) and len(node.targets) == 1:
+                add(node.targets[0], node.value)
+            elif isinstance(node, ast.AugAssign):
+                ok = node.op.__class__.__name__ in self._INT_OPS
+                add(node.target, ok and node.value or None)
+            elif isinstance(node, ast.For):
+                target, iter = node.target, node.iter
+                if self._is_call(iter, builtins & set(['range'])):
+                    add(target, 'int')
+                elif self._is_call(iter, builtins & set(['enumerate'])) and len(iter.args) == 1 \
+                     and isinstance(target, ast.Tuple) and len(target.elts) == 2:
+                    add(target.elts[0], 'int')
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load) and id(node) not in handled:
+                values.setdefault(node.id, []).append(None)
+        for name in stored:
+            if name not in values:
+                values[name] = [None]
+        names = set([ k for k in values if None not in values[k] ])
+        while True:
+            rejected = [ k for k in names
+                         if not all([ v == 'int' or self._is_int(v, names, builtins) for v in values[k] ]) ]
+            if not rejected:
+                return names, builtins
+            names.difference_update(rejected)
+
+    def _is_int(self, node, names, builtins):
+        if isinstance(node, ast.Constant):
+            return type(node.value) in (int, float)
+        if isinstance(node, ast.Name):
+            return node.id in names
+        if isinstance(node, ast.BinOp):
+            return node.op.__class__.__name__ in self._INT_OPS \
+                   and self._is_int(node.left, names, builtins) and self._is_int(node.right, names, builtins)
+        if isinstance(node, ast.UnaryOp):
+            return isinstance(node.op, (ast.USub, ast.UAdd)) and self._is_int(node.operand, names, builtins)
+        return self._is_call(node, builtins & set(['len']))
+
+    ##
+    ## ex. _extend(('<p>', )); _extend((_to_str(x), '</p>', ))  =>  _extend(('<p>', _to_str(x), '</p>', ))
+    ##
+    def _pass_merge(self, tree, template, globals, include_static):
+        changed = False
+        for stmts, protected in self._walk_stmts(tree.body):
+            i = 0
+            while i < len(stmts):
+                elts = self._extend_elts(stmts[i])
+                if elts is not None:
+                    j = i + 1
+                    while not protected and j < len(stmts):
+                        elts2 = self._extend_elts(stmts[j])
+                        if elts2 is None or not self._is_pure(elts2):
+                            break
+                        elts.extend(elts2)
+                        j += 1
+                    if j > i + 1:
+                        del stmts[i+1:j]
+                        changed = True
+                    if self._join_strings(elts):
+                        changed = True
+                i += 1
+        return changed
+
+    def _join_strings(self, elts):
+        changed = False
+        i = 0
+        while i < len(elts) - 1:
+            a, b = elts[i], elts[i+1]
+            if isinstance(a, ast.Constant) and isinstance(b, ast.Constant) \
+               and type(a.value) is str and type(b.value) is str:
+                elts[i] = self._constant(a.value + b.value, a)
+                del elts[i+1]
+                changed = True
+            else:
+                i += 1
+        return changed
+
+    ##
+    ## ex.
+    ##   def __tenjin_render__(_locals):
+    ##       _context = _locals['_context']; _buf = _locals['_buf']
+    ##       ...(template code)...
+    ##   __tenjin_render__(locals())
+    ##
+    def _pass_localize(self, tree, template, globals, include_static):
+        if template.args is None:
+            return False
+        for node in tree.body:
+            if isinstance(node, (ast.Global, ast.Nonlocal)):
+                return False
+        loaded, stored = set(), set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if node.id in self.FRAME_FUNCS:
+                    return False
+                if isinstance(node.ctx, ast.Load):
+                    loaded.add(node.id)
+                else:
+                    stored.add(node.id)
+        #: names which may be set into local variables by Template.render().
+        names = set(['_engine', 'include'])
+        if template.macro_script or template._imported:
+            names.update(template.get_macros(globals))
+        buf = ["def __tenjin_render__(_locals):\n",
+               "    _context = _locals['_context']; _buf = _locals['_buf']\n"]
+        for name in sorted((names & loaded) - stored):
+            buf.append("    if %r in _locals: %s = _locals[%r]\n" % (name, name, name))
+        buf.append("__tenjin_render__(locals())\n")
+        wrapper = ast.parse(''.join(buf))
+        wrapper.body[0].body.extend(tree.body)
+        tree.body[:] = wrapper.body
+        return True
+
+
 ##
 ## template engine class
 ##
@@ -1684,8 +3874,25 @@ class Engine(object):
     preprocess = False
     preprocessorclass = Preprocessor
     timestamp_interval = 1  # seconds
-
-    def __init__(self, prefix=None, postfix=None, layout=None, path=None, cache=True, preprocess=None, templateclass=None, preprocessorclass=None, lang=None, loader=None, pp=None, **kwargs):
+    tier_threshold = None   # number of rendering to promote template to tier 2 (None means disabled)
+    tier_background = True  # if True then promoted template is optimized in background thread
+    optimizer  = TemplateOptimizer()
+    checksum   = False  # if True then content hash is compared when timestamp of template file is changed
+    lean       = False  # if True then input and python script of compiled templates are dropped
+    intern_maxlen = 256 # max length of string constants shared among templates in lean mode
+    intern_maxitems = 10000  # max number of shared string constants (cleared when exceeded)
+    profile    = None   # filename to save number of rendering of each template (see save_profile())
+    single_flight = None   # True or 'wait' (wait for other thread converting template), or 'stale'
+    stale_while_revalidate = False   # if True then changed template is converted in background thread
+    production = False  # if True then template objects are frozen (see freeze())
+    watch      = False  # if True (or 'inotify' or 'poll') then template files are watched by TemplateWatcher
+    prefetch   = False  # if True then templates included or used as layout are loaded together
+    #: attributes copied by pickle (ex. into worker processes of preload())
+    _config_attrs = ('prefix', 'postfix', 'layout', 'templateclass', 'path', 'lang', 'loader',
+                     'preprocess', 'preprocessorclass', 'timestamp_interval', 'checksum',
+                     'lean', 'intern_maxlen', 'intern_maxitems', 'pp', 'kwargs', 'encoding')
+
+    def __init__(self, prefix=None, postfix=None, layout=None, path=None, cache=True, preprocess=None, templateclass=None, preprocessorclass=None, lang=None, loader=None, pp=None, tier_threshold=None, tier_background=None, checksum=None, lean=None, profile=None, single_flight=None, stale_while_revalidate=None, production=None, watch=None, prefetch=None, **kwargs):
         """Initializer of Engine class.
 
            prefix:str (='')
@@ -1710,6 +3917,51 @@ class Engine(object):
              this, cache file path will be 'inex.html.en.cache' for example.
            pp:list (=None)
              List of preprocessor object which is callable and manipulates template content.
+           tier_threshold:int (=None)
+             Number of rendering to promote template to tier 2. Template in tier 2
+             is recompiled by TemplateOptimizer. If None, templates are not promoted.
+           tier_background:bool (=True)
+             If True, promoted template is optimized in background thread.
+             If False, it is optimized in thread which renders it.
+           checksum:bool (=False)
+             If True, content hash of template files is stored into cache and
+             cached template is used if timestamp of template file is changed
+             but content hash is not changed (after deployment, for example).
+           lean:bool (=False)
+             If True, input and python script of templates are dropped after
+             compiled, and string constants are shared among templates in order
+             to reduce memory (see memory_footprint()). Tier 2 optimization and
+             incremental conversion are not available for them.
+             Table of shared string constants is cleared when number of them
+             exceeds Engine.intern_maxitems (templates keep strings they share).
+           profile:str (=None)
+             Filename of access profile. If specified, number of rendering of
+             each template is counted and saved into it by save_profile() (and
+             at exit). preload() converts templates in descending order of it.
+           single_flight:bool or str (=None)
+             If True or 'wait', only a thread converts template which is not
+             cached or expired, and other threads requesting it at the same
+             time wait for the result. If 'stale', other threads use expired
+             template object in memory (if exists) instead of waiting.
+           stale_while_revalidate:bool (=False)
+             If True, changed template file is converted in background thread
+             and previous template object is returned until it is finished.
+             If failed to convert (syntax error, for example), error is logged
+             and previous template object is used.
+           production:bool (=False)
+             If True, engine is frozen (see freeze()) and template files are
+             not checked whether changed or not until reload() is called.
+           watch:bool or str (=False)
+             If True, directories in path are watched by TemplateWatcher
+             (inotify on Linux) and template objects are checked only when
+             their template files are changed, instead of checking timestamp
+             of template files every timestamp_interval. If 'inotify' or
+             'poll', it is used as backend of TemplateWatcher. 'path' is
+             required. Call close() to stop watching.
+           prefetch:bool (=False)
+             If True, templates which are included or used as layout by a
+             template (see dependencies()) are loaded and compiled when the
+             template is loaded, instead of when they are rendered.
            kwargs:dict
              Options for Template class constructor.
              See document of Template.__init__() for details.
@@ -1723,6 +3975,16 @@ class Engine(object):
         if lang is not None:  self.lang = lang
         if loader is not None: self.loader = loader
         if preprocess is not None: self.preprocess = preprocess
+        if tier_threshold is not None: self.tier_threshold = tier_threshold
+        if tier_background is not None: self.tier_background = tier_background
+        if checksum is not None: self.checksum = checksum
+        if lean is not None: self.lean = lean
+        if profile is not None: self.profile = profile
+        if single_flight is not None: self.single_flight = single_flight
+        if stale_while_revalidate is not None: self.stale_while_revalidate = stale_while_revalidate
+        if production is not None: self.production = production
+        if watch is not None: self.watch = watch
+        if prefetch is not None: self.prefetch = prefetch
         if   pp is None:            pp = []
         elif isinstance(pp, list):  pass
         elif isinstance(pp, tuple): pp = list(pp)
@@ -1733,10 +3995,74 @@ class Engine(object):
             self.pp.append(TemplatePreprocessor(self.preprocessorclass))
         self.kwargs = kwargs
         self.encoding = kwargs.get('encoding')
-        self._filepaths = {}   # template_name => relative path and absolute path
-        self._added_templates = {}   # templates added by add_template()
+        self._init_state()
         #self.cache = cache
         self._set_cache_storage(cache)
+        if self.production:
+            self.freeze()
+        if self.watch:
+            #: watch only directories of template files (not current directory).
+            if not self.path:
+                raise ValueError("'watch' option requires 'path' option.")
+            backend = self.watch is not True and self.watch or None
+            self.watcher = TemplateWatcher(self.path, self._weak_invalidate(), backend).start()
+            #: stop watcher when engine is garbage-collected without close().
+            weakref.finalize(self, self.watcher.stop)
+
+    def _weak_invalidate(self):
+        #: return callback which doesn't prevent engine from being garbage-collected.
+        global weakref
+        if weakref is None: import weakref
+        ref = weakref.ref(self)
+        def invalidate(filepath):
+            engine = ref()
+            if engine is not None:
+                engine.invalidate(filepath)
+        return invalidate
+
+    def close(self):
+        """Stop watching template files (see 'watch' option)."""
+        watcher, self.watcher = self.watcher, None
+        if watcher is not None:
+            watcher.stop()
+
+    def _init_state(self):
+        #: initialize attributes which are not configuration.
+        self._filepaths = {}   # template_name => relative path and absolute path
+        self._added_templates = {}   # templates added by add_template()
+        self._importing = {}         # thread id => filenames of templates importing macros
+        self._tier_templates = {}    # templates counted by _count_render() (weak references)
+        self._tier_lock = None
+        self._constants = {}         # string constants shared among templates (see _make_lean())
+        self._hits = None            # template name => number of rendering (see save_profile())
+        self._flights = {}           # cache path => template being converted (see _single_flight())
+        self._flights_lock = None
+        self.single_flight_waits = 0 # number of requests which didn't convert template by single flight
+        self._revalidating = set()   # cache paths of templates being converted in background
+        self._frozen = None          # template name => template object (see freeze())
+        global threading, weakref
+        if self.single_flight or self.stale_while_revalidate:
+            if threading is None: import threading
+            self._flights_lock = threading.Lock()
+        if self.tier_threshold:
+            #: don't keep templates removed from cache storage only for tier_stats().
+            if weakref is None: import weakref
+            if threading is None: import threading
+            self._tier_templates = weakref.WeakValueDictionary()
+            self._tier_lock = threading.Lock()
+        self.watcher = None
+
+    def __getstate__(self):
+        #: pickle only configuration (Engine._config_attrs), not cache storage,
+        #: template objects, locks nor watcher.
+        d = self.__dict__
+        return dict([ (k, d[k]) for k in self._config_attrs if k in d ])
+
+    def __setstate__(self, state):
+        #: unpickled engine has no cache storage.
+        self.__dict__.update(state)
+        self._init_state()
+        self.cache = None
 
     def _set_cache_storage(self, cache):
         if cache is True:
@@ -1748,6 +4074,9 @@ class Engine(object):
             self.cache = None
         elif isinstance(cache, CacheStorage):
             self.cache = cache
+            #: bundle file is looked up by filename relative to path of engine.
+            if isinstance(cache, BundleCacheStorage) and cache.path is None:
+                cache.path = self.path
         else:
             raise ValueError("%r: invalid cache object." % (cache, ))
 
@@ -1774,14 +4103,71 @@ class Engine(object):
         #: if template_name doesn't start with ':', just return it.
         return template_name
 
-    def _create_template(self, input=None, filepath=None, _context=None, _globals=None):
-        #: if input is not specified then just create empty template object.
+    def _new_template(self):
+        #: create empty template object with options (used to restore cached template).
         template = self.templateclass(None, **self.kwargs)
+        #: preprocessors change converted python code as well as options.
+        if self.pp:
+            template.pp_signature = self._pp_signature()
+        return template
+
+    def _pp_signature(self):
+        #: return string which identifies preprocessors and their options
+        #: (attributes which are not stable between processes are ignored).
+        items = []
+        for pp in self.pp:
+            obj = hasattr(pp, '__qualname__') and pp or pp.__class__
+            attrs = [ (k, v) for k, v in sorted(getattr(pp, '__dict__', {}).items())
+                      if k != 'globals' and isinstance(v, (str, int, float, tuple, list, dict, type, type(None))) ]
+            items.append(('%s.%s' % (obj.__module__, obj.__qualname__), attrs))
+        return repr(items)
+
+    def _create_template(self, input=None, filepath=None, _context=None, _globals=None, base=None):
+        #: if input is not specified then just create empty template object.
+        template = self._new_template()
         #: if input is specified then create template object and return it.
         if input:
-            template.convert(input, filepath)
+            #: resolve '#@EXTENDS' and '#@BLOCK' before converting.
+            depends = {}
+            load_parent = lambda name: self._load_parent(name, depends, _context, _globals)
+            input = template.expand_blocks(input, load_parent, filepath)
+            #: if previous template object is specified then convert only changed blocks.
+            try:
+                template.convert(input, filepath, base)
+            except SyntaxError:
+                template._relocate_syntax_error(sys.exc_info()[1])
+                raise
+            #: record timestamps of imported templates to detect their change.
+            if template.imports:
+                filenames = self._enter_import(filepath)
+                try:
+                    for template_name, _, _ in template.imports:
+                        imported = self.get_template(template_name, _context, _globals)
+                        depends[imported.filename] = imported.timestamp
+                        depends.update(imported.depends or {})
+                finally:
+                    self._exit_import(filenames)
+            if depends:
+                template.depends = depends
         return template
 
+    def _load_parent(self, template_name, depends, _context=None, _globals=None):
+        #: find parent template in the same way as layout template.
+        filename = self.to_filename(template_name)
+        filepath = self.loader.find(filename, self.path)
+        if not filepath:
+            raise TemplateNotFoundError('%s: filename not found (path=%r).' % (filename, self.path))
+        ret = self.loader.load(filepath)
+        if not ret:
+            raise TemplateNotFoundError("%r: template not found." % filepath)
+        input, timestamp = ret
+        #: preprocess parent template as well as child template.
+        if self.pp:
+            input = self._preprocess(input, filepath, _context, _globals)
+        #: record timestamp of parent template to detect its change.
+        depends[filepath] = timestamp
+        return input, filepath
+
     def _preprocess(self, input, filepath, _context, _globals):
         #if _context is None: _context = {}
         #if _globals is None: _globals = sys._getframe(3).f_globals
@@ -1797,22 +4183,32 @@ class Engine(object):
 
     def add_template(self, template):
         self._added_templates[template.filename] = template
+        if self._frozen:
+            self._frozen = {}
 
     def _get_template_from_cache(self, cachepath, filepath):
         #: if template not found in cache, return None
-        template = self.cache.get(cachepath, self.templateclass)
+        template = self.cache.get(cachepath, self._new_template)
         if not template:
             return None
         assert template.timestamp is not None
         #: if checked within a sec, skip timestamp check.
+        #: (if template files are watched, skip it until template file is changed.)
         now = _time()
         last_checked = getattr(template, '_last_checked_at', None)
-        if last_checked and now < last_checked + self.timestamp_interval:
+        if last_checked and (now < last_checked + self.timestamp_interval or
+                             self.watcher is not None and self.watcher.is_alive()):
             #if logger: logger.trace('[tenjin.%s] timestamp check skipped (%f < %f + %f)' % \
             #                        (self.__class__.__name__, now, template._last_checked_at, self.timestamp_interval))
             return template
         #: if timestamp of template objectis same as file, return it.
-        if template.timestamp == self.loader.timestamp(filepath):
+        if template.timestamp == self.loader.timestamp(filepath) and \
+           self._is_depends_fresh(template):
+            template._last_checked_at = now
+            return template
+        #: if content of template files are not changed (only timestamp is changed), return it.
+        if self.checksum and template.checksums and \
+           self._refresh_by_checksums(template, cachepath, filepath):
             template._last_checked_at = now
             return template
         #: if timestamp of template object is different from file, clear it
@@ -1821,11 +4217,180 @@ class Engine(object):
                                    (self.__class__.__name__, filepath))
         return None
 
+    def _load_template(self, filepath, _context=None, _globals=None, base=None):
+        #: load template file and create template object with timestamp.
+        ret = self.loader.load(filepath)
+        if not ret:
+            raise TemplateNotFoundError("%r: template not found." % filepath)
+        input, timestamp = ret
+        checksum = self.checksum and _checksum(input)
+        if self.pp:
+            input = self._preprocess(input, filepath, _context, _globals)
+        template = self._create_template(input, filepath, _context, _globals, base)
+        template.timestamp = timestamp
+        #: record content hash of template file and parent templates.
+        if checksum:
+            checksums = {filepath: checksum}
+            for path in template.depends or ():
+                ret = self.loader.load(path)
+                if ret:
+                    checksums[path] = _checksum(ret[0])
+            template.checksums = checksums
+        return template
+
+    def _refresh_by_checksums(self, template, cachepath, filepath):
+        #: return False if content hash of template file or parent templates is changed.
+        checksums = template.checksums
+        depends = template.depends or {}
+        timestamps = {}
+        for path in [filepath] + list(depends):
+            if path == filepath:
+                recorded = template.timestamp
+            else:
+                recorded = depends[path]
+            if recorded == _ignore_not_found_error(lambda: self.loader.timestamp(path)):
+                continue
+            ret = self.loader.load(path)
+            if not ret or checksums.get(path) != _checksum(ret[0]):
+                return False
+            timestamps[path] = ret[1]
+        #: update timestamps and save them into cache in order not to compare content hash again.
+        if logger: logger.info("[tenjin.%s] timestamp changed but content not changed (filepath=%r)" % \
+                                   (self.__class__.__name__, filepath))
+        if filepath in timestamps:
+            template.timestamp = timestamps.pop(filepath)
+        if timestamps:
+            template.depends = dict(depends, **timestamps)
+        self.cache.set(cachepath, template)
+        return True
+
+    def invalidate(self, filepath):
+        """Check timestamp of template objects related to template file at next
+           request: template object of the file, and template objects which
+           depend on it directly or indirectly (see dependencies()).
+           If filepath is None, all template objects in memory are checked.
+           Returns number of template objects. Called by TemplateWatcher.
+        """
+        cache = self.cache
+        if not cache:
+            return 0
+        templates = list(cache.items.values())
+        if filepath is not None:
+            #: collect template objects which depend on file transitively.
+            dependents = {}   # full path => template objects depending on it
+            abspath = self.loader.abspath
+            for template in templates:
+                for _, _, path in self._dependencies(template, False):
+                    if path:
+                        dependents.setdefault(abspath(path), []).append(template)
+            fullpath = abspath(filepath)
+            template = cache.items.get(self.cachename(fullpath))
+            templates = template is not None and [template] or []
+            queue, visited = [fullpath], set([fullpath])
+            while queue:
+                for template in dependents.get(queue.pop(), ()):
+                    if template not in templates:
+                        templates.append(template)
+                    path = template.filename and abspath(template.filename)
+                    if path and path not in visited:
+                        visited.add(path)
+                        queue.append(path)
+        for template in templates:
+            template._last_checked_at = None
+        return len(templates)
+
+    def dependencies(self, template_name, _context=None, _globals=None):
+        """Return list of [kind, template name, filepath] which template depends on.
+           kind is 'include' or 'layout' (template name is found in python script
+           as string literal), 'import' ('#@IMPORT' or '#@FROM'), or 'depends'
+           (parent template of '#@EXTENDS', for example). filepath is None if
+           template file is not found.
+           ex.
+             >>> engine.dependencies('page.pyhtml')
+             [['layout', ':layout', 'views/layout.pyhtml'],
+              ['include', '_row.pyhtml', 'views/_row.pyhtml']]
+        """
+        if _globals is None: _globals = sys._getframe(1).f_globals
+        template = self.get_template(template_name, _context, _globals)
+        return self._dependencies(template, True)
+
+    def _dependencies(self, template, find=True):
+        #: resolve template names into filepaths (without searching files if find is false).
+        deps = []
+        names = [ [kind, name] for kind, name in template.references or () ]
+        names.extend([ ['import', name] for name, _, _ in template.imports or () ])
+        for kind, name in names:
+            filename = self.to_filename(name)
+            pair = self._filepaths.get(filename)
+            filepath = pair and pair[0] or (find and self.loader.find(filename, self.path) or None)
+            deps.append([kind, name, filepath])
+        paths = set([ filepath for _, _, filepath in deps ])
+        for filepath in template.depends or ():
+            if filepath not in paths:
+                deps.append(['depends', filepath, filepath])
+        return deps
+
+    def dependency_graph(self, template_names, _context=None, _globals=None):
+        """Return dict of filepath of templates and their dependencies (see
+           dependencies()). Templates included or used as layout (or imported)
+           by the templates are added into it recursively.
+           ex.
+             >>> engine.dependency_graph(['page.pyhtml'])
+             {'views/page.pyhtml': [['layout', ':layout', 'views/layout.pyhtml']],
+              'views/layout.pyhtml': []}
+        """
+        if _globals is None: _globals = sys._getframe(1).f_globals
+        graph = OrderedDict()
+        queue = list(template_names)
+        while queue:
+            template = self.get_template(queue.pop(0), _context, _globals)
+            if template.filename in graph:
+                continue
+            deps = graph[template.filename] = self._dependencies(template, True)
+            for kind, name, filepath in deps:
+                if kind != 'depends' and filepath and filepath not in graph:
+                    queue.append(name)
+        return graph
+
+    def _prefetch(self, template, _context, _globals):
+        #: load and compile templates which are included or used as layout.
+        #: (context data is passed to preprocess them in the same way as rendering.)
+        template._prefetched = True
+        for _, name in template.references:
+            try:
+                self.get_template(name, _context, _globals)
+            except TemplateNotFoundError:
+                ex = sys.exc_info()[1]
+                if logger: logger.info("[tenjin.%s] failed to prefetch template (filename=%r): %s" % (self.__class__.__name__, template.filename, ex))
+
+    def _is_depends_fresh(self, template):
+        #: return False if one of parent templates is changed or removed.
+        depends = template.depends
+        if depends:
+            timestamp = self.loader.timestamp
+            for filepath in depends:
+                if depends[filepath] != _ignore_not_found_error(lambda: timestamp(filepath)):
+                    return False
+        return True
+
     def get_template(self, template_name, _context=None, _globals=None):
         """Return template object.
            If template object has not registered, template engine creates
            and registers template object automatically.
         """
+        #: if engine is frozen then return template object without any check.
+        frozen = self._frozen
+        if frozen is not None:
+            template = frozen.get(template_name)
+            if template is not None:
+                return template
+        if _globals is None: _globals = sys._getframe(1).f_globals
+        template = self._get_template(template_name, _context, _globals)
+        if frozen is not None:
+            frozen[template_name] = template
+        return template
+
+    def _get_template(self, template_name, _context, _globals):
         #: accept template_name such as ':index'.
         filename = self.to_filename(template_name)
         #: if template object is added by add_template(), return it.
@@ -1850,32 +4415,462 @@ class Engine(object):
         template = cache and self._get_template_from_cache(cachepath, filepath) or None
         #: if template object is not found in cache or is expired...
         if not template:
-            ret = self.loader.load(filepath)
-            if not ret:
-                raise TemplateNotFoundError("%r: template not found." % filepath)
-            input, timestamp = ret
             if self.pp:   ## required for preprocessing
                 if _context is None: _context = {}
-                if _globals is None: _globals = sys._getframe(1).f_globals
-                input = self._preprocess(input, filepath, _context, _globals)
-            #: create template object.
-            template = self._create_template(input, filepath, _context, _globals)
-            #: set timestamp and filename of template object.
-            template.timestamp = timestamp
-            template._last_checked_at = _time()
-            #: save template object into cache.
-            if cache:
-                if not template.bytecode:
-                    #: ignores syntax error when compiling.
-                    try: template.compile()
-                    except SyntaxError: pass
-                cache.set(cachepath, template)
+            #: return previous template object while converting changed template in background.
+            stale = self.stale_while_revalidate and cache and cache.items.get(cachepath)
+            if stale:
+                template = self._revalidate_in_background(cachepath, filepath, stale, _globals)
+            elif self.single_flight:
+                template = self._single_flight(cachepath, filepath, _context, _globals)
+            else:
+                template = self._convert_template(cachepath, filepath, _context, _globals)
         #else:
         #    template.compile()
         #:
         template.filename = filepath
+        #: drop input and python script of compiled template in lean mode.
+        if self.lean and template.bytecode is not None and \
+           (template.input is not None or template.script is not None):
+            self._make_lean(template)
+            #: update size of template object in bounded cache storage.
+            if cache and (cache.max_items or cache.max_bytes) and cachepath in cache.items:
+                cache._add(cachepath, template)
+        #: resolve '#@IMPORT' and '#@FROM' only once per template object.
+        if template.imports and template._imported is None:
+            template._imported = self._import_macros(template, _globals)
+        #: load templates included or used as layout by template in advance.
+        if self.prefetch and template.references and not template._prefetched:
+            self._prefetch(template, _context, _globals)
         return template
 
+    def freeze(self, reload_signal=None):
+        """Freeze template objects in order to skip checking template files.
+           Template object is resolved from template name by only a dict lookup
+           after it is requested at first time. Call reload() to reflect changes
+           of template files. Returns engine itself.
+
+           reload_signal:int (=None)
+             Signal number (such as signal.SIGHUP) to call reload() in
+             background thread. Available only in main thread.
+        """
+        global signal, threading
+        if self._frozen is None:
+            self._frozen = {}
+        if reload_signal is not None:
+            if signal is None: import signal
+            if threading is None: import threading
+            _globals = sys._getframe(1).f_globals
+            #: don't reload templates in signal handler, which interrupts main thread.
+            def handler(signum, frame):
+                thread = threading.Thread(target=self._reload, args=(_globals, ))
+                thread.daemon = True
+                thread.start()
+            signal.signal(reload_signal, handler)
+        return self
+
+    def reload(self):
+        """Check template files of frozen template objects and convert changed
+           ones again. Frozen template objects are replaced at once after all of
+           them are checked. Returns number of template objects reloaded.
+        """
+        return self._reload(sys._getframe(1).f_globals)
+
+    def _reload(self, _globals):
+        frozen = self._frozen
+        if not frozen:
+            return 0
+        #: frozen template objects are used by other threads while reloading.
+        names = list(frozen.keys())
+        templates = {}
+        for template_name in names:
+            template = frozen.get(template_name)
+            #: check timestamp of template file regardless of timestamp_interval.
+            if template is not None:
+                template._last_checked_at = None
+            try:
+                templates[template_name] = self._get_template(template_name, {}, _globals)
+            except Exception:
+                ex = sys.exc_info()[1]
+                #: template is converted again (and error is raised) at next request.
+                if logger: logger.error("[tenjin.%s] failed to reload template (template_name=%r): %s: %s" % \
+                                            (self.__class__.__name__, template_name, ex.__class__.__name__, ex))
+        n = len(templates)
+        #: keep template objects requested at first time while reloading.
+        names = set(names)
+        for template_name, template in list(frozen.items()):
+            if template_name not in names:
+                templates.setdefault(template_name, template)
+        self._frozen = templates
+        if logger: logger.info("[tenjin.%s] %d templates reloaded" % (self.__class__.__name__, n))
+        return n
+
+    def _convert_template(self, cachepath, filepath, _context, _globals):
+        cache = self.cache
+        #: create template object (reusing python code of expired template object).
+        base = cache and cache.items.get(cachepath) or None
+        template = self._load_template(filepath, _context, _globals, base)
+        #: set timestamp and filename of template object.
+        template._last_checked_at = _time()
+        #: save template object into cache.
+        if cache:
+            if not template.bytecode:
+                #: ignores syntax error when compiling.
+                #: (error is kept in template object and raised when rendering.)
+                try: template.compile()
+                except SyntaxError: pass
+            cache.set(cachepath, template)
+        return template
+
+    def _single_flight(self, cachepath, filepath, _context, _globals):
+        #: only a thread converts template and other threads wait for it.
+        with self._flights_lock:
+            flight = self._flights.get(cachepath)
+            if flight is None:
+                #: return template object if other thread has just converted it.
+                template = self.cache and self._get_template_from_cache(cachepath, filepath)
+                if template:
+                    return template
+                flight = self._flights[cachepath] = _Flight()
+                leader = True
+            else:
+                #: convert template if it is being converted by current thread (recursive include).
+                leader = False
+                if flight.thread_id == threading.get_ident():
+                    return self._convert_template(cachepath, filepath, _context, _globals)
+                self.single_flight_waits += 1
+        if leader:
+            try:
+                flight.template = self._convert_template(cachepath, filepath, _context, _globals)
+                return flight.template
+            except Exception:
+                flight.error = sys.exc_info()[1]
+                raise
+            finally:
+                with self._flights_lock:
+                    self._flights.pop(cachepath, None)
+                flight.event.set()
+        #: return expired template object in memory without waiting if 'stale'.
+        if self.single_flight == 'stale':
+            stale = self.cache and self.cache.items.get(cachepath)
+            if stale:
+                return stale
+        flight.event.wait()
+        #: if other thread failed to convert template then raise the same error
+        #: (instead of converting it by all waiting threads at once).
+        if flight.error is not None:
+            raise flight.error
+        return flight.template
+
+    def _revalidate_in_background(self, cachepath, filepath, stale, _globals):
+        with self._flights_lock:
+            if cachepath in self._revalidating:
+                return stale
+            self._revalidating.add(cachepath)
+        #: skip timestamp check of previous template object while converting.
+        stale._last_checked_at = _time()
+        thread = threading.Thread(target=self._revalidate, args=(cachepath, filepath, stale, _globals))
+        thread.daemon = True
+        thread.start()
+        return stale
+
+    def _revalidate(self, cachepath, filepath, stale, _globals):
+        #: convert changed template and replace previous template object with it.
+        try:
+            try:
+                template = self._load_template(filepath, {}, _globals, stale)
+                if not template.bytecode:
+                    template.compile()
+                template.filename = filepath
+                template._last_checked_at = _time()
+                self.cache.set(cachepath, template)
+                if logger: logger.info("[tenjin.%s] template reloaded (filepath=%r)" % (self.__class__.__name__, filepath))
+            except Exception:
+                ex = sys.exc_info()[1]
+                #: keep previous template object and try again after timestamp_interval.
+                if logger: logger.error("[tenjin.%s] failed to reload template (filepath=%r): %s: %s" % \
+                                            (self.__class__.__name__, filepath, ex.__class__.__name__, ex))
+                stale._last_checked_at = _time()
+        finally:
+            with self._flights_lock:
+                self._revalidating.discard(cachepath)
+
+    def _make_lean(self, template):
+        #: drop attributes which are not necessary to render template.
+        template.input = template.script = None
+        template._blocks = None
+        #: share string constants (such as '</td>\n') among templates.
+        template.bytecode = self._intern_constants(template.bytecode)
+        if template.static is not None:
+            template.static = self._intern_constants(template.static)
+
+    def _intern_constants(self, obj):
+        #: return string, tuple or code object whose string constants are replaced by shared ones.
+        t = type(obj)
+        if t is str:
+            if len(obj) > self.intern_maxlen:
+                return obj
+            constants = self._constants
+            shared = constants.get(obj)
+            if shared is None:
+                #: start sharing over again when table is full, in order not to
+                #: keep constants of templates removed or reloaded forever.
+                if len(constants) >= self.intern_maxitems:
+                    constants.clear()
+                shared = constants.setdefault(obj, obj)
+            return shared
+        if t is tuple:
+            return tuple( self._intern_constants(x) for x in obj )
+        if t is _code_type:
+            return obj.replace(co_consts=self._intern_constants(obj.co_consts))
+        return obj
+
+    def memory_footprint(self):
+        """Return dict which reports number of template objects kept by engine
+           and approximate bytes retained by their input, python script,
+           bytecode, static output and instance dict, and string constants
+           shared among templates in lean mode.
+        """
+        templates = list(self.cache.items.values()) if self.cache else []
+        templates.extend(self._added_templates.values())
+        getsizeof = sys.getsizeof
+        report = {'templates': len(templates), 'input': 0, 'script': 0,
+                  'bytecode': 0, 'static': 0, 'dict': 0}
+        for template in templates:
+            if template.input is not None:
+                report['input'] += getsizeof(template.input)
+            if template.script is not None:
+                report['script'] += getsizeof(template.script)
+            if template.bytecode is not None:
+                report['bytecode'] += _code_size(template.bytecode)
+            if template.static is not None:
+                report['static'] += getsizeof(template.static)
+            report['dict'] += getsizeof(template.__dict__)
+        report['total'] = sum(report[k] for k in ('input', 'script', 'bytecode', 'static', 'dict'))
+        #: count references to shared string constants from templates kept by engine.
+        refs = {}
+        for template in templates:
+            self._count_shared_constants(template.bytecode, refs)
+            self._count_shared_constants(template.static, refs)
+        report['shared_constants'] = len(self._constants)
+        report['shared_bytes_saved'] = sum([ (n - 1) * getsizeof(s) for s, n in refs.values() ])
+        return report
+
+    def _count_shared_constants(self, obj, refs):
+        t = type(obj)
+        if t is str:
+            if self._constants.get(obj) is obj:
+                pair = refs.get(id(obj))
+                refs[id(obj)] = (obj, pair and pair[1] + 1 or 1)
+        elif t is tuple:
+            for x in obj:
+                self._count_shared_constants(x, refs)
+        elif t is _code_type:
+            self._count_shared_constants(obj.co_consts, refs)
+
+    def get_script(self, template_name, _context=None, _globals=None):
+        """Return python script of template. If template object doesn't have
+           it (loaded from LeanMarshalCacheStorage, for example), template
+           file is converted again without changing template object in cache.
+        """
+        if _context is None: _context = {}
+        if _globals is None: _globals = sys._getframe(1).f_globals
+        template = self.get_template(template_name, _context, _globals)
+        if template.script is None:
+            template = self._load_template(template.filename, _context, _globals)
+        return template.script
+
+    def preload(self, patterns=None, workers=None, profile=None, budget=None, _context=None, _globals=None):
+        """Convert and compile templates in advance and set them into cache
+           storage (call it before accepting requests). Returns dict of statistics.
+
+           patterns:list of str (=None)
+             Template names (such as ':index' or 'blog/index.pyhtml') or glob
+             patterns of filenames in Engine.path (such as 'blog/*.pyhtml').
+             If None, all files which have postfix (or '.pyhtml') are preloaded.
+           workers:int (=None)
+             Number of processes to convert templates. If None or 1, templates
+             are converted in current process.
+           profile:str or dict (=None)
+             Access profile (filename or dict of template name and number of
+             rendering). Templates are converted in descending order of it.
+             If None, Engine.profile is used if the file exists.
+           budget:float (=None)
+             Seconds to convert templates. Remained templates are skipped when
+             it is exceeded, and they are converted at first request.
+           ex.
+             >>> engine.preload(['**/*.pyhtml'], workers=4)
+             {'templates': 120, 'converted': 118, 'cached': 2, 'skipped': 0,
+              'errors': {}, 'workers': 4, 'elapsed': 0.42}
+        """
+        start = _time()
+        if _globals is None: _globals = sys._getframe(1).f_globals
+        names = self._find_templates(patterns)
+        #: convert frequently requested templates first.
+        if profile is None and self.profile and os.path.isfile(self.profile):
+            profile = self.profile
+        if profile:
+            hits = isinstance(profile, dict) and profile or self.load_profile(profile)
+            names.sort(key=lambda name: -hits.get(name, 0))
+        deadline = budget is not None and start + budget or None
+        stats = {'templates': len(names), 'converted': 0, 'cached': 0, 'skipped': 0, 'errors': {},
+                 'workers': workers or 1}
+        #: skip templates which are found in cache and not expired.
+        targets = []
+        for name in names:
+            filepath = self.loader.find(name, self.path)
+            if not filepath:
+                stats['errors'][name] = 'TemplateNotFoundError: %s: filename not found.' % name
+            else:
+                template = self.cache and self._get_template_from_cache(self.cachename(self.loader.abspath(filepath)), filepath)
+                #: cached template which has syntax error is reported as error.
+                if template and template.compile_error is None:
+                    stats['cached'] += 1
+                else:
+                    targets.append(name)
+        if workers and workers > 1 and len(targets) > 1:
+            self._preload_in_processes(targets, workers, stats, deadline)
+        else:
+            for i, name in enumerate(targets):
+                if deadline and _time() > deadline:
+                    stats['skipped'] = len(targets) - i
+                    break
+                try:
+                    _compile_preloaded(self.get_template(name, _context, _globals))
+                    stats['converted'] += 1
+                except Exception:
+                    ex = sys.exc_info()[1]
+                    stats['errors'][name] = '%s: %s' % (ex.__class__.__name__, ex)
+        stats['elapsed'] = _time() - start
+        if logger: logger.info("[tenjin.%s] preload %d templates (converted: %d, errors: %d, elapsed: %.3f)" % \
+                                   (self.__class__.__name__, stats['templates'], stats['converted'], len(stats['errors']), stats['elapsed']))
+        return stats
+
+    def _count_hit(self, filename):
+        hits = self._hits
+        if hits is None:
+            global atexit
+            if atexit is None: import atexit
+            hits = self._hits = {}
+            atexit.register(self.save_profile)
+        hits[filename] = hits.get(filename, 0) + 1
+
+    def save_profile(self, filename=None):
+        """Save number of rendering of each template into profile file
+           (default is Engine.profile) in descending order.
+           ex.
+             1200 index.pyhtml
+             830 blog/post.pyhtml
+        """
+        filename = filename or self.profile
+        if not filename or self._hits is None:
+            return
+        items = sorted(list(self._hits.items()), key=lambda item: (-item[1], item[0]))
+        s = ''.join([ '%d %s\n' % (count, name) for name, count in items ])
+        _write_binary_file(filename, s.encode('utf-8'))
+
+    def load_profile(self, filename):
+        """Return dict of template name and number of rendering in profile file
+           saved by save_profile(). Returns empty dict if file is not found.
+        """
+        hits = {}
+        if os.path.isfile(filename):
+            for line in _read_text_file(filename).splitlines():
+                pair = line.split(' ', 1)
+                if len(pair) == 2 and pair[0].isdigit():
+                    hits[pair[1]] = int(pair[0])
+        return hits
+
+    def _find_templates(self, patterns):
+        #: return template names matched to patterns (without duplication).
+        global glob
+        if glob is None: import glob
+        if patterns is None:
+            patterns = ['**/*' + (self.postfix or '.pyhtml')]
+        elif isinstance(patterns, str):
+            patterns = [patterns]
+        names = []
+        for pattern in patterns:
+            filename = self.to_filename(pattern)
+            if not re.search(r'[*?\[]', filename):
+                names.append(filename)
+                continue
+            for dirname in self.path or [os.curdir]:
+                for filepath in sorted(glob.glob(os.path.join(dirname, filename), recursive=True)):
+                    if os.path.isfile(filepath):
+                        names.append(os.path.relpath(filepath, dirname).replace(os.sep, '/'))
+        return list(OrderedDict.fromkeys(names))
+
+    def _preload_in_processes(self, names, workers, stats, deadline=None):
+        global concurrent
+        if concurrent is None: import concurrent.futures
+        #: engine is copied into worker processes without cache storage and
+        #: template objects (see __getstate__()).
+        size = -(-len(names) // (workers * 4))   # 4 chunks per worker
+        chunks = [ names[i:i+size] for i in range(0, len(names), size) ]
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            #: chunks are converted in order (frequently requested templates first).
+            futures = [ executor.submit(_preload_templates, self, chunk) for chunk in chunks ]
+            for i, future in enumerate(futures):
+                if deadline and _time() > deadline:
+                    for future in futures[i:]:
+                        future.cancel()
+                    stats['skipped'] = sum([ len(chunk) for chunk in chunks[i:] ])
+                    break
+                for name, filepath, data, error in future.result():
+                    if error:
+                        stats['errors'][name] = error
+                        continue
+                    #: restore template object from attributes marshaled by worker process.
+                    template = self._new_template()
+                    dct = marshal.loads(data)
+                    dct.pop('signature', None)
+                    for k in dct:
+                        setattr(template, k, dct[k])
+                    template.filename = filepath
+                    template._last_checked_at = _time()
+                    fullpath = self.loader.abspath(filepath)
+                    self._filepaths[name] = (filepath, fullpath)
+                    if self.cache:
+                        self.cache.set(self.cachename(fullpath), template)
+                    stats['converted'] += 1
+
+    def _import_macros(self, template, _globals):
+        #: return dict of macros (or namespaces of macros) imported by template.
+        filenames = self._enter_import(template.filename)
+        try:
+            imported = {}
+            for template_name, alias, names in template.imports:
+                macros = self.get_template(template_name, {}, _globals).get_macros(_globals)
+                if alias:
+                    imported[alias] = namespace = type(sys)(alias)
+                    namespace.__dict__.update(macros)
+                else:
+                    for name in names:
+                        if name not in macros:
+                            raise ImportError("%s: macro %r not found in %r." % (template.filename, name, template_name))
+                        imported[name] = macros[name]
+            return imported
+        finally:
+            self._exit_import(filenames)
+
+    def _enter_import(self, filename):
+        #: raise TemplateSyntaxError when '#@IMPORT' or '#@FROM' is circular.
+        global threading
+        if threading is None: import threading
+        filenames = self._importing.setdefault(threading.get_ident(), [])
+        if filename in filenames:
+            msg = "%r: circular '#@IMPORT' found." % (filename, )
+            raise TemplateSyntaxError(msg, (filenames[-1], None, None, None))
+        #: return filenames of templates importing macros in current thread.
+        filenames.append(filename)
+        return filenames
+
+    def _exit_import(self, filenames):
+        filenames.pop()
+        if not filenames:
+            self._importing.pop(threading.get_ident(), None)
+
     def include(self, template_name, append_to_buf=True, **kwargs):
         """Evaluate template using current local variables as context.
 
@@ -1903,6 +4898,10 @@ class Engine(object):
         #: get template object with context data and global vars.
         ## (context and globals are passed to get_template() only for preprocessing.)
         template = self.get_template(template_name, context, globals)
+        if self.tier_threshold:
+            self._count_render(template, globals)
+        if self.profile:
+            self._count_hit(self.to_filename(template_name))
         #: if append_to_buf is true then add output to _buf.
         #: if append_to_buf is false then don't add output to _buf.
         if append_to_buf:  _buf = locals['_buf']
@@ -1940,6 +4939,11 @@ class Engine(object):
         while True:
             ## context and globals are passed to get_template() only for preprocessing
             template = self.get_template(template_name, context, globals)
+            if self.tier_threshold:
+                self._count_render(template, globals)
+            #: count rendering of each template if profile is specified.
+            if self.profile:
+                self._count_hit(self.to_filename(template_name))
             content  = template.render(context, globals)
             layout   = context.pop('_layout', layout)
             if layout is True or layout is None:
@@ -1952,6 +4956,115 @@ class Engine(object):
         context.pop('_content', None)
         return content
 
+    def render_fragment(self, template_name, fragment_name, context=None, globals=None):
+        """Evaluate only a fragment of template and return the result.
+           Fragment is a named block ('#@BLOCK name') or capture_as() region
+           with fixed name (such as "with capture_as('sidebar'):").
+           Layout template is not used.
+
+           template_name:str
+             Filename (ex. 'user_list.pyhtml') or short name (ex. ':list') of template.
+           fragment_name:str
+             Block name or capture name.
+           context:dict (=None)
+             Context object to evaluate. If None then new dict is used.
+           globals:dict (=None)
+             Global context to evaluate. If None then globals() is used.
+        """
+        if context is None:
+            context = {}
+        if globals is None:
+            globals = sys._getframe(1).f_globals
+        self.hook_context(context)
+        template = self.get_template(template_name, context, globals)
+        #: template object restored from cache file doesn't have input, so load it again.
+        if template.input is None and fragment_name not in (template.fragments or ()):
+            template.input = self._load_template(template.filename, context, globals).input
+        return template.render_fragment(fragment_name, context, globals)
+
+    def _count_render(self, template, globals):
+        #: count rendering of template.
+        n = template._render_count = template._render_count + 1
+        if n == 1:
+            self._tier_templates[template.filename] = template
+        #: promote template to tier 2 when number of rendering reaches to threshold.
+        if n >= self.tier_threshold and template.tier == 1 \
+           and not template._promoting and template.static is None:
+            with self._tier_lock:
+                if template._promoting:
+                    return
+                template._promoting = True
+            if self.tier_background:
+                thread = threading.Thread(target=self._promote, args=(template, globals))
+                thread.daemon = True
+                thread.start()
+            else:
+                self._promote(template, globals)
+
+    def _promote(self, template, globals):
+        #: recompile template by optimizer and replace bytecode of it.
+        depends = dict(template.depends or {})
+        def include_static(template_name):
+            return self._include_static(template_name, globals, depends)
+        try:
+            ret = self.optimizer.optimize(template, globals, include_static)
+        except Exception:
+            ex = sys.exc_info()[1]
+            if logger: logger.error("[tenjin.%s] failed to optimize template (filepath=%r): %s" % (self.__class__.__name__, template.filename, ex))
+            return
+        if not ret:
+            return
+        code, passes = ret
+        if depends:
+            template.depends = depends
+        template.tier_passes = passes
+        template.bytecode = code
+        template.tier = 2
+        if logger: logger.info("[tenjin.%s] template promoted to tier 2 (filepath=%r, passes=%r)" % (self.__class__.__name__, template.filename, passes))
+
+    def _include_static(self, template_name, globals, depends):
+        #: return output of included template if it is static, else return None.
+        if self.pp:
+            return None
+        try:
+            template = self.get_template(template_name, {}, globals)
+        except TemplateNotFoundError:
+            return None
+        if template.static is None or template.trace or not template.timestamp:
+            return None
+        #: record inlined template as dependency.
+        depends[template.filename] = template.timestamp
+        return template.static
+
+    def compile_errors(self):
+        """Return dict of filepath and compile error of cached templates.
+           'hits' is number of rendering which raised cached error without compiling.
+           ex.
+             {'views/index.pyhtml': {'error': SyntaxError(...), 'hits': 120}}
+        """
+        templates = self.cache and list(self.cache.items.values()) or ()
+        return dict([ (t.filename, {'error': t.compile_error, 'hits': t.compile_error_hits})
+                      for t in templates if t.compile_error is not None ])
+
+    def tier_stats(self):
+        """Return dict of statistics about tiered compilation.
+           ex.
+             {'threshold': 100,
+              'tiers': {1: {'templates': 3, 'renders': 120},
+                        2: {'templates': 1, 'renders': 5000}},
+              'templates': {'views/index.pyhtml': {'tier': 2, 'renders': 5000,
+                                                   'passes': ['escape', 'merge']}, ...}}
+        """
+        tiers = {1: {'templates': 0, 'renders': 0}, 2: {'templates': 0, 'renders': 0}}
+        templates = {}
+        for filepath, template in list(self._tier_templates.items()):
+            d = tiers[template.tier]
+            d['templates'] += 1
+            d['renders'] += template._render_count
+            templates[filepath] = {'tier': template.tier, 'renders': template._render_count,
+                                   'passes': template.tier_passes}
+        return {'threshold': self.tier_threshold, 'tiers': tiers, 'templates': templates}
+
     def hook_context(self, context):
         #: add engine itself into context data.
         context['_engine'] = self
@@ -1960,6 +5073,41 @@ class Engine(object):
         context['include'] = self.include
 
 
+class _Flight(object):
+    #: template being converted by a thread (see Engine._single_flight()).
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.thread_id = threading.get_ident()
+        self.template = None
+        self.error = None
+
+
+def _compile_preloaded(template):
+    #: compile template and raise SyntaxError if it has syntax error.
+    #: (syntax error is ignored and kept in template object when converted.)
+    if template.compile_error is not None:
+        raise template.compile_error.with_traceback(None)
+    if not template.bytecode:
+        template.compile()
+    return template
+
+
+def _preload_templates(engine, names):
+    #: convert templates in worker process and return marshaled attributes of them.
+    storage = MarshalCacheStorage()
+    _globals = dict([ (k, getattr(helpers, k)) for k in helpers.__all__ ])
+    results = []
+    for name in names:
+        try:
+            template = _compile_preloaded(engine.get_template(name, {}, _globals))
+            results.append((name, template.filename, marshal.dumps(storage._save_data_of(template)), None))
+        except Exception:
+            ex = sys.exc_info()[1]
+            results.append((name, None, None, '%s: %s' % (ex.__class__.__name__, ex)))
+    return results
+
+
 ##
 ## safe template and engine
 ##
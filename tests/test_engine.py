@@ -6,7 +6,8 @@
 
 import pytest
 import re as _re
-import sys, os, re, time, marshal, shutil
+import sys, os, re, time, marshal, shutil, atexit, gc
+import importlib.util
 from glob import glob
 try:    import cPickle as pickle
 except: import pickle
@@ -515,6 +516,1017 @@ class TestEngine:
             _remove_files([template_name, template_name+'.cache'])
 
 
+    def test_cache_storage_bounded(self):
+        names = ['_bounded_%d.pyhtml' % i for i in range(4)]
+        try:
+            for i, name in enumerate(names):
+                write_file(name, '<p>${x}</p>\n' * (i + 1))
+            if "max_items is specified then least recently used template object is removed from memory":
+                storage = tenjin.MarshalCacheStorage(max_items=2)
+                engine = tenjin.Engine(cache=storage)
+                for name in names[:3]:
+                    engine.render(name, {'x': 1})
+                cachepath = lambda name: engine.cachename(os.path.abspath(name))
+                assert list(storage.items.keys()) == [cachepath(names[1]), cachepath(names[2])]
+                assert storage.evictions == 1
+            if "template object is got then it becomes most recently used":
+                engine.render(names[1], {'x': 1})
+                engine.render(names[3], {'x': 1})
+                assert list(storage.items.keys()) == [cachepath(names[1]), cachepath(names[3])]
+                assert storage.evictions == 2
+            if "removed template object is loaded from cache file again":
+                assert os.path.exists(names[0] + '.cache')
+                t = storage.get(cachepath(names[0]), tenjin.Template)
+                assert t is not None and t.bytecode is not None
+                assert storage.evictions == 3
+            if "max_bytes is specified then template objects are removed when total size exceeds it":
+                storage = tenjin.MemoryCacheStorage(max_bytes=1)
+                engine = tenjin.Engine(cache=storage)
+                for name in names:
+                    assert engine.render(name, {'x': 1}).startswith('<p>1</p>')
+                assert len(storage.items) == 1
+                stats = storage.stats()
+                assert stats['items'] == 1
+                assert stats['evictions'] == 3
+                assert stats['bytes'] == storage._size_of(engine.get_template(names[3]))
+                assert stats['evicted_bytes'] > 0
+            if "unset() and clear() update size of template objects":
+                storage.clear()
+                assert storage.stats()['bytes'] == 0
+            if "neither max_items nor max_bytes is specified then template objects are not removed":
+                storage = tenjin.MemoryCacheStorage()
+                engine = tenjin.Engine(cache=storage)
+                for name in names:
+                    engine.render(name, {'x': 1})
+                assert len(storage.items) == 4
+                assert storage.evictions == 0
+        finally:
+            _remove_files(['_bounded_'])
+
+
+    def test_sqlite_cache_storage(self):
+        names = ['_sqlite_a.pyhtml', '_sqlite_b.pyhtml']
+        dbpath = '_sqlite_cache#%1.sqlite3'
+        try:
+            for name in names:
+                write_file(name, '<?py #@ARGS x ?>\n<p>${x}</p>\n')
+            storage = tenjin.SqliteCacheStorage(dbpath)
+            engine = tenjin.Engine(cache=storage)
+            if "template is rendered then attributes are stored into database instead of cache file":
+                for name in names:
+                    assert engine.render(name, {'x': 1}) == '<p>1</p>\n'
+                assert not os.path.exists(names[0] + '.cache')
+                conn = storage._connect()
+                assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+                rows = conn.execute("SELECT cachepath, timestamp FROM tenjin_cache ORDER BY cachepath").fetchall()
+                assert [ r[0] for r in rows ] == [ engine.cachename(os.path.abspath(x)) for x in names ]
+                assert rows[0][1] == os.path.getmtime(names[0])
+            if "preload() loads all template objects into memory":
+                storage2 = tenjin.SqliteCacheStorage(dbpath)
+                engine2 = tenjin.Engine(cache=storage2)
+                assert storage2.preload(engine2) == 2
+                assert len(storage2.items) == 2
+                t = list(storage2.items.values())[0]
+                assert t.args == ['x'] and t.bytecode is not None
+                engine2._create_template = None   # not called
+                assert engine2.render(names[1], {'x': 2}) == '<p>2</p>\n'
+            if "templates are preloaded by engine with other template class then they are not restored":
+                class MyTemplate(tenjin.Template):
+                    pass
+                storage5 = tenjin.SqliteCacheStorage(dbpath)
+                assert storage5.preload(tenjin.Engine(cache=storage5, templateclass=MyTemplate)) == 0
+            if "template object is not in memory then it is loaded from database":
+                storage3 = tenjin.SqliteCacheStorage(dbpath)
+                t = storage3.get(engine.cachename(os.path.abspath(names[0])), tenjin.Template)
+                assert t.args == ['x']
+                assert t.render({'x': 3}) == '<p>3</p>\n'
+            if "readonly is true then database is not changed":
+                ## (dbpath which contains '#' or '%' is quoted in URI)
+                storage4 = tenjin.SqliteCacheStorage(dbpath, readonly=True)
+                assert storage4.preload(tenjin.Engine(cache=storage4)) == 2
+                storage4.set('/dummy.pyhtml.cache', tenjin.Template(None, input='<p></p>\n'))
+                assert storage4._load('/dummy.pyhtml.cache') is None
+            if "database is used from threads then each thread has its own connection":
+                import threading
+                outputs = []
+                def f(i):
+                    outputs.append(tenjin.Engine(cache=storage).render(names[i % 2], {'x': i}))
+                threads = [ threading.Thread(target=f, args=(i, )) for i in range(4) ]
+                for th in threads: th.start()
+                for th in threads: th.join()
+                assert sorted(outputs) == [ '<p>%d</p>\n' % i for i in range(4) ]
+            if "clear() removes all rows":
+                storage.clear()
+                assert storage._connect().execute("SELECT COUNT(*) FROM tenjin_cache").fetchone()[0] == 0
+        finally:
+            _remove_files(['_sqlite_'])
+
+
+    def test_bundle_cache_storage(self):
+        names = ['_bundle_a.pyhtml', '_bundle_b.pyhtml']
+        bundlepath = '_bundle_views.bundle'
+        try:
+            write_file(names[0], '<?py #@ARGS x ?>\n<p>${x}</p>\n')
+            write_file(names[1], '<footer>(c)</footer>\n')
+            if "build() writes converted and compiled templates into bundle file":
+                storage = tenjin.BundleCacheStorage(bundlepath)
+                engine = tenjin.Engine()
+                assert storage.build(engine, names) == 2
+                with open(bundlepath, 'rb') as f:
+                    assert f.read(16) == tenjin.BundleCacheStorage.magic
+            if "build() doesn't write cache files nor change cache of engine":
+                assert not os.path.exists(names[0] + '.cache')
+                assert engine.cache.items == {}
+                assert engine._filepaths == {}
+            if "templates are indexed by relative filenames":
+                storage._open()
+                assert sorted(storage._index.keys()) == ['_bundle_a.pyhtml.cache', '_bundle_b.pyhtml.cache']
+                storage.close()
+            if "template is rendered then it is loaded from bundle without converting":
+                storage = tenjin.BundleCacheStorage(bundlepath)
+                engine = tenjin.Engine(cache=storage)
+                engine._create_template = None   # not called
+                assert storage._map is None
+                assert engine.render(names[0], {'x': 1}) == '<p>1</p>\n'
+                assert len(storage._index) == 2
+                assert len(storage.items) == 1    # unmarshaled lazily
+                assert engine.render(names[1]) == '<footer>(c)</footer>\n'
+                assert storage.get(engine.cachename(os.path.abspath(names[1])), tenjin.Template).static is not None
+            if "template file is changed then it is converted again and kept only in memory":
+                time.sleep(0.01)
+                write_file(names[0], '<?py #@ARGS x ?>\n<b>${x}</b>\n')
+                os.utime(names[0], (time.time() + 1, time.time() + 1))
+                engine = tenjin.Engine(cache=storage)
+                storage.items.clear()
+                assert engine.render(names[0], {'x': 2}) == '<b>2</b>\n'
+                storage.items.clear()
+                assert storage._load(engine.cachename(os.path.abspath(names[0])))['script'].find('<p>') >= 0
+            if "bundle file built on other directory is available":
+                os.makedirs('_bundle_src/views')
+                write_file('_bundle_src/views/page.pyhtml', '<?py #@ARGS x ?>\n<i>${x}</i>\n')
+                storage = tenjin.BundleCacheStorage('_bundle_src/views.bundle')
+                storage.build(tenjin.Engine(path=['_bundle_src/views'], postfix='.pyhtml'), [':page'])
+                shutil.move('_bundle_src', '_bundle_dst')
+                storage = tenjin.BundleCacheStorage('_bundle_dst/views.bundle')
+                engine = tenjin.Engine(path=['_bundle_dst/views'], cache=storage)
+                engine._create_template = None   # not called
+                assert engine.render('page.pyhtml', {'x': 1}) == '<i>1</i>\n'
+                assert storage.path == ['_bundle_dst/views']
+            if "templates which have the same basename in other directories are not mixed up":
+                os.makedirs('_bundle_dst/views/user')
+                write_file('_bundle_dst/views/list.pyhtml', 'ROOT list\n')
+                write_file('_bundle_dst/views/user/list.pyhtml', 'USER list\n')
+                ts = time.time()
+                for fname in ['_bundle_dst/views/list.pyhtml', '_bundle_dst/views/user/list.pyhtml']:
+                    os.utime(fname, (ts, ts))
+                storage = tenjin.BundleCacheStorage('_bundle_dst/views.bundle')
+                storage.build(tenjin.Engine(path=['_bundle_dst/views']), ['list.pyhtml'])
+                storage = tenjin.BundleCacheStorage('_bundle_dst/views.bundle')
+                engine = tenjin.Engine(path=['_bundle_dst/views'], cache=storage)
+                assert engine.render('user/list.pyhtml') == 'USER list\n'
+                assert engine.render('list.pyhtml') == 'ROOT list\n'
+                cachepath = os.path.abspath('_bundle_dst/views/user/list.pyhtml.cache')
+                assert storage._load(cachepath) is None
+            if "bundle file is not found then templates are converted as usual":
+                storage = tenjin.BundleCacheStorage('_bundle_notfound.bundle')
+                assert tenjin.Engine(cache=storage).render(names[1]) == '<footer>(c)</footer>\n'
+                assert storage._index == {}
+            if "file is not a bundle file then ValueError is raised":
+                write_file('_bundle_broken.bundle', 'xxx' * 10)
+                storage = tenjin.BundleCacheStorage('_bundle_broken.bundle')
+                with pytest.raises(ValueError, match=r"not a bundle file"):
+                    storage._load('/dummy.pyhtml.cache')
+        finally:
+            for dirname in ['_bundle_src', '_bundle_dst']:
+                if os.path.isdir(dirname): shutil.rmtree(dirname)
+            _remove_files(['_bundle_'])
+
+
+    def test_cache_signature(self):
+        name = '_signature_page.pyhtml'
+        cachepath = os.path.abspath(name) + '.cache'
+        try:
+            write_file(name, '<?py #@ARGS x ?>\n<p>${x}</p>\n')
+            if "signature contains python magic number, tenjin version and hash of options":
+                sig = tenjin.Template().cache_signature()
+                magic, version, digest = sig.split('-')
+                assert magic == importlib.util.MAGIC_NUMBER.hex()
+                assert version == tenjin.__version__
+                assert tenjin.Template(indent=4).cache_signature() == sig
+                assert tenjin.Template(indent=2).cache_signature() != sig
+                assert tenjin.Template(escapefunc='h').cache_signature() != sig
+                assert tenjin.Template(smarttrim=True).cache_signature() != sig
+                assert tenjin.SafeTemplate().cache_signature() != sig
+            if "template is cached then signature is stored with template attributes":
+                storage = tenjin.MarshalCacheStorage()
+                assert tenjin.Engine(cache=storage).render(name, {'x': '<>'}) == '<p>&lt;&gt;</p>\n'
+                assert storage._load(cachepath)['signature'] == sig
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage())
+                engine._create_template = None   # not called
+                assert engine.render(name, {'x': 1}) == '<p>1</p>\n'
+            if "options are changed then cached template is converted again":
+                storage = tenjin.MarshalCacheStorage()
+                engine = tenjin.Engine(cache=storage, escapefunc='str')
+                assert engine.render(name, {'x': '<>'}) == '<p><></p>\n'
+                assert storage._load(cachepath)['signature'] == tenjin.Template(escapefunc='str').cache_signature()
+            if "cache file has no signature (or broken) then it is ignored":
+                dct = storage._load(cachepath)
+                dct.pop('signature')
+                write_file(cachepath, marshal.dumps(dct))
+                assert tenjin.MarshalCacheStorage().get(cachepath, tenjin.Template) is None
+                write_file(cachepath, b'\xff' * 10)
+                assert tenjin.MarshalCacheStorage().get(cachepath, tenjin.Template) is None
+            if "text cache file has signature in header":
+                os.unlink(cachepath)
+                storage = tenjin.TextCacheStorage()
+                tenjin.Engine(cache=storage).render(name, {'x': 1})
+                with open(cachepath) as f:
+                    assert f.read().split("\n")[1] == 'signature: ' + sig
+                assert storage._load(cachepath)['signature'] == sig
+            if "preprocessors of engine are changed then cached template is converted again":
+                write_file(name, '<div>\n  <p>${x}</p>\n</div>\n')
+                assert tenjin.Engine(cache=tenjin.MarshalCacheStorage()).render(name, {'x': 1}) == '<div>\n  <p>1</p>\n</div>\n'
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage(), pp=[tenjin.TrimPreprocessor()])
+                assert engine.render(name, {'x': 1}) == '<div>\n<p>1</p>\n</div>\n'
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage(), pp=[tenjin.TrimPreprocessor()])
+                engine._create_template = None   # not called
+                assert engine.render(name, {'x': 2}) == '<div>\n<p>2</p>\n</div>\n'
+                sig1 = engine._new_template().cache_signature()
+                assert tenjin.Engine(pp=[tenjin.TrimPreprocessor(True)])._new_template().cache_signature() != sig1
+                assert tenjin.Engine(preprocess=True)._new_template().cache_signature() not in (sig, sig1)
+                assert tenjin.Engine()._new_template().cache_signature() == sig
+        finally:
+            _remove_files(['_signature_'])
+
+
+    def test_cache_dir(self):
+        names = ['_cachedir_page.pyhtml']
+        cache_dir = '_cachedir_tmp'
+        try:
+            write_file(names[0], '<p>${x}</p>\n')
+            storage = tenjin.MarshalCacheStorage(cache_dir=cache_dir)
+            if "cache_dir is specified then cache file is created under it":
+                engine = tenjin.Engine(cache=storage)
+                assert engine.render(names[0], {'x': 1}) == '<p>1</p>\n'
+                assert not os.path.exists(names[0] + '.cache')
+                cachepath = engine.cachename(os.path.abspath(names[0]))
+                cachefile = storage.cachefile(cachepath)
+                assert os.path.isfile(cachefile)
+            if "cache file is named by hash of cache path and sharded into subdirectory":
+                import hashlib
+                digest = hashlib.sha1(cachepath.encode('utf-8')).hexdigest()
+                assert cachefile == os.path.join(cache_dir, digest[:2], digest + '-_cachedir_page.pyhtml.cache')
+            if "lang is specified then different cache file is created":
+                engine_fr = tenjin.Engine(cache=storage, lang='fr')
+                assert engine_fr.render(names[0], {'x': 2}) == '<p>2</p>\n'
+                cachefile_fr = storage.cachefile(engine_fr.cachename(os.path.abspath(names[0])))
+                assert cachefile_fr != cachefile and os.path.isfile(cachefile_fr)
+            if "cache file in cache_dir is loaded and deleted":
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage(cache_dir=cache_dir))
+                engine._create_template = None   # not called
+                assert engine.render(names[0], {'x': 3}) == '<p>3</p>\n'
+                engine.cache.unset(cachepath)
+                assert not os.path.exists(cachefile)
+            if "cache_dir is not specified then cache file is created next to template file":
+                assert tenjin.MarshalCacheStorage().cachefile(cachepath) == cachepath
+        finally:
+            _remove_files(['_cachedir_page'])
+            if os.path.isdir(cache_dir):
+                shutil.rmtree(cache_dir)
+
+
+    def test_checksum(self):
+        names = ['_checksum_page.pyhtml', '_checksum_base.pyhtml']
+        try:
+            write_file(names[1], '<html>\n<?py #@BLOCK body ?>\n<?py #@ENDBLOCK ?>\n</html>\n')
+            write_file(names[0], ('<?py #@EXTENDS _checksum_base.pyhtml ?>\n'
+                                  '<?py #@BLOCK body ?>\n<p>${x}</p>\n<?py #@ENDBLOCK ?>\n'))
+            def touch(filename, delta):
+                ts = os.path.getmtime(filename) + delta
+                os.utime(filename, (ts, ts))
+            def new_engine(checksum=True):
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage(), checksum=checksum)
+                engine._create_template = None   # raise error if called
+                return engine
+            expected = '<html>\n<p>1</p>\n</html>\n'
+            if "checksum is true then content hash of template and parent is stored into cache":
+                storage = tenjin.MarshalCacheStorage()
+                engine = tenjin.Engine(cache=storage, checksum=True)
+                assert engine.render(names[0], {'x': 1}) == expected
+                checksums = engine.get_template(names[0]).checksums
+                assert sorted(checksums.keys()) == sorted(names)
+                cachepath = engine.cachename(os.path.abspath(names[0]))
+                assert storage._load(cachepath)['checksums'] == checksums
+            if "timestamp is changed but content is not changed then cached template is used":
+                touch(names[0], 10)
+                touch(names[1], 10)
+                engine = new_engine()
+                assert engine.render(names[0], {'x': 1}) == expected
+                if "new timestamps are saved into cache":
+                    dct = storage._load(cachepath)
+                    assert dct['timestamp'] == os.path.getmtime(names[0])
+                    assert dct['depends'] == {names[1]: os.path.getmtime(names[1])}
+                    engine = new_engine()
+                    engine._refresh_by_checksums = None   # not called
+                    assert engine.render(names[0], {'x': 1}) == expected
+            if "checksum is false then template is converted again":
+                touch(names[0], 10)
+                with pytest.raises(TypeError):
+                    new_engine(False).render(names[0], {'x': 1})
+            if "content of parent template is changed then template is converted again":
+                write_file(names[1], '<body>\n<?py #@BLOCK body ?>\n<?py #@ENDBLOCK ?>\n</body>\n')
+                touch(names[1], 20)
+                with pytest.raises(TypeError):
+                    new_engine().render(names[0], {'x': 1})
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage(), checksum=True)
+                assert engine.render(names[0], {'x': 1}) == '<body>\n<p>1</p>\n</body>\n'
+        finally:
+            _remove_files(['_checksum_'])
+
+
+    def test_lean_marshal_cache_storage(self):
+        names = ['_lean_page.pyhtml', '_lean_error.pyhtml']
+        try:
+            write_file(names[0], '<?py #@ARGS x ?>\n<p>${x}</p>\n')
+            write_file(names[1], '<?py if x ?>\n<p>${x}</p>\n')
+            storage = tenjin.LeanMarshalCacheStorage()
+            engine = tenjin.Engine(cache=storage)
+            script = engine.get_template(names[0]).script
+            cachepath = engine.cachename(os.path.abspath(names[0]))
+            if "template is compiled then python script is not stored into cache file":
+                dct = storage._load(cachepath)
+                assert 'script' not in dct
+                assert dct['args'] == ['x'] and dct['bytecode'] is not None
+                lean_size = os.path.getsize(cachepath)
+                tenjin.MarshalCacheStorage().set(cachepath, engine.get_template(names[0]))
+                assert lean_size < os.path.getsize(cachepath)
+                storage.set(cachepath, engine.get_template(names[0]))
+            if "template is loaded from cache file then script is None":
+                engine = tenjin.Engine(cache=tenjin.LeanMarshalCacheStorage())
+                engine._create_template = None   # not called
+                assert engine.render(names[0], {'x': 1}) == '<p>1</p>\n'
+                assert engine.get_template(names[0]).script is None
+            if "get_script() regenerates python script without changing template object":
+                del engine._create_template
+                assert engine.get_script(names[0]) == script
+                assert engine.get_template(names[0]).script is None
+            if "template has syntax error then python script is stored":
+                with pytest.raises(SyntaxError):
+                    engine.render(names[1], {'x': 1})
+                assert 'script' in storage._load(engine.cachename(os.path.abspath(names[1])))
+        finally:
+            _remove_files(['_lean_'])
+
+
+    def test_lean(self):
+        names = ['_leanmode_a.pyhtml', '_leanmode_b.pyhtml', '_leanmode_c.pyhtml']
+        try:
+            write_file(names[0], '<?py #@ARGS x ?>\n<td>${x}</td>\n')
+            write_file(names[1], '<?py #@ARGS x ?>\n<td>#{x}</td>\n')
+            write_file(names[2], '<?py #@ARGS x ?>\n<td>${x}</td>\n')
+            if "lean mode is false then input and script are kept":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage())
+                for name in names:
+                    engine.get_template(name)
+                report = engine.memory_footprint()
+                assert report['templates'] == 3
+                assert report['input'] > 0 and report['script'] > 0 and report['bytecode'] > 0
+                assert report['shared_constants'] == 0
+                fat_total = report['total']
+            if "lean mode is true then input and script are dropped after compiled":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), lean=True)
+                for name in names:
+                    t = engine.get_template(name)
+                    assert t.input is None and t.script is None and t.bytecode is not None
+                assert engine.render(names[0], {'x': '<>'}) == '<td>&lt;&gt;</td>\n'
+                assert engine.render(names[1], {'x': '<>'}) == '<td><></td>\n'
+                report = engine.memory_footprint()
+                assert report['input'] == 0 and report['script'] == 0
+                assert report['total'] < fat_total
+            if "string constants are shared among templates":
+                def const(name, value):
+                    consts = engine.get_template(name).bytecode.co_consts
+                    return consts[consts.index(value)]
+                s = ''.join(['<t', 'd>'])   # not same object as constant
+                assert const(names[0], s) is const(names[1], s)
+                assert const(names[0], s) is not s
+                assert report['shared_constants'] > 0
+                assert report['shared_bytes_saved'] > 0
+            if "templates are removed from cache then bytes saved by them are not reported":
+                engine.cache.clear()
+                assert engine.memory_footprint()['shared_bytes_saved'] == 0
+            if "number of shared constants exceeds intern_maxitems then table is cleared":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), lean=True)
+                engine.intern_maxitems = 2
+                for name in names:
+                    engine.get_template(name)
+                    assert len(engine._constants) <= 2
+                assert engine.render(names[2], {'x': '<>'}) == '<td>&lt;&gt;</td>\n'
+            if "template is loaded from cache then script is dropped":
+                storage = tenjin.MarshalCacheStorage()
+                tenjin.Engine(cache=storage).get_template(names[0])
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage(), lean=True)
+                engine._create_template = None   # not called
+                t = engine.get_template(names[0])
+                assert t.script is None
+                del engine._create_template
+                assert engine.get_script(names[0]) is not None
+        finally:
+            _remove_files(['_leanmode_'])
+
+
+    def test_write_behind(self):
+        names = ['_writebehind_%d.pyhtml' % i for i in range(3)]
+        try:
+            for name in names:
+                write_file(name, '<p>${x}</p>\n')
+            if "write_behind is true then cache file is saved by background thread":
+                storage = tenjin.MarshalCacheStorage(write_behind=True)
+                storage.write_behind_delay = 0.5
+                engine = tenjin.Engine(cache=storage)
+                for name in names:
+                    assert engine.render(name, {'x': 1}) == '<p>1</p>\n'
+                # template object is available before cache file is saved.
+                assert not os.path.exists(names[0] + '.cache')
+                assert len(storage._pending) == 3
+                assert storage._writer.daemon is True
+            if "template is set again before saved then only last one is saved":
+                t = engine.get_template(names[0])
+                storage.set(engine.cachename(os.path.abspath(names[0])), t)
+                assert len(storage._pending) == 3
+            if "template is not in memory then pending attributes are used":
+                storage.items.clear()
+                engine._create_template = None   # not called
+                assert engine.render(names[1], {'x': 2}) == '<p>2</p>\n'
+                del engine._create_template
+            if "flush() is called then pending attributes are saved":
+                assert storage.flush() == 3
+                assert storage._pending == {}
+                for name in names:
+                    assert os.path.isfile(name + '.cache')
+                assert storage.flush() == 0
+            if "background thread saves attributes after delay":
+                for name in names:
+                    os.unlink(name + '.cache')
+                storage.write_behind_delay = 0.01
+                storage.clear()
+                engine.render(names[0], {'x': 1})
+                for _ in range(200):
+                    if os.path.isfile(names[0] + '.cache'): break
+                    time.sleep(0.01)
+                assert os.path.isfile(names[0] + '.cache')
+                assert storage._pending == {}
+            if "template is unset before saved then it is not saved":
+                os.unlink(names[0] + '.cache')
+                storage.write_behind_delay = 0.5
+                storage.clear()
+                engine.get_template(names[0])
+                storage.unset(engine.cachename(os.path.abspath(names[0])))
+                assert storage.flush() == 0
+                assert not os.path.exists(names[0] + '.cache')
+            if "template is unset while being saved then unset() waits for it":
+                import threading
+                started, resume = threading.Event(), threading.Event()
+                class SlowStorage(tenjin.MarshalCacheStorage):
+                    def _store_all(self, pairs):
+                        started.set()
+                        resume.wait(5)
+                        tenjin.MarshalCacheStorage._store_all(self, pairs)
+                storage = SlowStorage(write_behind=True)
+                storage.write_behind_delay = 0.01
+                engine = tenjin.Engine(cache=storage)
+                engine.get_template(names[0])
+                assert started.wait(5)
+                th = threading.Thread(target=storage.unset, args=(engine.cachename(os.path.abspath(names[0])), ))
+                th.start()
+                th.join(0.1)
+                assert th.is_alive()      # waits for background thread
+                resume.set()
+                th.join(5)
+                assert not th.is_alive()
+                assert not os.path.exists(names[0] + '.cache')
+            if "SqliteCacheStorage saves pending attributes in a transaction":
+                storage = tenjin.SqliteCacheStorage('_writebehind_.db', write_behind=True)
+                storage.write_behind_delay = 0.5
+                engine = tenjin.Engine(cache=storage)
+                for name in names:
+                    engine.get_template(name)
+                assert storage.flush() == 3
+                engine = tenjin.Engine(cache=tenjin.SqliteCacheStorage('_writebehind_.db'))
+                engine._create_template = None   # not called
+                assert engine.render(names[2], {'x': 3}) == '<p>3</p>\n'
+        finally:
+            _remove_files(['_writebehind_'])
+
+
+    def test_preload(self):
+        try:
+            os.mkdir('_preload_views')
+            os.mkdir('_preload_views/blog')
+            write_file('_preload_views/index.pyhtml', '<p>${x}</p>\n')
+            write_file('_preload_views/blog/post.pyhtml', '<h1>${x}</h1>\n')
+            write_file('_preload_views/broken.pyhtml', '<?py #@EXTENDS _notfound.pyhtml ?>\n')
+            write_file('_preload_views/readme.txt', 'not a template\n')
+            def new_engine():
+                return tenjin.Engine(path=['_preload_views'], postfix='.pyhtml',
+                                     cache=tenjin.MarshalCacheStorage())
+            if "patterns are not specified then all templates in path are preloaded":
+                engine = new_engine()
+                stats = engine.preload()
+                assert stats['templates'] == 3
+                assert stats['converted'] == 2
+                assert stats['cached'] == 0
+                assert list(stats['errors']) == ['broken.pyhtml']
+                assert stats['errors']['broken.pyhtml'].startswith('TemplateNotFoundError: ')
+                assert stats['elapsed'] >= 0
+                assert os.path.isfile('_preload_views/blog/post.pyhtml.cache')
+            if "templates are in cache then they are not converted again":
+                engine = new_engine()
+                stats = engine.preload(['index.pyhtml', 'blog/*.pyhtml'])
+                assert stats['templates'] == 2
+                assert stats['converted'] == 0
+                assert stats['cached'] == 2
+            if "template name is not found then it is reported as error":
+                stats = engine.preload([':index', ':notfound'])
+                assert stats['templates'] == 2
+                assert list(stats['errors']) == ['notfound.pyhtml']
+            if "workers is specified then templates are converted in worker processes":
+                _remove_files(['_preload_views/*.cache', '_preload_views/blog/*.cache'])
+                engine = new_engine()
+                stats = engine.preload(['**/*.pyhtml'], workers=2)
+                assert stats['workers'] == 2
+                assert stats['converted'] == 2
+                assert list(stats['errors']) == ['broken.pyhtml']
+                assert os.path.isfile('_preload_views/index.pyhtml.cache')
+                # preloaded templates are rendered without converting.
+                engine._create_template = None   # not called
+                assert engine.render(':index', {'x': '<>'}) == '<p>&lt;&gt;</p>\n'
+                assert engine.render('blog/post.pyhtml', {'x': 1}) == '<h1>1</h1>\n'
+            if "template has syntax error then it is reported as error":
+                write_file('_preload_views/syntax.pyhtml', '<?py if ?>\n')
+                engine = new_engine()
+                stats = engine.preload(['syntax.pyhtml', 'index.pyhtml'])
+                assert stats['converted'] == 0 and stats['cached'] == 1
+                assert list(stats['errors']) == ['syntax.pyhtml']
+                assert stats['errors']['syntax.pyhtml'].startswith('SyntaxError: ')
+                stats = engine.preload(['syntax.pyhtml'])
+                assert stats['cached'] == 0 and list(stats['errors']) == ['syntax.pyhtml']
+                engine = tenjin.Engine(path=['_preload_views'], cache=tenjin.MemoryCacheStorage())
+                stats = engine.preload(['syntax.pyhtml', 'index.pyhtml'], workers=2)
+                assert stats['converted'] == 1
+                assert list(stats['errors']) == ['syntax.pyhtml']
+                assert stats['errors']['syntax.pyhtml'].startswith('SyntaxError: ')
+                os.unlink('_preload_views/syntax.pyhtml')
+            if "engine is pickled then only configuration is copied":
+                import pickle
+                engine = tenjin.Engine(path=['_preload_views'], postfix='.pyhtml', lean=True,
+                                       single_flight=True, escapefunc='escape', cache=tenjin.MemoryCacheStorage())
+                engine.get_template(':index')
+                copied = pickle.loads(pickle.dumps(engine))
+                assert copied.path == ['_preload_views'] and copied.postfix == '.pyhtml'
+                assert copied.lean is True and copied.kwargs == {'escapefunc': 'escape'}
+                assert copied.cache is None and copied._filepaths == {}
+                assert copied.single_flight is None and copied._flights_lock is None
+                assert copied.render(':index', {'x': '<>'}) == '<p>&lt;&gt;</p>\n'
+        finally:
+            shutil.rmtree('_preload_views', ignore_errors=True)
+
+
+    def test_preload_profile(self):
+        names = ['_profile_a.pyhtml', '_profile_b.pyhtml', '_profile_c.pyhtml']
+        try:
+            for name in names:
+                write_file(name, '<p>${x}</p>\n')
+            if "profile is specified then number of rendering is counted":
+                engine = tenjin.Engine(postfix='.pyhtml', profile='_profile.txt', cache=False)
+                for i in range(3):
+                    engine.render(':_profile_c', {'x': i})
+                engine.render(names[1], {'x': 1})
+                assert engine._hits == {'_profile_c.pyhtml': 3, '_profile_b.pyhtml': 1}
+            if "save_profile() saves number of rendering in descending order":
+                engine.save_profile()
+                atexit.unregister(engine.save_profile)   # registered at first rendering
+                assert read_file('_profile.txt', 'r') == '3 _profile_c.pyhtml\n1 _profile_b.pyhtml\n'
+                assert engine.load_profile('_profile.txt') == engine._hits
+                assert engine.load_profile('_profile_notfound.txt') == {}
+            if "profile exists then preload() converts templates in descending order":
+                engine = tenjin.Engine(profile='_profile.txt', cache=tenjin.MemoryCacheStorage())
+                converted = []
+                load_template = engine._load_template
+                def _load_template(filepath, *args):
+                    converted.append(filepath)
+                    return load_template(filepath, *args)
+                engine._load_template = _load_template
+                stats = engine.preload(['_profile_*.pyhtml'])
+                assert converted == ['_profile_c.pyhtml', '_profile_b.pyhtml', '_profile_a.pyhtml']
+                assert stats['converted'] == 3 and stats['skipped'] == 0
+                # preload() doesn't count rendering.
+                assert engine._hits is None
+            if "profile is passed as dict then it is used instead of file":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage())
+                engine._load_template = _load_template
+                converted[:] = []
+                engine.preload(['_profile_*.pyhtml'], profile={'_profile_b.pyhtml': 5})
+                assert converted[0] == '_profile_b.pyhtml'
+            if "budget is exceeded then remained templates are skipped":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage())
+                stats = engine.preload(['_profile_*.pyhtml'], budget=0)
+                assert stats['converted'] == 0
+                assert stats['skipped'] == 3
+        finally:
+            _remove_files(['_profile'])
+
+
+    def test_single_flight(self):
+        import threading
+        filename = '_singleflight.pyhtml'
+        def concurrent_requests(engine, n=8):
+            # count conversion of template by concurrent requests.
+            converted = []
+            load_template = engine._load_template
+            def _load_template(*args):
+                converted.append(threading.get_ident())
+                time.sleep(0.05)   # slow conversion
+                return load_template(*args)
+            engine._load_template = _load_template
+            barrier = threading.Barrier(n)
+            results = []
+            def request():
+                barrier.wait()
+                try:
+                    results.append(engine.get_template(filename))
+                except Exception:
+                    results.append(sys.exc_info()[1])
+            threads = [ threading.Thread(target=request) for _ in range(n) ]
+            for t in threads: t.start()
+            for t in threads: t.join()
+            del engine._load_template
+            return converted, results
+        try:
+            write_file(filename, '<p>${x}</p>\n')
+            if "single_flight is not specified then template is converted by all threads":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage())
+                converted, results = concurrent_requests(engine)
+                assert len(converted) > 1
+            if "single_flight is true then template is converted by only a thread":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), single_flight=True)
+                converted, results = concurrent_requests(engine)
+                assert len(converted) == 1
+                assert len(results) == 8
+                assert all([ t is results[0] for t in results ])
+                assert engine.single_flight_waits == 7
+                assert engine._flights == {}
+            if "single_flight is 'stale' then expired template is used while converting":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), single_flight='stale')
+                stale = engine.get_template(filename)
+                ts = time.time() + 1
+                os.utime(filename, (ts, ts))
+                stale._last_checked_at = None
+                converted, results = concurrent_requests(engine)
+                assert len(converted) == 1
+                fresh = [ t for t in results if t is not stale ]
+                assert len(fresh) == 1
+                assert len(results) - len(fresh) == 7
+                assert engine.get_template(filename) is fresh[0]
+            if "template has been converted by other thread then it is not converted again":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), single_flight=True)
+                t = engine.get_template(filename)
+                engine._load_template = None   # not called
+                cachepath = engine.cachename(os.path.abspath(filename))
+                assert engine._single_flight(cachepath, filename, None, None) is t
+                del engine._load_template
+            if "conversion is failed then waiting threads raise the same error without converting":
+                write_file(filename, '<?py #@EXTENDS _singleflight_notfound.pyhtml ?>\n')
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), single_flight=True)
+                converted, results = concurrent_requests(engine)
+                assert len(converted) == 1
+                assert len(results) == 8
+                assert all([ isinstance(ex, tenjin.TemplateNotFoundError) for ex in results ])
+                assert engine._flights == {}
+            if "conversion is failed then error is raised and next request converts template again":
+                write_file(filename, '<?py #@EXTENDS _singleflight_notfound.pyhtml ?>\n')
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), single_flight=True)
+                with pytest.raises(tenjin.TemplateNotFoundError):
+                    engine.get_template(filename)
+                assert engine._flights == {}
+                write_file(filename, '<p>${x}</p>\n')
+                assert engine.render(filename, {'x': 1}) == '<p>1</p>\n'
+        finally:
+            _remove_files(['_singleflight'])
+
+
+    def test_stale_while_revalidate(self):
+        filename = '_revalidate.pyhtml'
+        def touch(content):
+            write_file(filename, content)
+            ts = time.time() + touch.count
+            touch.count += 10
+            os.utime(filename, (ts, ts))
+        touch.count = 10
+        def wait_for(func):
+            for _ in range(200):
+                if func(): break
+                time.sleep(0.01)
+            return func()
+        try:
+            write_file(filename, '<p>${x}</p>\n')
+            engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), stale_while_revalidate=True)
+            cachepath = engine.cachename(os.path.abspath(filename))
+            stale = engine.get_template(filename)
+            if "template file is changed then previous template object is returned":
+                touch('<div>${x}</div>\n')
+                stale._last_checked_at = None
+                assert engine.get_template(filename) is stale
+                assert engine.render(filename, {'x': 1}) == '<p>1</p>\n'
+            if "changed template is converted in background and replaced":
+                assert wait_for(lambda: engine.cache.items[cachepath] is not stale)
+                assert engine.render(filename, {'x': 1}) == '<div>1</div>\n'
+                assert engine._revalidating == set()
+            if "failed to convert changed template then error is logged and previous one is used":
+                stale = engine.get_template(filename)
+                touch('<?py y = = 1 ?>\n<p>${x}</p>\n')   # syntax error
+                stale._last_checked_at = None
+                tenjin.logger = DebugLogger()
+                try:
+                    assert engine.get_template(filename) is stale
+                    assert wait_for(lambda: not engine._revalidating)
+                    assert engine.cache.items[cachepath] is stale
+                    assert engine.render(filename, {'x': 1}) == '<div>1</div>\n'
+                    msgs = [ m for m in tenjin.logger.messages if 'failed to reload' in m ]
+                    assert len(msgs) == 1
+                    assert msgs[0].startswith("[ERROR] [tenjin.Engine] failed to reload template (filepath='_revalidate.pyhtml'): SyntaxError: ")
+                finally:
+                    tenjin.logger = None
+        finally:
+            _remove_files(['_revalidate'])
+
+
+    def test_freeze(self):
+        import signal
+        filename = '_freeze.pyhtml'
+        try:
+            write_file(filename, '<p>${x}</p>\n')
+            if "production is true then engine is frozen":
+                engine = tenjin.Engine(postfix='.pyhtml', production=True)
+                assert engine._frozen == {}
+                assert tenjin.Engine()._frozen is None
+            if "engine is frozen then template object is returned by a dict lookup":
+                t = engine.get_template(':_freeze')
+                assert engine._frozen == {':_freeze': t}
+                engine.to_filename = None   # not called
+                engine.cache = None         # not used
+                assert engine.get_template(':_freeze') is t
+                assert engine.render(':_freeze', {'x': 1}) == '<p>1</p>\n'
+                del engine.to_filename, engine.cache
+            if "template file is changed then frozen template object is still used":
+                write_file(filename, '<div>${x}</div>\n')
+                ts = time.time() + 10
+                os.utime(filename, (ts, ts))
+                t._last_checked_at = None
+                assert engine.get_template(':_freeze') is t
+            if "reload() is called then changed template is converted again":
+                assert engine.reload() == 1
+                assert engine.get_template(':_freeze') is not t
+                assert engine.render(':_freeze', {'x': 1}) == '<div>1</div>\n'
+            if "frozen template objects are used by other threads while reloading":
+                template = engine.get_template(':_freeze')
+                load_template = engine._load_template
+                requested = []
+                def _load_template(*args):
+                    # other thread requests templates while reloading
+                    if not requested:
+                        requested.append(engine.get_template(':_freeze'))
+                        write_file('_freeze_new.pyhtml', '<i>${x}</i>\n')
+                        engine.get_template(':_freeze_new')
+                    return load_template(*args)
+                engine._load_template = _load_template
+                write_file(filename, '<div>${x}</div>\n')
+                ts = time.time() + 20
+                os.utime(filename, (ts, ts))
+                try:
+                    assert engine.reload() == 1
+                finally:
+                    del engine._load_template
+                assert requested == [template]
+                assert engine.get_template(':_freeze') is not template
+                if "templates requested at first time while reloading are kept":
+                    assert ':_freeze_new' in engine._frozen
+                    engine._frozen.pop(':_freeze_new')
+            if "template file is removed then it is not reloaded and error is logged":
+                os.unlink(filename)
+                tenjin.logger = DebugLogger()
+                try:
+                    assert engine.reload() == 0
+                    assert tenjin.logger.messages[0].startswith("[ERROR] [tenjin.Engine] failed to reload template (template_name=':_freeze'): ")
+                finally:
+                    tenjin.logger = None
+                with pytest.raises(OSError):
+                    engine.get_template(':_freeze')
+            if "reload_signal is specified then reload() is called by signal":
+                write_file(filename, '<p>${x}</p>\n')
+                engine = tenjin.Engine(postfix='.pyhtml')
+                import threading
+                called = []
+                engine._reload = lambda _globals: called.append(threading.current_thread())
+                orig = signal.getsignal(signal.SIGUSR1)
+                try:
+                    assert engine.freeze(reload_signal=signal.SIGUSR1) is engine
+                    os.kill(os.getpid(), signal.SIGUSR1)
+                    for _ in range(100):
+                        if called: break
+                        time.sleep(0.01)
+                    assert len(called) == 1
+                    # (templates are reloaded in background thread, not in signal handler)
+                    assert called[0] is not threading.main_thread()
+                finally:
+                    signal.signal(signal.SIGUSR1, orig)
+        finally:
+            _remove_files(['_freeze'])
+
+
+    def test_watch(self):
+        os.mkdir('_watch_views')
+        try:
+            write_file('_watch_views/_layout.pyhtml', '<html>\n<?py #@BLOCK body ?>\n<?py #@ENDBLOCK ?>\n</html>\n')
+            write_file('_watch_views/page.pyhtml', ('<?py #@EXTENDS _layout.pyhtml ?>\n'
+                                                    '<?py #@BLOCK body ?>\n<p>${x}</p>\n<?py #@ENDBLOCK ?>\n'))
+            engine = tenjin.Engine(path=['_watch_views'], cache=tenjin.MemoryCacheStorage(), watch='poll')
+            engine.watcher.interval = 0.02
+            try:
+                assert engine.watcher.backend == 'poll'
+                t = engine.get_template('page.pyhtml')
+                if "template files are watched then timestamp of them are not checked":
+                    engine.loader.timestamp = None   # not called
+                    t._last_checked_at = time.time() - 10
+                    assert engine.get_template('page.pyhtml') is t
+                    del engine.loader.timestamp
+                if "template file is changed then template object is checked at next request":
+                    write_file('_watch_views/page.pyhtml', ('<?py #@EXTENDS _layout.pyhtml ?>\n'
+                                                            '<?py #@BLOCK body ?>\n<div>${x}</div>\n<?py #@ENDBLOCK ?>\n'))
+                    ts = time.time() + 10
+                    os.utime('_watch_views/page.pyhtml', (ts, ts))
+                    for _ in range(300):
+                        if t._last_checked_at is None: break
+                        time.sleep(0.01)
+                    assert t._last_checked_at is None
+                    t = engine.get_template('page.pyhtml')
+                    assert t.render({'x': 1}) == '<html>\n<div>1</div>\n</html>\n'
+                if "parent template is changed then child template is checked as well":
+                    write_file('_watch_views/_layout.pyhtml', '<body>\n<?py #@BLOCK body ?>\n<?py #@ENDBLOCK ?>\n</body>\n')
+                    os.utime('_watch_views/_layout.pyhtml', (ts, ts))
+                    for _ in range(300):
+                        if t._last_checked_at is None: break
+                        time.sleep(0.01)
+                    assert t._last_checked_at is None
+                    assert engine.get_template('page.pyhtml').render({'x': 1}) == '<body>\n<div>1</div>\n</body>\n'
+                if "watcher is stopped then timestamp of template files are checked again":
+                    engine.watcher.stop()
+                    t = engine.get_template('page.pyhtml')
+                    t._last_checked_at = time.time() - 10
+                    engine.get_template('page.pyhtml')
+                    assert t._last_checked_at > time.time() - 1
+                if "close() stops watcher":
+                    engine = tenjin.Engine(path=['_watch_views'], cache=tenjin.MemoryCacheStorage(), watch='poll')
+                    watcher = engine.watcher
+                    assert watcher.is_alive()
+                    engine.close()
+                    assert engine.watcher is None
+                    assert not watcher.is_alive()
+                if "engine is garbage-collected then watcher is stopped":
+                    engine = tenjin.Engine(path=['_watch_views'], cache=tenjin.MemoryCacheStorage(), watch='poll')
+                    watcher = engine.watcher
+                    import weakref
+                    ref = weakref.ref(engine)
+                    engine = None
+                    gc.collect()
+                    assert ref() is None
+                    assert not watcher.is_alive()
+                if "path is not specified then watch option raises ValueError":
+                    with pytest.raises(ValueError, match="'watch' option requires 'path' option."):
+                        tenjin.Engine(watch=True)
+            finally:
+                if engine is not None:
+                    engine.close()
+        finally:
+            shutil.rmtree('_watch_views', ignore_errors=True)
+
+
+    def test_dependency_graph(self):
+        try:
+            os.mkdir('_deps_views')
+            write_file('_deps_views/page.pyhtml', ("<?py _context['_layout'] = ':_layout' ?>\n"
+                                                   "<?py for x in items: ?>\n"
+                                                   "<?py include(':_row', x=x) ?>\n"
+                                                   "<?py #endfor ?>\n"
+                                                   "<?py include(name) ?>\n"))
+            write_file('_deps_views/_layout.pyhtml', '<html>#{_content}</html>\n')
+            write_file('_deps_views/_row.pyhtml', "<p>it's \\</p>\n<?py include('_cell.pyhtml') ?>\n")
+            write_file('_deps_views/_cell.pyhtml', '<td>${x}</td>\n<p>include("_footer.pyhtml")</p>\n')
+            def new_engine(**kwargs):
+                return tenjin.Engine(path=['_deps_views'], postfix='.pyhtml',
+                                     cache=tenjin.MarshalCacheStorage(), **kwargs)
+            if "template is converted then included and layout templates are recorded":
+                engine = new_engine()
+                t = engine.get_template(':page')
+                assert t.references == [['layout', ':_layout'], ['include', ':_row']]
+                assert engine.get_template(':_row').references == [['include', '_cell.pyhtml']]
+            if "plain text which looks like include() is not recorded":
+                assert engine.get_template(':_cell').references is None
+            if "template is loaded from cache then references are restored":
+                engine = new_engine()
+                engine._create_template = None   # not called
+                assert engine.get_template(':page').references == [['layout', ':_layout'], ['include', ':_row']]
+                del engine._create_template
+            if "dependencies() returns kind, name and filepath of referenced templates":
+                assert engine.dependencies(':page') == [
+                    ['layout', ':_layout', '_deps_views/_layout.pyhtml'],
+                    ['include', ':_row', '_deps_views/_row.pyhtml'],
+                ]
+            if "dependency_graph() returns dependencies of templates recursively":
+                graph = engine.dependency_graph([':page'])
+                assert list(graph) == ['_deps_views/page.pyhtml', '_deps_views/_layout.pyhtml',
+                                       '_deps_views/_row.pyhtml', '_deps_views/_cell.pyhtml']
+                assert graph['_deps_views/_row.pyhtml'] == [['include', '_cell.pyhtml', '_deps_views/_cell.pyhtml']]
+                assert graph['_deps_views/_cell.pyhtml'] == []
+            if "prefetch is true then referenced templates are loaded with template":
+                engine = new_engine(prefetch=True)
+                engine.get_template(':page')
+                names = sorted([ os.path.basename(t.filename) for t in engine.cache.items.values() ])
+                assert names == ['_cell.pyhtml', '_layout.pyhtml', '_row.pyhtml', 'page.pyhtml']
+                assert all([ t.bytecode is not None for t in engine.cache.items.values() ])
+            if "template file is changed then templates depending on it are invalidated transitively":
+                for t in engine.cache.items.values():
+                    t._last_checked_at = time.time()
+                assert engine.invalidate('_deps_views/_cell.pyhtml') == 3
+                checked = sorted([ os.path.basename(t.filename) for t in engine.cache.items.values()
+                                   if t._last_checked_at is None ])
+                assert checked == ['_cell.pyhtml', '_row.pyhtml', 'page.pyhtml']
+                assert engine.invalidate('_deps_views/_layout.pyhtml') == 2
+                assert engine.invalidate(None) == 4
+            if "context data is passed to preprocess prefetched templates":
+                write_file('_deps_views/_pp_page.pyhtml', "<?py include(':_pp_part') ?>\n")
+                write_file('_deps_views/_pp_part.pyhtml', "<p>#{{label}}</p>\n")
+                engine = tenjin.Engine(path=['_deps_views'], postfix='.pyhtml', preprocess=True,
+                                       prefetch=True, cache=tenjin.MemoryCacheStorage())
+                engine.get_template(':_pp_page', {'label': 'Hello'})
+                assert 'Hello' in engine.get_template(':_pp_part').script
+        finally:
+            shutil.rmtree('_deps_views', ignore_errors=True)
+
+
+    def test_pyc_cache_storage(self):
+        import py_compile
+        name = '_pyc_page.pyhtml'
+        cachepath = os.path.abspath(name) + '.cache'
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            write_file(name, '<?py #@ARGS x ?>\n<p>${x}</p>\n')
+            storage = tenjin.PycCacheStorage()
+            pycpath = storage.pycpath(cachepath)
+            assert pycpath == os.path.join(os.getcwd(), '__pycache__', '_pyc_page.pyhtml.%s.pyc' % sys.implementation.cache_tag)
+            if "template is rendered then it is stored into '__pycache__/*.pyc' file":
+                assert tenjin.Engine(cache=storage).render(name, {'x': 1}) == '<p>1</p>\n'
+                assert not os.path.exists(name + '.cache')
+                with open(pycpath, 'rb') as f:
+                    header = f.read(16)
+                assert header[:4] == importlib.util.MAGIC_NUMBER
+                assert header[4:8] == b'\0\0\0\0'    # timestamp-based
+                assert header[8:12] == int(os.path.getmtime(name)).to_bytes(4, 'little')
+            if "'*.pyc' file is valid then template is loaded from it without converting":
+                engine = tenjin.Engine(cache=tenjin.PycCacheStorage())
+                engine._create_template = None   # not called
+                assert engine.render(name, {'x': 2}) == '<p>2</p>\n'
+                t = engine.get_template(name)
+                assert t.args == ['x'] and t.timestamp == os.path.getmtime(name)
+            if "template file is changed then '*.pyc' file is ignored":
+                ts = os.path.getmtime(name)
+                write_file(name, '<?py #@ARGS x ?>\n<b>${x}</b>\n')
+                os.utime(name, (ts + 2, ts + 2))
+                assert tenjin.PycCacheStorage()._load(cachepath) is None
+            if "invalidation mode is checked hash then '*.pyc' is validated by source hash":
+                storage = tenjin.PycCacheStorage(py_compile.PycInvalidationMode.CHECKED_HASH)
+                assert tenjin.Engine(cache=storage).render(name, {'x': 3}) == '<b>3</b>\n'
+                with open(pycpath, 'rb') as f:
+                    assert f.read(8)[4:] == b'\3\0\0\0'
+                assert storage._load(cachepath)['args'] == ['x']
+                ts = os.path.getmtime(name)
+                write_file(name, '<?py #@ARGS x ?>\n<i>${x}</i>\n')
+                os.utime(name, (ts, ts))
+                assert storage._load(cachepath) is None
+            if "'python -B' is specified then '*.pyc' file is not written":
+                storage.unset(cachepath)
+                assert not os.path.exists(pycpath)
+                sys.dont_write_bytecode = True
+                assert tenjin.Engine(cache=storage).render(name, {'x': 4}) == '<i>4</i>\n'
+                assert not os.path.exists(pycpath)
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+            _remove_files(['_pyc_', '__pycache__/_pyc_'])
+            if os.path.isdir('__pycache__') and not os.listdir('__pycache__'):
+                os.rmdir('__pycache__')
+
+
     def test_change_layout(self):
         data = TestEngine._testdata['test_change_layout']
         ## setup
@@ -1059,5 +2071,373 @@ function _EF(c){return _ET[c];};</script>
         finally:
             for x in glob(fname + '*'): os.unlink(x)
 
+    def test_extends_blocks(self):
+        parent = (
+            '<?py #@ARGS title ?>\n'
+            '<html>\n'
+            '<title><?py #@BLOCK title ?>{=title=}<?py #@ENDBLOCK ?></title>\n'
+            '<body>\n'
+            '  <?py #@BLOCK content ?>\n'
+            '  <p>default content</p>\n'
+            '  <?py #@BLOCK footer ?>\n'
+            '  <p>default footer</p>\n'
+            '  <?py #@ENDBLOCK footer ?>\n'
+            '  <?py #@ENDBLOCK ?>\n'
+            '</body>\n'
+            '</html>\n'
+            )
+        child = (
+            '<?py #@EXTENDS _blocks_parent.pyhtml ?>\n'
+            '<?py #@ARGS items ?>\n'
+            'this text is ignored.\n'
+            '<?py #@BLOCK content ?>\n'
+            '<ul>\n'
+            '<?py for item in items: ?>\n'
+            '  <li>{=item=}</li>\n'
+            '<?py #endfor ?>\n'
+            '</ul>\n'
+            '<?py #@ENDBLOCK ?>\n'
+            '<?py #@BLOCK unused ?>\n'
+            '<?py raise Exception("never executed") ?>\n'
+            '<?py #@ENDBLOCK ?>\n'
+            )
+        expected = (
+            '<html>\n'
+            '<title>Blocks</title>\n'
+            '<body>\n'
+            '<ul>\n'
+            '  <li>A&amp;B</li>\n'
+            '</ul>\n'
+            '</body>\n'
+            '</html>\n'
+            )
+        try:
+            write_file('_blocks_parent.pyhtml', parent)
+            write_file('_blocks_child.pyhtml', child)
+            context = {'title': 'Blocks', 'items': ['A&B']}
+            engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage())
+            if "child extends parent then blocks are overrided statically":
+                t = engine.get_template('_blocks_child.pyhtml')
+                assert t.args == ['items', 'title']
+                assert 'never executed' not in t.script
+                assert engine.render('_blocks_child.pyhtml', context) == expected
+            if "parent is rendered alone then default contents are rendered":
+                output = engine.render('_blocks_parent.pyhtml', context)
+                assert output == expected.replace('<ul>\n  <li>A&amp;B</li>\n</ul>\n',
+                                                  '  <p>default content</p>\n  <p>default footer</p>\n')
+            if "timestamps of parent templates are recorded":
+                assert t.depends == {'_blocks_parent.pyhtml': os.path.getmtime('_blocks_parent.pyhtml')}
+            if "parent template is changed then child template is reconverted":
+                t._last_checked_at = None
+                write_file('_blocks_parent.pyhtml', parent.replace('<html>', '<html lang="en">'))
+                ts = os.path.getmtime('_blocks_parent.pyhtml') + 1
+                os.utime('_blocks_parent.pyhtml', (ts, ts))
+                output = engine.render('_blocks_child.pyhtml', context)
+                assert output == expected.replace('<html>', '<html lang="en">')
+            if "error is raised in expanded template then filename and line number of template file are reported":
+                write_file('_blocks_parent_err.pyhtml', ('<html>\n'
+                                                         '<body>\n'
+                                                         '<?py #@BLOCK content ?>\n'
+                                                         '<?py #@ENDBLOCK ?>\n'
+                                                         '<p>${undefined_in_parent}</p>\n'
+                                                         '</body>\n'
+                                                         '</html>\n'))
+                child_err = ('<?py #@EXTENDS _blocks_parent_err.pyhtml ?>\n'
+                             '<?py #@BLOCK content ?>\n'
+                             '<p>ok</p>\n'
+                             '<p>${undefined_in_child}</p>\n'
+                             '<?py #@ENDBLOCK ?>\n')
+                write_file('_blocks_child_err.pyhtml', child_err)
+                engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage())
+                t = engine.get_template('_blocks_child_err.pyhtml')
+                lineno = lambda s: t.script[:t.script.index(s)].count('\n') + 1
+                assert t.source_location(lineno('undefined_in_child')) == ('_blocks_child_err.pyhtml', 4)
+                assert t.source_location(lineno('undefined_in_parent')) == ('_blocks_parent_err.pyhtml', 5)
+                assert t.source_location(lineno('</html>')) == ('_blocks_parent_err.pyhtml', 7)
+                with pytest.raises(NameError) as exc_info:
+                    engine.render('_blocks_child_err.pyhtml', {'undefined_in_child': 1})
+                if sys.version_info >= (3, 11):
+                    assert exc_info.value.__notes__ == ['  (File "_blocks_parent_err.pyhtml", line 5 in template)']
+            if "expanded template is restored from cache then line map is restored":
+                t2 = tenjin.Engine(cache=tenjin.MarshalCacheStorage()).get_template('_blocks_child_err.pyhtml')
+                assert t2.script is not None and t2.line_map == t.line_map
+            if "expanded template has syntax error then filename and line number of template file are reported":
+                write_file('_blocks_child_err.pyhtml', child_err.replace('<p>ok</p>', '<?py if ?>'))
+                engine = tenjin.Engine(cache=False)
+                with pytest.raises(SyntaxError) as exc_info:
+                    engine.render('_blocks_child_err.pyhtml', {})
+                assert (exc_info.value.filename, exc_info.value.lineno) == ('_blocks_child_err.pyhtml', 3)
+            if "'#@BLOCK' is not closed then raises TemplateSyntaxError":
+                write_file('_blocks_child.pyhtml', child.replace('</ul>\n<?py #@ENDBLOCK ?>\n', '</ul>\n'))
+                def f(): tenjin.Engine(cache=False).get_template('_blocks_child.pyhtml')
+                with pytest.raises(tenjin.TemplateSyntaxError, match="'#@BLOCK content' is not closed."): f()
+        finally:
+            _remove_files(['_blocks_parent', '_blocks_child'])
+
+    def test_render_fragment(self):
+        input = (
+            '<?py #@ARGS user, items ?>\n'
+            '<?py title = "Items of " + user ?>\n'
+            '<?py unused = _context["never_called"]() ?>\n'
+            '<?py count = len(items) ?>\n'
+            '<h1>{=title=}</h1>\n'
+            '<div id="list">\n'
+            '  <?py #@BLOCK list ?>\n'
+            '  <p>{=count=} items</p>\n'
+            '  <ul>\n'
+            '  <?py for item in items: ?>\n'
+            '    <?py #@BLOCK row ?>\n'
+            '    <li>{=item=}</li>\n'
+            '    <?py #@ENDBLOCK ?>\n'
+            '  <?py #endfor ?>\n'
+            '  </ul>\n'
+            '  <?py #@ENDBLOCK ?>\n'
+            '</div>\n'
+            '<?py with capture_as("sidebar"): ?>\n'
+            '<p>{=title=}</p>\n'
+            '<?py #endwith ?>\n'
+            )
+        fname = '_fragment.pyhtml'
+        try:
+            write_file(fname, input)
+            context = {'user': 'Haruhi', 'items': ['A', '<B>'], 'never_called': None}
+            engine = tenjin.Engine(cache=tenjin.MarshalCacheStorage())
+            if "named block is specified then renders only the block and statements it depends on":
+                output = engine.render_fragment(fname, 'list', dict(context))
+                assert output == ('  <p>2 items</p>\n'
+                                  '  <ul>\n'
+                                  '    <li>A</li>\n'
+                                  '    <li>&lt;B&gt;</li>\n'
+                                  '  </ul>\n')
+                script = engine.get_template(fname).convert_fragment('list')
+                assert 'never_called' not in script
+                assert 'title' not in script
+            if "fragment is in for-loop then loop variable should be passed by context":
+                output = engine.render_fragment(fname, 'row', {'item': 'C'})
+                assert output == '    <li>C</li>\n'
+            if "capture_as() region is specified then renders only captured content":
+                output = engine.render_fragment(fname, 'sidebar', dict(context))
+                assert output == '<p>Items of Haruhi</p>\n'
+            if "template is restored from cache file then loads template file again":
+                engine2 = tenjin.Engine(cache=tenjin.MarshalCacheStorage())
+                assert engine2.get_template(fname).input is None
+                output = engine2.render_fragment(fname, 'sidebar', dict(context))
+                assert output == '<p>Items of Haruhi</p>\n'
+            if "fragment not found then raises ValueError":
+                def f(): engine.render_fragment(fname, 'footer', dict(context))
+                with pytest.raises(ValueError, match=_re.escape("_fragment.pyhtml: fragment 'footer' not found.")): f()
+        finally:
+            _remove_files(['_fragment'])
+
+    def test_import_macros(self):
+        components = (
+            '<?py #@MACRO card(title) ?>\n'
+            '<div class="card">${title}</div>\n'
+            '<?py #@ENDMACRO ?>\n'
+            '<?py #@MACRO badge(label) ?>\n'
+            '<span>${label}</span>\n'
+            '<?py #@ENDMACRO ?>\n'
+            )
+        page = (
+            '<?py #@ARGS title ?>\n'
+            '<?py #@FROM _macro_ui.pyhtml IMPORT card ?>\n'
+            '<?py #@IMPORT _macro_ui.pyhtml as ui ?>\n'
+            '<?py card(title, _buf=_buf) ?>\n'
+            '<p>#{ui.badge("new")}</p>\n'
+            )
+        try:
+            write_file('_macro_ui.pyhtml', components)
+            write_file('_macro_page.pyhtml', page)
+            engine = tenjin.Engine()
+            if "'#@FROM' or '#@IMPORT' is found then imports macros of other template":
+                output = engine.render('_macro_page.pyhtml', {'title': '<Hello>'})
+                assert output == ('<div class="card">&lt;Hello&gt;</div>\n'
+                                  '<p><span>new</span>\n</p>\n')
+            if "imported template is recorded as dependency":
+                t = engine.get_template('_macro_page.pyhtml')
+                assert list(t.depends.keys()) == ['_macro_ui.pyhtml']
+                assert t.imports == [['_macro_ui.pyhtml', None, ['card']],
+                                     ['_macro_ui.pyhtml', 'ui', None]]
+            if "macros are resolved only once per template object":
+                imported = t._imported
+                engine.render('_macro_page.pyhtml', {'title': 'x'})
+                assert engine.get_template('_macro_page.pyhtml')._imported is imported
+            if "imported template is changed then importing template is reloaded":
+                time.sleep(0.01)
+                write_file('_macro_ui.pyhtml', components.replace('"card"', '"box"'))
+                future = time.time() + 1
+                os.utime('_macro_ui.pyhtml', (future, future))
+                t._last_checked_at = None
+                engine.get_template('_macro_ui.pyhtml')._last_checked_at = None
+                output = engine.render('_macro_page.pyhtml', {'title': 'x'})
+                assert output.startswith('<div class="box">x</div>\n')
+            if "imported macro is not found then raises ImportError":
+                write_file('_macro_page.pyhtml', page.replace('IMPORT card', 'IMPORT cart'))
+                def f(): tenjin.Engine(cache=False).render('_macro_page.pyhtml', {'title': 'x'})
+                with pytest.raises(ImportError, match="macro 'cart' not found"): f()
+            if "'#@IMPORT' is circular then raises TemplateSyntaxError":
+                write_file('_macro_a.pyhtml', '<?py #@IMPORT _macro_b.pyhtml as b ?>\n')
+                write_file('_macro_b.pyhtml', '<?py #@IMPORT _macro_a.pyhtml as a ?>\n')
+                engine = tenjin.Engine(cache=False)
+                def f(): engine.render('_macro_a.pyhtml')
+                with pytest.raises(tenjin.TemplateSyntaxError, match="circular '#@IMPORT'"): f()
+                assert engine._importing == {}
+        finally:
+            _remove_files(['_macro_'])
+
+    def test_tiered_compilation(self):
+        page = (
+            '<?py #@ARGS items, title ?>\n'
+            '<?py #@FROM _tier_macro.pyhtml IMPORT badge ?>\n'
+            '<h1>${title}</h1>\n'
+            '<?py include("_tier_footer.pyhtml") ?>\n'
+            '<?py include("_tier_dynamic.pyhtml") ?>\n'
+            '<ul>\n'
+            '<?py for i, item in enumerate(items): ?>\n'
+            '  <li id="${i}">${item} (${len(items)}) ${"<&>"}</li>\n'
+            '<?py #endfor ?>\n'
+            '</ul>\n'
+            '#{badge(title)}\n'
+            )
+        context = {'items': ['<A>', 'B'], 'title': 'Tier&'}
+        expected = ('<h1>Tier&amp;</h1>\n'
+                    '<footer>static</footer>\n'
+                    '<p>Tier&amp;</p>\n'
+                    '<ul>\n'
+                    '  <li id="0">&lt;A&gt; (2) &lt;&amp;&gt;</li>\n'
+                    '  <li id="1">B (2) &lt;&amp;&gt;</li>\n'
+                    '</ul>\n'
+                    '<b>Tier&amp;</b>\n\n')
+        try:
+            write_file('_tier_page.pyhtml', page)
+            write_file('_tier_footer.pyhtml', '<footer>static</footer>\n')
+            write_file('_tier_dynamic.pyhtml', '<p>${title}</p>\n')
+            write_file('_tier_macro.pyhtml', '<?py #@MACRO badge(s) ?>\n<b>${s}</b>\n<?py #@ENDMACRO ?>\n')
+            if "tier_threshold is not specified then templates are not promoted":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage())
+                for _ in range(5):
+                    assert engine.render('_tier_page.pyhtml', dict(context)) == expected
+                assert engine.get_template('_tier_page.pyhtml').tier == 1
+                assert engine.tier_stats()['templates'] == {}
+            engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), tier_threshold=3, tier_background=False)
+            assert engine.tier_background is False and 'tier_background' not in engine.kwargs
+            if "number of rendering reaches to threshold then template is promoted to tier 2":
+                t = engine.get_template('_tier_page.pyhtml')
+                bytecode = t.bytecode
+                for _ in range(2):
+                    assert engine.render('_tier_page.pyhtml', dict(context)) == expected
+                assert t.tier == 1
+                assert engine.render('_tier_page.pyhtml', dict(context)) == expected
+                assert t.tier == 2
+                assert t.tier_passes == ['inline', 'escape', 'merge', 'localize']
+                assert t.bytecode is not bytecode
+            if "promoted template renders the same output":
+                assert engine.render('_tier_page.pyhtml', dict(context)) == expected
+            if "static template is not promoted":
+                assert engine.get_template('_tier_footer.pyhtml').tier == 1
+            if "inlined template is recorded as dependency":
+                assert '_tier_footer.pyhtml' in t.depends
+                assert '_tier_macro.pyhtml' in t.depends
+            if "tier_stats() returns number of templates and renders per tier":
+                stats = engine.tier_stats()
+                assert stats['threshold'] == 3
+                ## (footer is rendered twice before inlined)
+                assert stats['tiers'] == {1: {'templates': 2, 'renders': 6},
+                                          2: {'templates': 1, 'renders': 4}}
+                assert stats['templates']['_tier_page.pyhtml'] == \
+                    {'tier': 2, 'renders': 4, 'passes': ['inline', 'escape', 'merge', 'localize']}
+                assert stats['templates']['_tier_dynamic.pyhtml']['tier'] == 1
+            if "inlined template is changed then promoted template is reloaded":
+                write_file('_tier_footer.pyhtml', '<footer>changed</footer>\n')
+                future = time.time() + 1
+                os.utime('_tier_footer.pyhtml', (future, future))
+                t._last_checked_at = None
+                engine.get_template('_tier_footer.pyhtml')._last_checked_at = None
+                output = engine.render('_tier_page.pyhtml', dict(context))
+                assert output == expected.replace('static', 'changed')
+                assert engine.get_template('_tier_page.pyhtml') is not t
+                assert engine.get_template('_tier_page.pyhtml').tier == 1
+            if "template which uses capturing helpers is not localized":
+                write_file('_tier_capture.pyhtml',
+                           '<?py #@ARGS name ?>\n'
+                           '<?py start_capture("x") ?>\n'
+                           '<i>${name} ${1}</i>\n'
+                           '<?py stop_capture() ?>\n'
+                           '<p>#{_context["x"]}</p>\n')
+                for _ in range(3):
+                    output = engine.render('_tier_capture.pyhtml', {'name': 'A'})
+                assert output == '<p><i>A 1</i>\n</p>\n'
+                assert engine.get_template('_tier_capture.pyhtml').tier_passes == ['escape', 'merge']
+            if "tier_background is true then template is optimized in background thread":
+                engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), tier_threshold=1)
+                assert engine.render('_tier_page.pyhtml', dict(context)) == expected.replace('static', 'changed')
+                t = engine.get_template('_tier_page.pyhtml')
+                for _ in range(100):
+                    if t.tier == 2: break
+                    time.sleep(0.01)
+                assert t.tier == 2
+                assert engine.render('_tier_page.pyhtml', dict(context)) == expected.replace('static', 'changed')
+            if "template removed from cache storage is not kept for tier_stats()":
+                assert '_tier_page.pyhtml' in engine.tier_stats()['templates']
+                engine.cache.clear()
+                t = None
+                gc.collect()
+                assert engine.tier_stats()['templates'] == {}
+        finally:
+            _remove_files(['_tier_'])
+
+    def test_compile_errors(self):
+        try:
+            write_file('_broken_page.pyhtml', '<p>${{x}</p>\n')
+            engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage())
+            t = engine.get_template('_broken_page.pyhtml')
+            if "template is failed to compile then error is cached in template object":
+                assert t.bytecode is None
+                assert isinstance(t.compile_error, SyntaxError)
+                for _ in range(3):
+                    with pytest.raises(SyntaxError):
+                        engine.render('_broken_page.pyhtml', {'x': 1})
+                assert engine.get_template('_broken_page.pyhtml') is t
+            if "compile_errors() returns cached errors and number of hits":
+                assert engine.compile_errors() == {'_broken_page.pyhtml': {'error': t.compile_error, 'hits': 3}}
+            if "template file is changed then cached error is cleared":
+                write_file('_broken_page.pyhtml', '<p>${x}</p>\n')
+                future = time.time() + 1
+                os.utime('_broken_page.pyhtml', (future, future))
+                t._last_checked_at = None
+                assert engine.render('_broken_page.pyhtml', {'x': 1}) == '<p>1</p>\n'
+                assert engine.compile_errors() == {}
+        finally:
+            _remove_files(['_broken_'])
+
+    def test_reload_converts_only_changed_blocks(self):
+        input = ('<?py for i in range(3): ?>\n'
+                 '<p>${i}</p>\n'
+                 '<?py #endfor ?>\n'
+                 '<footer>v1</footer>\n')
+        bases = []
+        class RecordingTemplate(tenjin.Template):
+            def convert(self, input, filename=None, base=None):
+                bases.append(base)
+                return tenjin.Template.convert(self, input, filename, base)
+        try:
+            write_file('_incr_page.pyhtml', input)
+            engine = tenjin.Engine(cache=tenjin.MemoryCacheStorage(), templateclass=RecordingTemplate)
+            t1 = engine.get_template('_incr_page.pyhtml')
+            assert bases == [None]
+            if "template file is changed then expired template object is passed as base":
+                write_file('_incr_page.pyhtml', input.replace('v1', 'v2'))
+                future = time.time() + 1
+                os.utime('_incr_page.pyhtml', (future, future))
+                t1._last_checked_at = None
+                output = engine.render('_incr_page.pyhtml')
+                assert output == '<p>0</p>\n<p>1</p>\n<p>2</p>\n<footer>v2</footer>\n'
+                assert bases == [None, t1]
+                t2 = engine.get_template('_incr_page.pyhtml')
+                assert t2 is not t1
+                assert t2.script == tenjin.Template(None, input=input.replace('v1', 'v2')).script
+        finally:
+            _remove_files(['_incr_'])
+
 
 _DUMMY_VALUE = 'SOS'
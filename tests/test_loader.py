@@ -5,8 +5,10 @@
 ###
 
 import pytest
-import sys, os, time
+import sys, os, time, shutil
+import importlib.util
 import tenjin
+from tenjin.helpers import escape, to_str
 
 from test_engine import _with_dummy_files
 
@@ -52,3 +54,91 @@ class TestFileSystemLoader:
         # if file not exist, return None
         ret = self.loader.load('_views/layout2.pyhtml')
         assert ret == None
+
+
+class TestTemplateFinder:
+
+    @_with_dummy_files
+    def test_import(self):
+        with open('_views/_finder_page.pyhtml', 'w') as f:
+            f.write('<?py #@ARGS title ?>\n<h1>${title}</h1>\n')
+        finder = tenjin.TemplateFinder(['_views']).install()
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            # if template file is imported then module has template object and render().
+            import _finder_page
+            assert _finder_page.template.args == ['title']
+            assert _finder_page.template.filename == '_views/_finder_page.pyhtml'
+            assert _finder_page.render({'title': '<A>'}) == '<h1>&lt;A&gt;</h1>\n'
+            # compiled template is cached into '__pycache__/*.pyc' by importlib.
+            pycpath = importlib.util.cache_from_source('_views/_finder_page.pyhtml')
+            assert os.path.isfile(pycpath)
+            # if module is imported again then '*.pyc' is used instead of converting template.
+            del sys.modules['_finder_page']
+            try:
+                tenjin.Template.convert, orig = None, tenjin.Template.convert   # not called
+                import _finder_page
+            finally:
+                tenjin.Template.convert = orig
+            assert _finder_page.render({'title': 'B'}) == '<h1>B</h1>\n'
+            # if template file is not found then ImportError is raised.
+            with pytest.raises(ImportError):
+                import _finder_notfound
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+            sys.modules.pop('_finder_page', None)
+            finder.uninstall()
+        assert finder not in sys.meta_path
+
+
+class TestTemplateWatcher:
+
+    def _test_watch(self, backend):
+        changed = []
+        def wait_for(path):
+            for _ in range(300):
+                if path in changed: return True
+                time.sleep(0.01)
+            return False
+        os.mkdir('_watch')
+        try:
+            with open('_watch/page.pyhtml', 'w') as f:
+                f.write('<p>${x}</p>\n')
+            watcher = tenjin.TemplateWatcher(['_watch'], changed.append, backend, interval=0.02)
+            assert watcher.start() is watcher
+            assert watcher.backend == backend
+            assert watcher.is_alive()
+            try:
+                # if template file is changed then callback is called with full path of it.
+                fullpath = os.path.abspath('_watch/page.pyhtml')
+                with open('_watch/page.pyhtml', 'w') as f:
+                    f.write('<div>${x}</div>\n')
+                assert wait_for(fullpath)
+                # template file in subdirectory created after started is watched as well.
+                os.mkdir('_watch/blog')
+                time.sleep(0.05)
+                with open('_watch/blog/post.pyhtml', 'w') as f:
+                    f.write('<h1>${x}</h1>\n')
+                assert wait_for(os.path.abspath('_watch/blog/post.pyhtml'))
+                # if template file is removed then callback is called.
+                del changed[:]
+                os.unlink('_watch/page.pyhtml')
+                assert wait_for(fullpath)
+                # cache files are ignored.
+                with open('_watch/blog/post.pyhtml.cache', 'w') as f:
+                    f.write('dummy')
+                time.sleep(0.1)
+                assert os.path.abspath('_watch/blog/post.pyhtml.cache') not in changed
+            finally:
+                watcher.stop()
+            assert not watcher.is_alive()
+        finally:
+            shutil.rmtree('_watch', ignore_errors=True)
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is available only on Linux")
+    def test_inotify(self):
+        self._test_watch('inotify')
+
+    def test_poll(self):
+        self._test_watch('poll')
@@ -8,7 +8,7 @@
 import pytest
 import re
 import re as _re
-import sys, os, traceback, time
+import sys, os, traceback, time, marshal
 import yaml
 
 from testcase_helper import *
@@ -328,6 +328,7 @@ class TestMain:
             )
         expected_cache = r"""
 timestamp: %(timestamp)s
+signature: %(signature)s
 args: title, items
 
 title = _context.get('title'); items = _context.get('items'); 
@@ -337,7 +338,7 @@ for item in items:
     _extend(('''  <li>''', _escape(_to_str(item)), '''</li>\n''', ));
 #endfor
 _extend(('''</ul>\n''', ));
-"""[1:]  % {'timestamp': '%s.0' % int(time.time())}
+"""[1:]  % {'timestamp': '%s.0' % int(time.time()), 'signature': tenjin.Template().cache_signature()}
         self.filename = 'test_cache1.pyhtml'
         cachename = self.filename + '.cache'
         try:
@@ -557,6 +558,12 @@ _extend(('''</ul>\n''', ));
             #self._test()
             self.options = '-a dump %s' % cachename
             self._test()
+            # if script is not stored in cache file then it is regenerated.
+            os.unlink(cachename)
+            tenjin.Engine(cache=tenjin.LeanMarshalCacheStorage()).get_template(filename)
+            with open(cachename, 'rb') as f:
+                assert 'script' not in marshal.load(f)
+            self._test()
         finally:
             os.unlink(cachename)
 
@@ -582,6 +589,53 @@ _extend(('''</ul>\n''', ));
         self.options = "-qasyntax"
         self._test()
 
+    def test_static(self):  # -a static
+        self.options  = "-a static"
+        self.input    = ["<footer>\n  <p>(c) 2026</p>\n</footer>\n", INPUT]
+        self.filename = [".test_static0.pyhtml", ".test_static1.pyhtml"]
+        self.expected = (".test_static0.pyhtml - static.\n"
+                         ".test_static1.pyhtml - dynamic.\n")
+        self._test()
+
+    def test_bundle(self):  # -a bundle --bundle=file
+        bundlepath = ".test_bundle.bundle"
+        self.options  = "-a bundle --bundle=%s" % bundlepath
+        self.input    = [INPUT, INPUT3]
+        self.filename = [".test_bundle0.pyhtml", ".test_bundle1.pyhtml"]
+        self.expected = "%s - 2 templates.\n" % bundlepath
+        try:
+            self._test()
+            storage = tenjin.BundleCacheStorage(bundlepath)
+            assert storage._load(os.path.abspath(".test_bundle0.pyhtml") + ".cache")['bytecode'] is not None
+        finally:
+            if os.path.exists(bundlepath):
+                os.unlink(bundlepath)
+        #
+        self.options  = "-a bundle"
+        self.exception = CommandOptionError
+        self.errormsg = "-a bundle: '--bundle=file' option required."
+        self.expected = ""
+        self._test()
+
+    def test_deps(self):  # -a deps
+        self.options  = "-a deps"
+        self.input    = ["<?py _context['_layout'] = '.test_deps_layout.pyhtml' ?>\n"
+                         "<?py for x in items: ?>\n<?py include('.test_deps_row.pyhtml') ?>\n<?py #endfor ?>\n",
+                         "<html>#{_content}</html>\n",
+                         "<td>${x}</td>\n"]
+        self.filename = [".test_deps.pyhtml", ".test_deps_layout.pyhtml", ".test_deps_row.pyhtml"]
+        self.expected = (".test_deps.pyhtml: .test_deps_layout.pyhtml .test_deps_row.pyhtml\n"
+                         ".test_deps_layout.pyhtml:\n"
+                         ".test_deps_row.pyhtml:\n")
+        self._test()
+        #
+        self.options  = "-a deps"
+        self.filename = False
+        self.exception = CommandOptionError
+        self.errormsg = "-a deps: template filenames required."
+        self.expected = ""
+        self._test()
+
     def test_invalid_options(self):  # -Y, -i, -f, -c, -i foo
         self.input    = INPUT
         self.expected = ""
@@ -298,6 +298,17 @@ class TestSafeEngine:
             assert output == expected
         f()
 
+    def test_FUNCTEST_memoize(self):
+        fname = 'test_safe_engine_memoize.pyhtml'
+        input = "<?py #@ARGS v ?>\n<p>v={=v=}</p>\n"
+        @_with_template(fname, input)
+        def f():
+            engine = tenjin.SafeEngine(memoize=True)
+            assert engine.render(fname, {'v': as_escaped('<&>')}) == "<p>v=<&></p>\n"
+            ## escaped string and str which are equal should not share memoized output
+            assert engine.render(fname, {'v': '<&>'}) == "<p>v=&lt;&amp;&gt;</p>\n"
+        f()
+
     def test_FUNCTEST_preprocessing2(self):
         fname = 'test_safe_engine_preprocessing2.pyhtml'
         input = r'''
@@ -6,7 +6,7 @@
 
 import pytest
 import re
-import sys, os
+import sys, os, time
 
 from testcase_helper import *
 import tenjin
@@ -548,6 +548,226 @@ escape: ''', (var), '''\n''', ));
         #assert isinstance(cycle(), EscapedStr)
         #assert isinstance(cycle(), EscapedStr)
 
+    def test_macro(self):
+        input = r"""<?py #@MACRO badge(label, cls='info') ?>
+<span class="${cls}">${label}</span>
+<?py #@ENDMACRO ?>
+<p>#{badge('<New>')}</p>
+<?py badge('Old', 'warn', _buf=_buf) ?>
+"""
+        t = tenjin.Template("test.macro.pyhtml", input=input)
+        if "'#@MACRO' is found then converts it into function with keyword-only '_buf'":
+            expected = r"""def badge(label, cls='info', *, _buf=None):
+    _bufarg = _buf; _buf = [] if _buf is None else _buf; _extend=_buf.extend;_to_str=to_str;_escape=escape;
+    _extend(('''<span class="''', _escape(_to_str(cls)), '''">''', _escape(_to_str(label)), '''</span>\n''', ));
+    return ''.join(_buf) if _bufarg is None else None
+#enddef
+"""
+            assert t.macro_script == expected
+        if "macro is moved out of main script then blank lines are left to keep line numbers":
+            expected = "\n\n\n" + self.lvars + r"""_extend(('''<p>''', _to_str(badge('<New>')), '''</p>\n''', ));
+badge('Old', 'warn', _buf=_buf)
+"""
+            assert t.script == expected
+        if "macro is called without '_buf' then returns string, else appends into _buf":
+            assert t.render() == ('<p><span class="info">&lt;New&gt;</span>\n</p>\n'
+                                  '<span class="warn">Old</span>\n')
+        if "macros are evaluated only once":
+            macros = t.get_macros()
+            t.render()
+            assert t.get_macros() is macros
+            assert macros['badge']('x') == '<span class="info">x</span>\n'
+        if "'#@MACRO' is not closed then raises TemplateSyntaxError":
+            def f(): tenjin.Template(None, input="<?py #@MACRO foo() ?>\n<p>x</p>\n")
+            with pytest.raises(tenjin.TemplateSyntaxError, match="'#@MACRO foo' is not closed."): f()
+        if "'#@ENDMACRO' name is not matched then raises TemplateSyntaxError":
+            def f(): tenjin.Template(None, input="<?py #@MACRO foo() ?>\n<?py #@ENDMACRO bar ?>\n")
+            with pytest.raises(tenjin.TemplateSyntaxError, match="'#@ENDMACRO foo' expected"): f()
+        if "macro parameters are invalid then raises TemplateSyntaxError":
+            def f(): tenjin.Template(None, input="<?py #@MACRO foo(1x) ?>\n<?py #@ENDMACRO ?>\n")
+            with pytest.raises(tenjin.TemplateSyntaxError, match="invalid macro parameters"): f()
+
+    def test_memoize(self):
+        input = "<?py #@ARGS name ?>\n<?py #@MEMOIZE size=2, ttl=10 ?>\n<p>${name}:#{_context['count']()}</p>\n"
+        calls = []
+        def count():
+            calls.append(1)
+            return len(calls)
+        t = tenjin.Template(None, input=input)
+        if "'#@MEMOIZE' is found then sets memoize options":
+            assert t.memoize == True
+            assert t.memoize_size == 2
+            assert t.memoize_ttl == 10.0
+        if "template is rendered with same arguments then returns memoized output":
+            assert t.render({'name': 'A', 'count': count}) == "<p>A:1</p>\n"
+            assert t.render({'name': 'A', 'count': count}) == "<p>A:1</p>\n"
+            assert t.render({'name': 'B', 'count': count}) == "<p>B:2</p>\n"
+            assert len(calls) == 2
+        if "_buf is passed then memoized output is appended into it":
+            buf = ['<div>']
+            t.render({'name': 'B', 'count': count}, _buf=buf)
+            assert buf == ['<div>', "<p>B:2</p>\n"]
+        if "number of memoized outputs exceeds size then least recently used one is removed":
+            t.render({'name': 'C', 'count': count})
+            assert list(t._memo.items.keys()) == [((str, 'B'),), ((str, 'C'),)]
+        if "TTL is expired then template is evaluated again":
+            t._memo.items[((str, 'C'),)] = ("<p>C:3</p>\n", time.time() - 1)
+            assert t.render({'name': 'C', 'count': count}) == "<p>C:4</p>\n"
+        if "argument is not hashable then memoization is skipped":
+            t.render({'name': ['D'], 'count': count})
+            t.render({'name': ['D'], 'count': count})
+            assert len(calls) == 6
+            assert len(t._memo.items) == 2
+        if "'#@ARGS' is not declared then memoization is skipped":
+            t2 = tenjin.Template(None, input="<p>#{count()}</p>\n", memoize=True)
+            assert t2.render({'count': count}) == "<p>7</p>\n"
+            assert t2.render({'count': count}) == "<p>8</p>\n"
+        if "arguments are equal but types are different then they are memoized separately":
+            t3 = tenjin.Template(None, input="<?py #@ARGS x ?>\n<p>${repr(x)}</p>\n", memoize=True)
+            assert t3.render({'x': True}) == "<p>True</p>\n"
+            assert t3.render({'x': 1}) == "<p>1</p>\n"
+        if "invalid option is specified then raises TemplateSyntaxError":
+            def f(): tenjin.Template(None, input="<?py #@ARGS x ?>\n<?py #@MEMOIZE maxsize=2 ?>\n")
+            with pytest.raises(tenjin.TemplateSyntaxError, match="invalid option"): f()
+
+    def test_static(self):
+        input = "<footer>\n  <p>(c) 2026 'tenjin' \\ \"pytenjin\"</p>\n</footer>\n"
+        t = tenjin.Template(None, input=input)
+        if "template has no statements nor expressions then it is static":
+            assert t.static == input
+            assert t.render() == input
+        if "template is static then output is returned without evaluation":
+            t.bytecode = compile("raise RuntimeError('evaluated')", '(test)', 'exec')
+            assert t.render() == input
+            buf = ['<div>']
+            assert t.render({}, _buf=buf) is buf
+            assert buf == ['<div>', input]
+        if "template has statements or expressions then it is not static":
+            assert tenjin.Template(None, input="<p>${x}</p>\n").static is None
+            assert tenjin.Template(None, input="<?py x = 1 ?>\n<p></p>\n").static is None
+        if "preamble or postamble is specified then it is not static":
+            assert tenjin.Template(None, input=input, postamble=True).static is None
+
+    def test_compile_error_is_cached(self):
+        t = tenjin.Template(None, input='<p>${{x}</p>\n')
+        if "compile() fails then error is kept and raised":
+            with pytest.raises(SyntaxError) as exc_info:
+                t.compile()
+            error = exc_info.value
+            assert t.compile_error is error
+            assert t.compile_error_hits == 0
+        if "compile() is called again then kept error is raised without compiling":
+            t.script = "x = 1\n"
+            with pytest.raises(SyntaxError) as exc_info:
+                t.render({})
+            assert exc_info.value is error
+            assert t.compile_error_hits == 1
+            assert t.bytecode is None
+        if "template is converted again then kept error is cleared":
+            t.convert('<p>${x}</p>\n')
+            assert t.compile_error is None
+            assert t.compile_error_hits == 0
+            assert t.render({'x': 1}) == '<p>1</p>\n'
+
+    def test_convert_with_base(self):
+        input = ('<?py #@ARGS items ?>\n'
+                 '<h1>Items</h1>\n'
+                 '<?py for item in items: ?>\n'
+                 '  <li>${item}</li>\n'
+                 '<?py #endfor ?>\n'
+                 '<?py n = len(items) ?>\n'
+                 '<p>${n} items</p>\n'
+                 '<?py if n: ?>\n'
+                 '<p>not empty</p>\n'
+                 '<?py #endif ?>\n'
+                 '<footer></footer>\n')
+        base = tenjin.Template(None, input=input)
+        def convert(input, base):
+            converted = []
+            t = tenjin.Template(None)
+            orig = t.parse_stmts
+            def parse_stmts(buf, input):
+                converted.append(input)
+                return orig(buf, input)
+            t.parse_stmts = parse_stmts
+            t.convert(input, None, base)
+            return t, converted
+        if "template is converted then checkpoints between top-level blocks are recorded":
+            end_of = lambda s: input.index(s) + len(s)
+            assert [ cp[0] for cp in base._blocks ] == \
+                [ end_of(s) for s in ('#@ARGS items ?>\n', '#endfor ?>\n', 'len(items) ?>\n', '#endif ?>\n') ]
+        if "base template is specified then only changed top-level blocks are converted":
+            input2 = input.replace('${n} items', '${n} item(s)')
+            t, converted = convert(input2, base)
+            assert converted == ['<p>${n} item(s)</p>\n<?py if n: ?>\n<p>not empty</p>\n<?py #endif ?>\n']
+            assert t.script == tenjin.Template(None, input=input2).script
+            assert t.args == ['items']
+            assert t.render({'items': ['A']}) == ('<h1>Items</h1>\n  <li>A</li>\n'
+                                                  '<p>1 item(s)</p>\n<p>not empty</p>\n<footer></footer>\n')
+        if "checkpoints are updated so that converted template can be base of next conversion":
+            input3 = input2.replace('<footer></footer>', '<footer>(c)</footer>')
+            t2, converted = convert(input3, t)
+            assert converted == ['<footer>(c)</footer>\n']
+            assert t2.script == tenjin.Template(None, input=input3).script
+            assert t2._blocks == tenjin.Template(None, input=input3)._blocks
+        if "directive is found in changed blocks then whole template is converted":
+            input4 = input.replace('<h1>Items</h1>', '<?py #@MEMOIZE ?>\n<h1>Items</h1>')
+            t, converted = convert(input4, base)
+            assert converted == [input4]
+            assert t.memoize is True
+        if "changed blocks are not valid then error is reported with line number of whole template":
+            input5 = input.replace('<?py #endif ?>\n', '')
+            with pytest.raises(tenjin.TemplateSyntaxError) as exc_info:
+                convert(input5, base)
+            assert exc_info.value.lineno == 8
+
+    def test_optimizer(self):
+        optimizer = tenjin.TemplateOptimizer()
+        g = {'escape': tenjin.helpers.escape, 'to_str': tenjin.helpers.to_str}
+        def render(t, code, context):
+            t.bytecode = code
+            return t.render(dict(context), dict(g))
+        if "escaping of numbers is elided only when variable is assigned only numbers":
+            input = ('<?py #@ARGS items ?>\n'
+                     '<?py for i in range(len(items)): ?>\n'
+                     '<?py     s = items[i] ?>\n'
+                     '<p>${i}:${s}:${i * 2}</p>\n'
+                     '<?py #endfor ?>\n')
+            t = tenjin.Template(None, input=input)
+            expected = t.render({'items': ['<a>']}, dict(g))
+            code, passes = optimizer.optimize(t, g)
+            assert passes == ['escape', 'localize']
+            assert render(t, code, {'items': ['<a>']}) == expected == '<p>0:&lt;a&gt;:0</p>\n'
+            escaped = []
+            g2 = dict(g, escape=lambda s: escaped.append(s) or tenjin.helpers.escape(s))
+            code, passes = optimizer.optimize(t, g2)
+            escaped[:] = []
+            t.bytecode = code
+            t.render({'items': ['<a>']}, g2)
+            assert escaped == ['<a>']
+        if "'#@ARGS' is not declared then variables are not regarded as numbers":
+            t = tenjin.Template(None, input='<?py i = 1 ?>\n<p>${i}</p>\n')
+            assert optimizer.optimize(t, g) is None
+            assert render(t, t.bytecode, {'i': '<b>'}) == '<p>1</p>\n'
+        if "escape function changes numbers then escaping is not elided":
+            t = tenjin.Template(None, input='<?py #@ARGS ?>\n<p>${1}</p>\n')
+            g2 = dict(g, escape=lambda s: '[%s]' % s)
+            assert optimizer.optimize(t, g2) == None or 'escape' not in optimizer.optimize(t, g2)[1]
+        if "template uses capturing helpers then it is not localized":
+            t = tenjin.Template(None, input='<?py #@ARGS ?>\n<?py start_capture("x") ?>\n<p>${1}</p>\n<?py stop_capture() ?>\n')
+            code, passes = optimizer.optimize(t, g)
+            assert passes == ['escape', 'merge']
+        if "output is kept in try statement":
+            t = tenjin.Template(None, input='<?py #@ARGS f ?>\n')
+            t.script += self.lvars + ("\ntry:\n"
+                         "    _extend(('<p>', ));\n"
+                         "    _extend((_to_str(f()), '</p>', ));\n"
+                         "except ValueError:\n"
+                         "    _extend(('error', ));\n")
+            def f(): raise ValueError()
+            code, passes = optimizer.optimize(t, g)
+            assert render(t, code, {'f': f}) == '<p>error'
+
     def test_curly_braces_in_expressions(self):
         # '{}' is available in '${}' or '#{}', such as '${foo({'x':1})}'
         input = """
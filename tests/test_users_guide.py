@@ -74,6 +74,8 @@ class TestUsersGuide:
                 if self.__name__ == 'm17n':
                     expected = re.sub(r'timestamp: \d+(\.\d+)?', 'timestamp: 0.0', expected)
                     actual   = re.sub(r'timestamp: \d+(\.\d+)?', 'timestamp: 0.0', actual)
+                    expected = re.sub(r'signature: \S+', 'signature: -', expected)
+                    actual   = re.sub(r'signature: \S+', 'signature: -', actual)
             if self._testMethodName == 'test_nested':
                 expected = re.sub(r'[ \t]*\#.*', '', expected)
             assert actual == expected